@@ -0,0 +1,82 @@
+#pragma once
+
+#include <boost/python.hpp>
+#include <boost/math/quaternion.hpp>
+
+#include "exceptions.h"
+
+/* PointingModel - corrections to the encoder (az, el, roll) readings
+ * of the telescope boresight.
+ *
+ * The horizon-frame boresight rotation is modeled as
+ *
+ *   Rx(base_tilt_x) Ry(base_tilt_y) Rz(-(az + az_offset))
+ *     Rx(npae) Ry(pi/2 - (el + el_offset)) Rx(collimation)
+ *     Rz(pi + roll + roll_offset)
+ *
+ * where Ri(a) is a rotation by angle a about axis i, and the result is
+ * decomposed back into (az, el, roll) in the same form as used by
+ * CelestialSightLine.naive_az_el (for which all parameters are zero).
+ * The parameters, in radians, are read from a mapping (such as
+ * so3g.proj.PointingModel); missing keys are taken as zero.
+ */
+
+class PointingModel {
+public:
+    PointingModel(boost::python::object params);
+    void Apply(double &az, double &el, double &roll) const;
+
+    double az_offset = 0.;
+    double el_offset = 0.;
+    double roll_offset = 0.;
+    double collimation = 0.;
+    double npae = 0.;
+    double base_tilt_x = 0.;
+    double base_tilt_y = 0.;
+
+private:
+    boost::math::quaternion<double> _q_tilt;
+    boost::math::quaternion<double> _q_npae;
+    boost::math::quaternion<double> _q_coll;
+};
+
+/* PointingCorrection - a tabulated rotation C(t, az, el), which
+ * multiplies the naive boresight quaternion on the left to give the
+ * high-precision one (see so3g.proj.PointingCorrection).  The table is
+ * a float64 array of shape (n_t, n_az, n_el, 4), on regular grids
+ * starting at (t0, az0, el0) with spacing (dt, daz, del).  It is
+ * interpolated linearly, and clamped at the edges.
+ */
+
+class PointingCorrection {
+public:
+    PointingCorrection(boost::python::object correction);
+    boost::math::quaternion<double> Get(double t, double az,
+                                        double el) const;
+
+private:
+    BufferWrapper _buf;
+    const char *_data;
+    int _n[3];
+    Py_ssize_t _strides[4];
+    double _x0[3], _dx[3];
+};
+
+// Apply the model to float64 az, el and roll vectors, in place.
+void apply_pointing_model(boost::python::object params,
+                          boost::python::object az,
+                          boost::python::object el,
+                          boost::python::object roll);
+
+// Naive horizon to celestial boresight quaternions, for
+// CelestialSightLine.naive_az_el, optionally corrected with a
+// PointingCorrection; written into output, of shape (n, 4).
+void naive_boresight(boost::python::object output,
+                     boost::python::object t,
+                     boost::python::object az,
+                     boost::python::object el,
+                     boost::python::object roll,
+                     double lon, double lat, double era_epoch,
+                     double era_rate, double era_offset,
+                     boost::python::object pointing_model,
+                     boost::python::object correction);
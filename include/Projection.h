@@ -1,4 +1,6 @@
 #include <boost/python.hpp>
+#include <omp.h>
+#include <unordered_map>
 #include "exceptions.h"
 
 namespace bp = boost::python;
@@ -50,9 +52,15 @@ public:
     int DetCount() { return n_det; }
     int TimeCount() { return n_time; }
     void GetCoords(int i_det, int i_time, const double *dofs, double *coords);
+    static void QuatToCoords(const double *qdet, double *coords,
+                             bool fast_math);
+    bool fast_math = false;
 private:
+    void _GetBore(int i_time, double *qbore);
     BufferWrapper _pborebuf;
     BufferWrapper _pdetbuf;
+    bool _pbore_f32;
+    bool _pdet_f32;
     int n_det;
     int n_time;
 };
@@ -67,10 +75,19 @@ public:
     bool TestInputs(bp::object &map, bp::object &pbore, bp::object &pdet,
                     bp::object &signal, bp::object &weight);
     bp::object zeros(int count);
+    bp::object zeros(int count, int dtype);
     int GetPixel(int i_det, int i_time, const double *coords);
     std::pair<int,int> IndexRange();
+    int GetTile(int pixel_index, int tile_ny, int tile_nx);
+    double MaxRadius();
+    bp::object downgrade(bp::object map, int factor, bp::object weights,
+                         bp::object output);
+    bp::object upgrade(bp::object map, int factor, int order,
+                       bp::object output);
+    bp::object resample(Pixelizor2_Flat &src, bp::object src_map, int order,
+                        bp::object output);
 private:
-    int crpix[2];
+    double crpix[2];
     double cdelt[2];
     int naxis[2];
     int strides[2];
@@ -132,7 +149,7 @@ public:
             delete _signalspace;
     };
     inline int ComponentCount() {return SpinClass::comp_count;}
-    void PixelWeight(const double *coords, FSIGNAL *wt);
+    void PixelWeight(const int i_det, const double *coords, FSIGNAL *wt);
     bool TestInputs(bp::object &map, bp::object &pbore, bp::object &pdet,
                     bp::object &signal, bp::object &weight);
     void Forward(const int i_det,
@@ -150,7 +167,14 @@ public:
                  const int pixel_index,
                  const double* coords,
                  const FSIGNAL* weights);
+    void PairSignal(const FSIGNAL sum, const FSIGNAL diff, FSIGNAL *sig);
+    void ForwardPair(const int i_a,
+                     const int i_b,
+                     const int i_time,
+                     const int pixel_index,
+                     const double* coords);
     SignalSpace<FSIGNAL> *_signalspace = nullptr;
+    FSIGNAL scale = 1.;
 protected:
     bool need_map = true;
     bool need_signal = true;
@@ -158,12 +182,79 @@ protected:
     int n_det = 0;
     int n_time = 0;
     BufferWrapper _mapbuf;
+    // Per-detector (eff cos 2 delta, eff sin 2 delta), or empty.
+    vector<double> _pol_cal;
+    void PolWeight(const int i_det, const double *coords, FSIGNAL *wt);
+};
+
+/** HitCounter - accumulate integer hit counts.
+ *
+ * The map may be int32 or uint16 (DTYPE), with shape (n_y, n_x) or
+ * (n_group, n_y, n_x).  In the latter case, each detector's hits are
+ * accumulated into the plane given by its entry in the groups vector;
+ * detectors with a negative group index are skipped.
+ */
+
+template <typename DTYPE>
+class HitCounter : public ProjectionOptimizer {
+public:
+    HitCounter<DTYPE>(bp::object _groups, int _n_det):
+        groups(_groups), n_det(_n_det) {};
+    ~HitCounter<DTYPE>() {};
+    bool TestInputs(bp::object &map, bp::object &pbore, bp::object &pdet,
+                    bp::object &signal, bp::object &weight);
+    inline bool Skip(const int i_det) {return _plane_offsets[i_det] < 0;}
+    void Forward(const int i_det,
+                 const int i_time,
+                 const int pixel_index);
+protected:
+    bp::object groups;
+    int n_det = 0;
+    BufferWrapper _mapbuf;
+    vector<int> _plane_offsets;
+};
+
+/** ProjectionStats - optional timing and sample counters for the
+ *  ProjectionEngine methods.
+ *
+ * When enabled, an instrumented method records the time spent
+ * checking its inputs (up to the start of the main loop), the wall
+ * time of the loop, and, for each thread, the time spent working and
+ * the number of samples processed and of those that fell outside the
+ * map.  When disabled (the default), only the sample counters in the
+ * loop are kept, and they are discarded.
+ */
+
+class ProjectionStats {
+public:
+    bool enabled = false;
+    inline double Now() const { return enabled ? omp_get_wtime() : 0.; }
+    void Start(std::string method);
+    void StartLoop(int n_threads);
+    inline void AddWork(double t_start, long n_samp, long n_offmap) {
+        if (!enabled)
+            return;
+        int i = omp_get_thread_num();
+        t_thread[i] += omp_get_wtime() - t_start;
+        n_samples[i] += n_samp;
+        n_offmaps[i] += n_offmap;
+    }
+    void EndLoop();
+    bp::object ToDict() const;
+private:
+    std::string _method;
+    double _t0 = 0.;
+    double _t_inputs = 0.;
+    double _t_loop = 0.;
+    vector<double> t_thread;
+    vector<long> n_samples;
+    vector<long> n_offmaps;
 };
 
 template<typename P, typename Z, typename A>
 class ProjectionEngine {
 public:
-    ProjectionEngine(Z pixelizor);
+    ProjectionEngine(Z pixelizor, bool fast_math=false);
     bp::object to_map(bp::object map, bp::object pbore, bp::object pofs,
                       bp::object signal, bp::object weights);
     bp::object to_map_omp(bp::object map, bp::object pbore, bp::object pofs,
@@ -174,12 +265,128 @@ public:
     bp::object to_weight_map_omp(bp::object map, bp::object pbore, bp::object pofs,
                                  bp::object signal, bp::object weights,
                                  bp::object thread_intervals);
+    bp::object to_hits(bp::object map, bp::object pbore, bp::object pofs,
+                       bp::object groups);
+    bp::object to_hits_omp(bp::object map, bp::object pbore, bp::object pofs,
+                           bp::object groups, bp::object thread_intervals);
+    bp::object to_map_pairs(bp::object map, bp::object pbore, bp::object pofs,
+                            bp::object signal, bp::object weights,
+                            bp::object pairs, bool pair_pointing=true);
+    bp::object to_map_pairs_omp(bp::object map, bp::object pbore, bp::object pofs,
+                                bp::object signal, bp::object weights,
+                                bp::object pairs, bp::object thread_intervals,
+                                bool pair_pointing=true);
     bp::object from_map(bp::object map, bp::object pbore, bp::object pofs,
-                        bp::object signal, bp::object weights);
+                        bp::object signal, bp::object weights,
+                        double scale=1.);
+    bp::object from_map_omp(bp::object map, bp::object pbore, bp::object pofs,
+                            bp::object signal, bp::object weights,
+                            bp::object thread_intervals, double scale=1.);
     bp::object coords(bp::object pbore, bp::object pofs,
                       bp::object coord);
     bp::object pixels(bp::object pbore, bp::object pofs, bp::object pixel);
-    bp::object pixel_ranges(bp::object pbore, bp::object pofs);
+    bp::object pixel_ranges(bp::object pbore, bp::object pofs,
+                            int n_domain=0);
+    bp::object tile_ranges(bp::object pbore, bp::object pofs,
+                           bp::object tile_shape);
+    bp::object mask_ranges(bp::object map, bp::object pbore, bp::object pofs);
+    void set_profile(bool enabled) { _profile = enabled; }
+    bp::object get_stats();
+    // Number of samples per block in the detector x time traversal
+    // of the sample loops (0 for the default).
+    int get_time_block() const { return _time_block; }
+    void set_time_block(int time_block);
 private:
+    // The methods work on a copy of the pixelizor (whose TestInputs
+    // records the map strides), so concurrent calls do not interfere.
     Z _pixelizor;
+    bool _fast_math;
+    int _time_block;
+    // Each call keeps its own stats, and stores them here when done
+    // (see _StoreStats).
+    bool _profile = false;
+    ProjectionStats _last_stats;
+    int _TimeBlock() const;
+    void _StoreStats(const ProjectionStats &stats);
+    template <typename DTYPE>
+    void _to_hits(bp::object &map, bp::object &pbore, bp::object &pofs,
+                  bp::object &groups, bp::object &thread_intervals);
+};
+
+/** MultiProjectionEngine - project one set of detector timestreams
+ *  into several maps, with different projections, pixelizations and
+ *  rotations, in a single pass.
+ *
+ *  The detector quaternion (boresight times offset) is computed once
+ *  per sample and then, for each target, left-multiplied by that
+ *  target's rotation before the projection and pixelization are
+ *  applied.  The targets are given, when constructing, as a list of
+ *  (proj_name, pixelizor) pairs; the rotations are passed with the
+ *  data, one per target, each either None (identity), a single
+ *  quaternion of shape (4,), or one quaternion per sample, (n_t,4).
+ *  The targets are split between the OpenMP threads.
+ */
+
+template<typename A>
+class MultiProjectionEngine {
+public:
+    MultiProjectionEngine(bp::object targets, bool fast_math=false);
+    bp::object to_map(bp::object maps, bp::object pbore, bp::object pofs,
+                      bp::object rots, bp::object signal, bp::object weights);
+    bp::object to_weight_map(bp::object maps, bp::object pbore, bp::object pofs,
+                             bp::object rots, bp::object signal, bp::object weights);
+private:
+    vector<int> _projs;
+    // Copied by each call, as in ProjectionEngine.
+    vector<Pixelizor2_Flat> _pixelizors;
+    bool _fast_math;
+    template<bool weight_map>
+    bp::object _accumulate(bp::object &maps, bp::object &pbore, bp::object &pofs,
+                           bp::object &rots, bp::object &signal,
+                           bp::object &weights);
+};
+
+/** StackingEngine - project detector timestreams into cutouts
+ *  centered on each source of a catalog, in a single pass.
+ *
+ *  The cutout geometry is given by a zenithal projection (CoordSys is
+ *  ProjARC, ProjTAN or ProjZEA) and a pixelizor, with the source at
+ *  the reference point.  The sources are given, when constructing, as
+ *  an array of shape (n_source,4) of quaternions that rotate
+ *  celestial coordinates to the native coordinates of each source
+ *  (i.e. with the source at the pole, and the cutout in the desired
+ *  orientation).  The sources near each sample are found with a grid
+ *  index, so the cost per sample does not grow with the size of the
+ *  catalog.
+ *
+ *  The map passed to to_map is either (n_comp,n_y,n_x), to stack all
+ *  the cutouts, or (n_source,n_comp,n_y,n_x), to keep them separate;
+ *  similarly for to_weight_map.  If None, a stacked map is created.
+ */
+
+template<typename CoordSys, typename A>
+class StackingEngine {
+public:
+    StackingEngine(Pixelizor2_Flat pixelizor, bp::object sources,
+                   bool fast_math=false);
+    bp::object to_map(bp::object map, bp::object pbore, bp::object pofs,
+                      bp::object signal, bp::object weights);
+    bp::object to_weight_map(bp::object map, bp::object pbore, bp::object pofs,
+                             bp::object signal, bp::object weights);
+    int SourceCount() { return _n_source; }
+private:
+    // Copied by each call, as in ProjectionEngine.
+    Pixelizor2_Flat _pixelizor;
+    bool _fast_math;
+    int _n_source;
+    vector<double> _qsrc;
+    vector<double> _vsrc;
+    double _cell;
+    long _n_cell;
+    std::unordered_map<long, vector<int>> _cells;
+    long _CellIndex(double x) { return (long)((x + 1.) / _cell) + 1; }
+    void _Candidates(const double *v, long &last_key, vector<int> &cand);
+    template<bool weight_map>
+    bp::object _accumulate(bp::object &map, bp::object &pbore, bp::object &pofs,
+                           bp::object &signal, bp::object &weights);
 };
@@ -0,0 +1,65 @@
+#pragma once
+
+#include <boost/python.hpp>
+
+/* Thread control for the OpenMP regions in so3g.
+ *
+ * The thread count is kept per calling thread, so that several Python
+ * threads can each run so3g workloads with their own limits.  Every
+ * parallel region in so3g should pass so3g_get_num_threads() in its
+ * num_threads clause, and a ThreadPin (see below) as firstprivate.
+ */
+
+// Returns the number of threads to use for a parallel region started
+// by the calling thread: the value set by so3g_set_num_threads, or
+// omp_get_max_threads() if that is 0 (the default).
+int so3g_get_num_threads();
+
+// Sets the thread count for the calling thread (0 to restore the
+// OpenMP default), and returns the previous setting.
+int so3g_set_num_threads(int n_threads);
+
+// Requests that the threads of the calling thread's OpenMP team be
+// pinned to the listed CPUs (thread i to cpus[i % len(cpus)]), or
+// restored to their original affinity if cpus is None.  The calling
+// thread is pinned at once; the others are pinned by ThreadPin when
+// they join a parallel region started by the calling thread.
+void so3g_set_affinity(boost::python::object cpus);
+
+/* ThreadPin applies the affinity requested by so3g_set_affinity
+ * inside a parallel region.  OpenMP does not guarantee that a region
+ * is run by the same threads as an earlier one, so the pinning must
+ * be done in each region that does the work.  Declare a ThreadPin
+ * before the region and list it as firstprivate; each thread's copy
+ * then pins that thread, if the request has changed since the thread
+ * was last pinned (so this costs nothing when no request was made):
+ *
+ *     ThreadPin _pin;
+ *     #pragma omp parallel for num_threads(so3g_get_num_threads()) \
+ *         firstprivate(_pin)
+ */
+
+struct AffinityRequest;
+
+class ThreadPin {
+public:
+    ThreadPin();
+    ThreadPin(const ThreadPin &other);
+private:
+    const AffinityRequest *_request;
+};
+
+/* ReleaseGIL releases the Python GIL for the lifetime of the object,
+ * so that other Python threads can run while so3g is busy.  Only wrap
+ * code that does not touch any Python objects (including buffer
+ * releases, i.e. BufferWrapper destructors); declare it in a block
+ * that closes before any such objects are used again.
+ */
+
+class ReleaseGIL {
+public:
+    ReleaseGIL() { _state = PyEval_SaveThread(); }
+    ~ReleaseGIL() { PyEval_RestoreThread(_state); }
+private:
+    PyThreadState *_state;
+};
@@ -29,3 +29,4 @@ if os.getenv('DOCS_BUILD') != '1':
 # Other python modules.
 from . import hk
 from . import proj
+from . import threads
@@ -0,0 +1,8 @@
+"""Performance benchmarks for so3g.
+
+The benchmarks are not imported with so3g; run them from the command
+line, e.g.::
+
+  python -m so3g.bench.proj --help
+
+"""
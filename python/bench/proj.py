@@ -0,0 +1,379 @@
+"""Benchmarks of the projection engines (so3g.ProjEng_*).
+
+Synthetic pointing -- a raster scan of a square patch, observed by a
+disk-shaped focal plane -- is processed by each engine, and the
+throughput of each operation is measured at several thread counts.
+From the command line::
+
+  python -m so3g.bench.proj --n-det 200 --n-time 100000 \\
+      --threads 1,2,4,8 --output bench.json
+
+Later (e.g. after upgrading so3g), check for regressions against
+that run::
+
+  python -m so3g.bench.proj --compare bench.json
+
+The same can be done from Python, with run and compare.
+
+"""
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+import so3g
+from so3g import threads
+from so3g.proj import quat
+
+PROJECTIONS = ['Flat', 'CAR', 'CEA', 'ARC', 'TAN', 'ZEA']
+COMPS = ['T', 'QU', 'TQU']
+
+#: Operations that depend on the components; these are timed for
+#: every engine.  The pairs operations use consecutive detectors as
+#: pairs.
+COMP_OPERATIONS = ['to_map', 'to_map_omp', 'to_weight_map',
+                   'to_weight_map_omp', 'from_map', 'from_map_omp',
+                   'to_map_pairs_omp']
+
+#: Operations that depend only on the projection; these are timed
+#: with the _T engine.
+POINTING_OPERATIONS = ['coords', 'pixels', 'pixel_ranges',
+                       'to_hits', 'to_hits_omp']
+
+#: Operations that do not use OpenMP; these are timed once, with a
+#: single thread.
+SERIAL_OPERATIONS = ['to_map', 'to_weight_map', 'to_hits']
+
+
+def get_pointing(proj_name, n_det, n_time, width=2., fp_width=0.5):
+    """Returns synthetic (pbore, pofs) arrays, of shape (n_time, 4)
+    and (n_det, 4), for use with the engines of projection proj_name.
+
+    The boresight makes a raster scan of a width x width degree
+    patch, centered on the reference point of the projection.  The
+    detectors fill a disk of diameter fp_width degrees, with a range
+    of polarization angles.
+
+    """
+    t = np.arange(n_time) / n_time
+    x = width * quat.DEG * (abs((20 * t) % 2 - 1) - 0.5)
+    y = width * quat.DEG * (t - 0.5)
+
+    i = np.arange(n_det)
+    r = fp_width / 2 * quat.DEG * (i / n_det)**.5
+    phi = i * np.pi * (3 - 5**.5)
+    dx, dy = r * np.cos(phi), r * np.sin(phi)
+    gamma = i * 37 * quat.DEG
+
+    if proj_name == 'Flat':
+        pbore = np.array([x, y, np.ones(n_time), np.zeros(n_time)]).T
+        pofs = np.array([dx, dy, np.cos(gamma), np.sin(gamma)]).T
+    else:
+        if proj_name in ['CAR', 'CEA']:
+            # Centered on the equator.
+            q_bore = quat.rotation_lonlat(x, y)
+        else:
+            # Centered on the pole.
+            q_bore = quat.rotation_xieta(x, y)
+        pbore = np.asarray(q_bore, dtype='float64')
+        pofs = np.asarray(quat.rotation_xieta(dx, dy, gamma),
+                          dtype='float64')
+    return np.ascontiguousarray(pbore), np.ascontiguousarray(pofs)
+
+
+def get_pixelizor(width=2., res=1., fp_width=0.5):
+    """Returns a Pixelizor2_Flat, with res arcminute pixels, that
+    covers the data returned by get_pointing (with some margin).
+
+    """
+    res = res * quat.DEG / 60
+    n_pix = int(np.ceil((width + fp_width) * 1.1 * quat.DEG / res))
+    return so3g.Pixelizor2_Flat(n_pix, n_pix, res, -res,
+                                n_pix / 2., n_pix / 2.)
+
+
+def default_thread_counts():
+    """Returns the thread counts to test by default: the powers of 2
+    below so3g.get_num_threads(), and that number itself.
+
+    """
+    n_max = so3g.get_num_threads()
+    counts = [1]
+    while counts[-1] * 2 < n_max:
+        counts.append(counts[-1] * 2)
+    if n_max > 1:
+        counts.append(n_max)
+    return counts
+
+
+def _best_time(func, repeat):
+    best = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        dt = time.perf_counter() - t0
+        if best is None or dt < best:
+            best = dt
+    return best
+
+
+def _get_call(projeng, operation, pbore, pofs, n_comp, ny, nx):
+    """Returns a function that does one call of operation, with
+    inputs and outputs preallocated.
+
+    """
+    n_det, n_time = len(pofs), len(pbore)
+    if operation.startswith('to_map') or operation.startswith('from_map'):
+        signal = np.ones((n_det, n_time), 'float32')
+        map_ = np.zeros((n_comp, ny, nx))
+    elif operation.startswith('to_weight_map'):
+        map_ = np.zeros((n_comp, n_comp, ny, nx))
+    elif operation.startswith('to_hits'):
+        map_ = np.zeros((ny, nx), 'int32')
+    ivals = []
+    if operation.endswith('_omp'):
+        ivals.append(projeng.pixel_ranges(pbore, pofs))
+
+    if operation == 'to_map':
+        return lambda: projeng.to_map(map_, pbore, pofs, signal, None)
+    if operation == 'to_map_omp':
+        return lambda: projeng.to_map_omp(map_, pbore, pofs, signal,
+                                          None, ivals[0])
+    if operation == 'to_weight_map':
+        return lambda: projeng.to_weight_map(map_, pbore, pofs, None, None)
+    if operation == 'to_weight_map_omp':
+        return lambda: projeng.to_weight_map_omp(map_, pbore, pofs, None,
+                                                 None, ivals[0])
+    if operation == 'from_map':
+        return lambda: projeng.from_map(map_, pbore, pofs, signal, None)
+    if operation == 'from_map_omp':
+        return lambda: projeng.from_map_omp(map_, pbore, pofs, signal,
+                                            None, ivals[0])
+    if operation == 'to_map_pairs_omp':
+        pairs = np.arange(n_det // 2 * 2, dtype='int32').reshape(-1, 2)
+        return lambda: projeng.to_map_pairs_omp(map_, pbore, pofs, signal,
+                                                None, pairs, ivals[0], False)
+    if operation == 'to_hits':
+        return lambda: projeng.to_hits(map_, pbore, pofs, None)
+    if operation == 'to_hits_omp':
+        return lambda: projeng.to_hits_omp(map_, pbore, pofs, None,
+                                           ivals[0])
+    if operation == 'coords':
+        coords = np.zeros((n_det, n_time, 4))
+        return lambda: projeng.coords(pbore, pofs, coords)
+    if operation == 'pixels':
+        pixels = np.zeros((n_det, n_time), 'int32')
+        return lambda: projeng.pixels(pbore, pofs, pixels)
+    if operation == 'pixel_ranges':
+        return lambda: projeng.pixel_ranges(pbore, pofs)
+    raise ValueError('Unknown operation "%s".' % operation)
+
+
+def run(projections=None, comps=None, thread_counts=None, n_det=100,
+        n_time=100000, width=2., res=1., repeat=3, log=None):
+    """Time the projection engine operations.
+
+    Arguments:
+      projections: List of projection names (default: PROJECTIONS).
+      comps: List of component strings (default: COMPS).
+      thread_counts: List of thread counts (default:
+        default_thread_counts()).
+      n_det, n_time: Size of the synthetic data.
+      width: Width of the scanned patch, in degrees.
+      res: Map resolution, in arcminutes.
+      repeat: Each call is repeated this many times, and the best
+        time is kept.
+      log: If not None, a file (e.g. sys.stdout) to which a line is
+        written for each result.
+
+    Returns a dict with entries 'config' (the arguments, and some
+    information about the environment) and 'results'.  The results
+    are a list of dicts with keys:
+
+    - 'engine', 'projection', 'comps', 'operation', 'n_threads'
+    - 'time': the best time for one call, in seconds.
+    - 'samples_per_sec': n_det * n_time / time.
+    - 'speedup': relative to the same operation with the first (i.e.
+      smallest) thread count.
+    - 'efficiency': speedup divided by the relative thread count.
+
+    The POINTING_OPERATIONS are only timed with the _T engines, and
+    the SERIAL_OPERATIONS only with a single thread.
+
+    """
+    if projections is None:
+        projections = PROJECTIONS
+    if comps is None:
+        comps = COMPS
+    if thread_counts is None:
+        thread_counts = default_thread_counts()
+    thread_counts = sorted(int(n) for n in thread_counts)
+
+    config = {'projections': list(projections),
+              'comps': list(comps),
+              'thread_counts': thread_counts,
+              'n_det': n_det,
+              'n_time': n_time,
+              'width': width,
+              'res': res,
+              'repeat': repeat,
+              'so3g_version': getattr(so3g, '__version__', None),
+              'max_threads': so3g.get_num_threads(),
+              'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+    results = []
+    n_samp = n_det * n_time
+
+    pixelizor = get_pixelizor(width, res)
+    ny, nx = pixelizor.zeros(1).shape[-2:]
+
+    for proj_name in projections:
+        pbore, pofs = get_pointing(proj_name, n_det, n_time, width)
+        for comp in comps:
+            projeng = getattr(so3g, 'ProjEng_%s_%s' % (proj_name, comp))(
+                pixelizor)
+            operations = list(COMP_OPERATIONS)
+            if comp == 'T':
+                operations.extend(POINTING_OPERATIONS)
+            for operation in operations:
+                counts = thread_counts
+                if operation in SERIAL_OPERATIONS:
+                    counts = [1]
+                t_first = None
+                for n_threads in counts:
+                    with threads.limit(n_threads):
+                        func = _get_call(projeng, operation, pbore, pofs,
+                                          len(comp), ny, nx)
+                        dt = _best_time(func, repeat)
+                    if t_first is None:
+                        t_first = dt
+                    speedup = t_first / dt
+                    result = {
+                        'engine': 'ProjEng_%s_%s' % (proj_name, comp),
+                        'projection': proj_name,
+                        'comps': comp,
+                        'operation': operation,
+                        'n_threads': n_threads,
+                        'time': dt,
+                        'samples_per_sec': n_samp / dt,
+                        'speedup': speedup,
+                        'efficiency': speedup * counts[0] / n_threads,
+                    }
+                    results.append(result)
+                    if log is not None:
+                        log.write('%-18s %-18s %3i  %9.5f s  %10.4g /s  '
+                                  'eff=%.2f\n' % (
+                                      result['engine'], operation, n_threads,
+                                      dt, result['samples_per_sec'],
+                                      result['efficiency']))
+                        log.flush()
+    return {'config': config, 'results': results}
+
+
+def compare(new, old, tolerance=0.1):
+    """Compare two outputs of run, and return the results in new whose
+    samples_per_sec is lower than that of the matching result in old
+    by more than the fraction tolerance.  Each item returned is a dict
+    with keys 'engine', 'operation', 'n_threads', 'old', 'new' (the
+    two samples_per_sec) and 'ratio' (new / old).
+
+    Raises ValueError if the two runs used different data sizes.
+
+    """
+    for key in ['n_det', 'n_time', 'width', 'res']:
+        if new['config'][key] != old['config'][key]:
+            raise ValueError('Benchmark runs differ in %s (%r != %r).' % (
+                key, new['config'][key], old['config'][key]))
+    ref = {(r['engine'], r['operation'], r['n_threads']): r['samples_per_sec']
+           for r in old['results']}
+    slower = []
+    for r in new['results']:
+        key = (r['engine'], r['operation'], r['n_threads'])
+        if key not in ref:
+            continue
+        ratio = r['samples_per_sec'] / ref[key]
+        if ratio < 1 - tolerance:
+            slower.append({'engine': key[0], 'operation': key[1],
+                           'n_threads': key[2], 'old': ref[key],
+                           'new': r['samples_per_sec'], 'ratio': ratio})
+    return slower
+
+
+def _list_arg(text, type_=str):
+    return [type_(x) for x in text.split(',') if x != '']
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m so3g.bench.proj',
+        description='Benchmark the so3g projection engines.')
+    parser.add_argument('--projections', type=_list_arg,
+                        default=PROJECTIONS,
+                        help='Comma-separated projections (default: all).')
+    parser.add_argument('--comps', type=_list_arg, default=COMPS,
+                        help='Comma-separated components (default: all).')
+    parser.add_argument('--threads', type=lambda x: _list_arg(x, int),
+                        default=None,
+                        help='Comma-separated thread counts (default: '
+                        'powers of 2 up to the OpenMP maximum).')
+    parser.add_argument('--n-det', type=int, default=100)
+    parser.add_argument('--n-time', type=int, default=100000)
+    parser.add_argument('--width', type=float, default=2.,
+                        help='Width of the scanned patch, in degrees.')
+    parser.add_argument('--res', type=float, default=1.,
+                        help='Map resolution, in arcminutes.')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', '-o',
+                        help='File to which to write the results (JSON).')
+    parser.add_argument('--compare',
+                        help='Results of an earlier run (JSON); the data '
+                        'sizes are taken from there, unless given.')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Fractional slow-down reported as a '
+                        'regression by --compare.')
+    parser.add_argument('--quiet', '-q', action='store_true')
+    return parser
+
+
+def main(args=None):
+    parser = get_parser()
+    args = parser.parse_args(args)
+
+    old = None
+    kwargs = {}
+    if args.compare is not None:
+        with open(args.compare) as fin:
+            old = json.load(fin)
+        # Reproduce the earlier configuration, except where set.
+        for key in ['projections', 'comps', 'n_det', 'n_time', 'width',
+                    'res', 'repeat']:
+            if parser.get_default(key) == getattr(args, key):
+                setattr(args, key, old['config'][key])
+        if args.threads is None:
+            args.threads = old['config']['thread_counts']
+
+    output = run(projections=args.projections, comps=args.comps,
+                 thread_counts=args.threads, n_det=args.n_det,
+                 n_time=args.n_time, width=args.width, res=args.res,
+                 repeat=args.repeat,
+                 log=None if args.quiet else sys.stdout)
+
+    if args.output is not None:
+        with open(args.output, 'w') as fout:
+            json.dump(output, fout, indent=1)
+
+    if old is not None:
+        slower = compare(output, old, args.tolerance)
+        for s in slower:
+            print('Regression: %-18s %-18s %3i  %10.4g -> %10.4g /s '
+                  '(%.0f%%)' % (s['engine'], s['operation'], s['n_threads'],
+                                s['old'], s['new'], 100 * s['ratio']))
+        if len(slower):
+            return 1
+        print('No regressions.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,10 +4,14 @@ from spt3g import core
 from . import quat
 from . import util
 
-from .wcs import Projectionist, Ranges, RangesMatrix
+from .wcs import (Projectionist, ProjectionPlan, Ranges, RangesMatrix,
+                  multi_to_map, multi_to_weights)
 from .coords import CelestialSightLine, EarthlySite, Assembly, FocalPlane
 from .weather import Weather, weather_factory
+from .pointing import PointingModel, PointingCorrection
 from .ranges import Ranges, RangesMatrix
+from .tiles import TiledMap
+from .coadd import MapAccumulator
 
 import numpy as np
 
@@ -0,0 +1,248 @@
+import os
+import json
+import shutil
+
+import numpy as np
+
+from .tiles import TiledMap
+
+
+class MapAccumulator:
+    """Accumulates the signal and weights maps of many observations
+    into a coadd, and keeps track of which observations it contains.
+
+    The maps may be held in memory, in memory-mapped .npy files, or
+    in TiledMaps (see the workdir and tile_shape arguments).  The
+    accumulator can be saved to a checkpoint directory, restored from
+    one (e.g. when a long job resumes after preemption), and merged
+    with other accumulators or checkpoints (e.g. from other
+    processes).
+
+    Arguments:
+      projectionist: The Projectionist describing the map geometry.
+      comps: The projection component string, e.g. 'T', 'QU', 'TQU'.
+      workdir: If not None, a scratch directory in which to keep the
+        maps on disk (its previous contents are discarded).
+        Otherwise the maps are kept in memory.
+      tile_shape: If not None, the maps are TiledMaps with this
+        (tile_ny, tile_nx) tiling, stored under workdir (which is
+        then required).  Otherwise the maps are dense arrays.
+      max_cached: The max_cached argument for the TiledMaps.
+
+    Attributes:
+      signal: The signal map, shape (n_comp, n_y, n_x).
+      weights: The weights map, shape (n_comp, n_comp, n_y, n_x).
+      obs_ids: The list of observation IDs that have been added.
+
+    """
+    STATE_FILE = 'state.json'
+
+    def __init__(self, projectionist, comps='TQU', workdir=None,
+                 tile_shape=None, max_cached=16):
+        self.projectionist = projectionist
+        self.comps = comps
+        self.workdir = workdir
+        self.tile_shape = None
+        if tile_shape is not None:
+            self.tile_shape = tuple(int(x) for x in tile_shape)
+        self.obs_ids = []
+
+        n = len(comps)
+        shape = (int(projectionist.naxis[1]), int(projectionist.naxis[0]))
+        self.shapes = {'signal': (n,) + shape,
+                       'weights': (n, n) + shape}
+        if self.tile_shape is not None and workdir is None:
+            raise ValueError('TiledMap storage requires a workdir.')
+        for key, _shape in self.shapes.items():
+            if workdir is None:
+                m = np.zeros(_shape)
+            elif self.tile_shape is None:
+                os.makedirs(workdir, exist_ok=True)
+                m = np.lib.format.open_memmap(
+                    os.path.join(workdir, key + '.npy'), mode='w+',
+                    dtype='float64', shape=_shape)
+            else:
+                _path = os.path.join(workdir, key)
+                shutil.rmtree(_path, ignore_errors=True)
+                m = TiledMap(_path, _shape, self.tile_shape,
+                             max_cached=max_cached)
+            setattr(self, key, m)
+
+    def __contains__(self, obs_id):
+        return obs_id in self.obs_ids
+
+    def add(self, assembly, signal, obs_id=None, omp=None):
+        """Project the signal and pointing weights of one observation
+        into the maps.  If obs_id is given and has already been added
+        (for example before a checkpoint that was then restored), the
+        data are skipped.  The obs_id must be a string or integer.
+        Returns True if the data were added.
+
+        See Projectionist documentation for description of standard
+        arguments.
+
+        """
+        if obs_id is not None and obs_id in self.obs_ids:
+            return False
+        p = self.projectionist
+        p.to_map(signal, assembly, dest_map=self.signal, omp=omp,
+                 comps=self.comps)
+        p.to_weights(assembly, dest_map=self.weights, omp=omp,
+                     comps=self.comps)
+        if obs_id is not None:
+            self.obs_ids.append(obs_id)
+        return True
+
+    def merge(self, other):
+        """Add the maps of other -- a MapAccumulator, or the path of a
+        checkpoint saved by one -- into this accumulator.  Raises
+        ValueError if the two have observations in common.
+
+        """
+        owned = not isinstance(other, MapAccumulator)
+        if owned:
+            obs_ids, maps = self._open_checkpoint(other)
+        else:
+            obs_ids = other.obs_ids
+            maps = [other.signal, other.weights]
+        common = set(obs_ids).intersection(self.obs_ids)
+        if len(common):
+            raise ValueError('Accumulators both contain obs_ids %s.'
+                             % sorted(common))
+        for key, src in zip(['signal', 'weights'], maps):
+            _add_into(getattr(self, key), src)
+            # Release the tiles of maps opened from a checkpoint (but
+            # not those of a live accumulator).
+            if owned and isinstance(src, TiledMap):
+                src.close()
+        self.obs_ids.extend(obs_ids)
+
+    def save(self, path):
+        """Save the accumulator to the checkpoint directory path.
+
+        The maps are written to a new subdirectory, which only
+        replaces the previous checkpoint once it is complete; so if
+        the job is interrupted, the last checkpoint remains usable.
+
+        """
+        os.makedirs(path, exist_ok=True)
+        old_state = _read_state(path)
+        # Number past any checkpoint directory left by an interrupted
+        # save, as well as the current one.
+        seqs = [old_state['seq']] if old_state is not None else []
+        for f in os.listdir(path):
+            if f.startswith('ckpt_') and f[5:].isdigit():
+                seqs.append(int(f[5:]))
+        seq = max(seqs, default=-1) + 1
+        name = 'ckpt_%06i' % seq
+        tmp_dir = os.path.join(path, name + '.tmp')
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for key in ['signal', 'weights']:
+            m = getattr(self, key)
+            if isinstance(m, TiledMap):
+                m.flush()
+                os.makedirs(os.path.join(tmp_dir, key))
+                for tile in m.tiles():
+                    src = m.tile_filename(tile)
+                    dest = os.path.join(tmp_dir, key, os.path.basename(src))
+                    shutil.copyfile(src, dest)
+                    _fsync(dest)
+                _fsync(os.path.join(tmp_dir, key))
+            else:
+                dest = os.path.join(tmp_dir, key + '.npy')
+                np.save(dest, m)
+                _fsync(dest)
+        _fsync(tmp_dir)
+        os.rename(tmp_dir, os.path.join(path, name))
+        _fsync(path)
+
+        state = {'seq': seq,
+                 'checkpoint': name,
+                 'comps': self.comps,
+                 'shape': self.shapes['signal'][1:],
+                 'tile_shape': self.tile_shape,
+                 'obs_ids': self.obs_ids}
+        state_file = os.path.join(path, self.STATE_FILE)
+        with open(state_file + '.tmp', 'w') as fout:
+            json.dump(state, fout)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(state_file + '.tmp', state_file)
+        _fsync(path)
+        # Remove the previous checkpoint, and any left by interrupted
+        # saves.
+        for f in os.listdir(path):
+            if f.startswith('ckpt_') and f != name:
+                shutil.rmtree(os.path.join(path, f), ignore_errors=True)
+
+    def restore(self, path):
+        """Load the checkpoint from directory path into this (empty)
+        accumulator.  Returns False, and does nothing, if there is no
+        checkpoint there yet.
+
+        """
+        if _read_state(path) is None:
+            return False
+        if len(self.obs_ids):
+            raise ValueError('Cannot restore into a non-empty accumulator.')
+        self.merge(path)
+        return True
+
+    def _open_checkpoint(self, path):
+        state = _read_state(path)
+        if state is None:
+            raise ValueError('No checkpoint found in %s.' % path)
+        if (state['comps'] != self.comps or
+                tuple(state['shape']) != self.shapes['signal'][1:]):
+            raise ValueError('Checkpoint in %s does not match the '
+                             'accumulator geometry.' % path)
+        ckpt_dir = os.path.join(path, state['checkpoint'])
+        maps = []
+        for key in ['signal', 'weights']:
+            if os.path.isdir(os.path.join(ckpt_dir, key)):
+                maps.append(TiledMap(os.path.join(ckpt_dir, key),
+                                     self.shapes[key], state['tile_shape']))
+            else:
+                maps.append(np.load(os.path.join(ckpt_dir, key + '.npy'),
+                                    mmap_mode='r'))
+        return state['obs_ids'], maps
+
+
+def _fsync(path):
+    """Flush the file or directory at path to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _read_state(path):
+    state_file = os.path.join(path, MapAccumulator.STATE_FILE)
+    if not os.path.exists(state_file):
+        return None
+    with open(state_file) as fin:
+        return json.load(fin)
+
+
+def _add_into(dest, src):
+    """Add map src into dest; either may be a TiledMap or an array."""
+    if isinstance(src, TiledMap):
+        if isinstance(dest, TiledMap) and dest.tile_shape != src.tile_shape:
+            raise ValueError('Cannot merge TiledMaps with different tiling.')
+        for tile in src.tiles():
+            data = src.get_tile(tile)
+            if isinstance(dest, TiledMap):
+                dest.get_tile(tile)[...] += data
+            else:
+                y0, y1, x0, x1 = src.tile_bounds(tile)
+                dest[..., y0:y1, x0:x1] += data
+    elif isinstance(dest, TiledMap):
+        for tile in range(dest.tile_count):
+            y0, y1, x0, x1 = dest.tile_bounds(tile)
+            block = src[..., y0:y1, x0:x1]
+            if np.any(block):
+                dest.get_tile(tile)[...] += block
+    else:
+        dest += src
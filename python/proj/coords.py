@@ -3,6 +3,10 @@ from . import quat
 from .weather import weather_factory
 
 from collections import OrderedDict
+import concurrent.futures
+import contextlib
+import os
+import threading
 
 import numpy as np
 
@@ -37,6 +41,46 @@ ERA_POLY = np.array([6.300387486754831,
                      4.894961212823756])  # Operates on "days since ERA_EPOCH".
 
 
+#: Number of samples per chunk, for high-precision pointing.
+PRECISE_CHUNK_SIZE = 2**16
+#: Number of worker threads for high-precision pointing; if None, the
+#: number of CPUs available to the process.
+PRECISE_WORKERS = None
+
+# Idle qpoint.QPoint instances, by configuration.
+_qpoint_cache = {}
+_qpoint_lock = threading.Lock()
+
+
+def _available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+@contextlib.contextmanager
+def _qpoint_session(qpoint, config):
+    """Context manager that takes a QPoint, with the high-precision
+    settings and weather config, from the cache (or creates one) and
+    returns it to the cache on exit.  Each session is used by one
+    thread at a time.
+
+    """
+    key = tuple(sorted(config.items()))
+    with _qpoint_lock:
+        idle = _qpoint_cache.setdefault(key, [])
+        qp = idle.pop() if len(idle) else None
+    if qp is None:
+        qp = qpoint.QPoint(accuracy='high', fast_math=True, mean_aber=True,
+                           num_threads=1, rate_ref='always', **config)
+    try:
+        yield qp
+    finally:
+        with _qpoint_lock:
+            _qpoint_cache[key].append(qp)
+
+
 class CelestialSightLine:
     """Carries a vector of celestial pointing data.
 
@@ -56,38 +100,69 @@ class CelestialSightLine:
         raise ValueError("Could not decode %s as a Site." % site)
 
     @classmethod
-    def naive_az_el(cls, t, az, el, roll=0., site=None, weather=None):
+    def naive_az_el(cls, t, az, el, roll=0., site=None, weather=None,
+                    pointing_model=None, output=None, correction=None):
         """Construct a SightLine from horizon coordinates, az and el (in
         radians) and time t (unix timestamp).
 
         This will be off by several arcminutes... but less than a
         degree.  The weather is ignored.
 
+        If a PointingModel is passed as pointing_model, it is applied
+        to the encoder az, el and roll first.
+
+        If a PointingCorrection is passed as correction, its tabulated
+        rotation is applied to the result, giving (nearly) the
+        high-precision pointing of az_el at the cost of the naive
+        computation.
+
+        The inputs are broadcast against each other, to 1-d.  The
+        quaternions are computed in C++, with OpenMP over samples,
+        and written into output, if passed (a G3VectorQuat, which is
+        then used as self.Q, or a float64 array of shape (n, 4)).  If
+        all of t, az, el and roll are scalars, and output is not
+        passed, self.Q is a single quat.
+
         """
         site = cls.decode_site(site)
         assert isinstance(site, EarthlySite)
 
         self = cls()
 
-        J = (t - ERA_EPOCH) / 86400
-        era = np.polyval(ERA_POLY, J)
-        lst = era + site.lon * DEG
-
-        self.Q = (
-            quat.euler(2, lst) *
-            quat.euler(1, np.pi/2 - site.lat * DEG) *
-            quat.euler(2, np.pi) *
-            quat.euler(2, -az) *
-            quat.euler(1, np.pi/2 - el) *
-            quat.euler(2, np.pi + roll)
-            )
+        scalar = (output is None and
+                  all(np.ndim(x) == 0 for x in [t, az, el, roll]))
+        t, az, el, roll = np.broadcast_arrays(
+            *[np.atleast_1d(np.asarray(x, dtype='float64'))
+              for x in [t, az, el, roll]])
+        if output is None:
+            output = quat.G3VectorQuat(np.empty((len(t), 4)))
+        so3g.naive_boresight(output, t, az, el, roll,
+                             site.lon * DEG, site.lat * DEG, ERA_EPOCH,
+                             ERA_POLY[0], ERA_POLY[1], pointing_model,
+                             correction)
+        if not isinstance(output, quat.G3VectorQuat):
+            output = quat.G3VectorQuat(output)
+        self.Q = output[0] if scalar else output
         return self
 
     @classmethod
-    def az_el(cls, t, az, el, roll=None, site=None, weather=None):
+    def az_el(cls, t, az, el, roll=None, site=None, weather=None,
+              pointing_model=None, output=None, n_workers=None,
+              chunk_size=None):
         """Construct a SightLine from horizon coordinates.  This uses
         high-precision pointing.
 
+        If a PointingModel is passed as pointing_model, it is applied
+        to the encoder az, el and roll first.
+
+        The samples are processed in chunks of chunk_size (default
+        PRECISE_CHUNK_SIZE), on a pool of n_workers threads (default
+        PRECISE_WORKERS, or the number of CPUs available).  The qpoint
+        sessions are cached, per weather, and reused across calls.
+        If output is passed (a G3VectorQuat, which is then used as
+        self.Q, or a C-contiguous float64 array of shape (n, 4)), the
+        quaternions are written into it.
+
         """
         import qpoint  # https://github.com/arahlin/qpoint
 
@@ -104,21 +179,57 @@ class CelestialSightLine:
                              '\'vacuum\'.')
 
         self = cls()
-        qp = qpoint.QPoint(accuracy='high', fast_math=True, mean_aber=True,
-                           num_threads=4,
-                           rate_ref='always', **weather.to_qpoint())
-
-        az, el, t = map(np.asarray, [az, el, t])
-        Q_arr = qp.azel2bore(az / DEG, el / DEG, None, None,
-                             lon=site.lon, lat=site.lat, ctime=t)
-        self.Q = quat.G3VectorQuat(Q_arr)
-
-        # Apply boresight roll manually (note qpoint pitch/roll refer
-        # to the platform rather than to something about the boresight
-        # axis).
-        if roll is not None:
-            self.Q *= quat.euler(2, roll)
-
+        t, az, el, roll = np.broadcast_arrays(
+            *[np.atleast_1d(np.asarray(x, dtype='float64'))
+              for x in [t, az, el, 0. if roll is None else roll]])
+        n = len(t)
+        if output is None:
+            output = quat.G3VectorQuat(np.empty((n, 4)))
+        q_out = np.asarray(output)
+        if q_out.shape != (n, 4):
+            raise ValueError('output has shape %s; expected %s.' %
+                             (q_out.shape, (n, 4)))
+        if chunk_size is None:
+            chunk_size = PRECISE_CHUNK_SIZE
+        chunk_size = max(int(chunk_size), 1)
+        if n_workers is None:
+            n_workers = PRECISE_WORKERS or _available_cpus()
+        qp_args = {'lon': site.lon, 'lat': site.lat}
+        qp_config = weather.to_qpoint()
+
+        def _chunk(i0):
+            s = slice(i0, i0 + chunk_size)
+            a, e, r = az[s], el[s], roll[s]
+            if pointing_model is not None:
+                with so3g.threads.limit(1):
+                    a, e, r = pointing_model.apply(a, e, r)
+            q = q_out[s]
+            with _qpoint_session(qpoint, qp_config) as qp:
+                qp.azel2bore(a / DEG, e / DEG, None, None,
+                             ctime=t[s], q=q, **qp_args)
+            # Apply boresight roll manually (note qpoint pitch/roll
+            # refer to the platform rather than to something about
+            # the boresight axis): q <- q * euler(2, roll).
+            c, sn = np.cos(r / 2), np.sin(r / 2)
+            q0, q1, q2, q3 = q.T.copy()
+            q[:, 0] = q0 * c - q3 * sn
+            q[:, 1] = q1 * c + q2 * sn
+            q[:, 2] = q2 * c - q1 * sn
+            q[:, 3] = q3 * c + q0 * sn
+
+        starts = range(0, n, chunk_size)
+        if n_workers <= 1 or len(starts) <= 1:
+            for i0 in starts:
+                _chunk(i0)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=min(n_workers, len(starts))) as pool:
+                for f in [pool.submit(_chunk, i0) for i0 in starts]:
+                    f.result()
+
+        if not isinstance(output, quat.G3VectorQuat):
+            output = quat.G3VectorQuat(output)
+        self.Q = output
         return self
 
     def coords(self, det_offsets=None, output=None):
@@ -0,0 +1,135 @@
+import so3g
+from . import quat
+
+import numpy as np
+
+DEG = np.pi / 180.
+
+
+class PointingModel(dict):
+    """This is a thin wrapper around a dict, holding the parameters of a
+    telescope pointing model, i.e. the corrections that take encoder
+    readings of (az, el, roll) to the true boresight position.
+
+    Parameters (all in radians):
+
+    - 'az_offset', 'el_offset', 'roll_offset': encoder zero-point
+      offsets, added to the encoder readings.
+    - 'collimation': cross-elevation offset of the boresight from the
+      optical axis.
+    - 'npae': non-perpendicularity of the azimuth and elevation axes.
+    - 'base_tilt_x', 'base_tilt_y': tilt of the azimuth axis, as small
+      rotations about the horizon x axis (az=0) and y axis (az=-90
+      deg).
+
+    The model is evaluated in C++ (see so3g.apply_pointing_model),
+    with OpenMP over samples.  Missing parameters are zero, in which
+    case the model has no effect.
+
+    """
+
+    default = {'az_offset': 0.,
+               'el_offset': 0.,
+               'roll_offset': 0.,
+               'collimation': 0.,
+               'npae': 0.,
+               'base_tilt_x': 0.,
+               'base_tilt_y': 0.}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for k, v in self.default.items():
+            if k not in self:
+                self[k] = v
+
+    def apply(self, az, el, roll=0., inplace=False):
+        """Apply the model to encoder az, el and roll (in radians),
+        returning the corrected (az, el, roll) as float64 arrays.  The
+        inputs are broadcast against each other.  If inplace=True, the
+        inputs must be 1-d float64 arrays of the same length, and are
+        updated in place rather than copied.
+
+        """
+        if inplace:
+            so3g.apply_pointing_model(self, az, el, roll)
+            return az, el, roll
+        args = [np.array(x, dtype='float64')
+                for x in np.broadcast_arrays(az, el, roll)]
+        so3g.apply_pointing_model(self, *[x.reshape(-1) for x in args])
+        return tuple(args)
+
+
+class PointingCorrection:
+    """Tabulated correction from the naive boresight pointing
+    (CelestialSightLine.naive_az_el) to the high-precision pointing
+    (CelestialSightLine.az_el).
+
+    The correction is a rotation C(t, az, el), which multiplies the
+    naive boresight quaternion on the left.  It absorbs refraction,
+    aberration, precession and nutation, and the difference between
+    the naive and precise Earth rotation.  These all vary slowly with
+    time and pointing, so C is tabulated on a coarse regular grid (see
+    for_observation) and interpolated linearly, in C++, when passed as
+    the correction argument of naive_az_el.
+
+    Attributes:
+      table: float64 array of shape (n_t, n_az, n_el, 4), holding the
+        correction quaternions on the grid.
+      t0, dt: start and spacing of the time grid (unix timestamp, s).
+      az0, daz: start and spacing of the azimuth grid (radians).
+      el0, del_: start and spacing of the elevation grid (radians).
+
+    """
+
+    def __init__(self, table, t0, dt, az0, daz, el0, del_):
+        self.table = np.ascontiguousarray(table, dtype='float64')
+        if self.table.ndim != 4 or self.table.shape[3] != 4:
+            raise ValueError('table must have shape (n_t, n_az, n_el, 4).')
+        self.t0, self.dt = float(t0), float(dt)
+        self.az0, self.daz = float(az0), float(daz)
+        self.el0, self.del_ = float(el0), float(del_)
+
+    @classmethod
+    def for_observation(cls, t, az, el, site=None, weather=None,
+                        dt=300., daz=2*DEG, del_=0.5*DEG, reference=None):
+        """Tabulate the correction over the range of t, az and el (in
+        radians) covered by an observation.
+
+        Arguments:
+          t, az, el: The boresight time, az and el vectors (only the
+            ranges are used).  If a pointing model will be applied,
+            pass the corrected az and el (the model offsets are
+            usually well within one grid step, though).
+          site, weather: As for CelestialSightLine.az_el.
+          dt, daz, del_: The grid spacing.  The defaults keep the
+            interpolation errors well below 0.1 arcsec above 20
+            degrees elevation.
+          reference: A function, called as reference(t, az, el) with
+            1-d arrays, that returns the precise boresight quaternions
+            (roll = 0).  The default uses CelestialSightLine.az_el
+            (which requires qpoint).
+
+        """
+        from .coords import CelestialSightLine
+        if reference is None:
+            def reference(t, az, el):
+                return CelestialSightLine.az_el(
+                    t, az, el, site=site, weather=weather).Q
+
+        axes = []
+        for x, dx in [(t, dt), (az, daz), (el, del_)]:
+            lo, hi = np.min(x), np.max(x)
+            n = int(np.ceil((hi - lo) / dx)) + 1
+            axes.append(lo + dx * np.arange(n))
+        grid = [g.ravel() for g in np.meshgrid(*axes, indexing='ij')]
+
+        q_ref = np.array(reference(*grid), dtype='float64')
+        q_naive = np.array(
+            CelestialSightLine.naive_az_el(*grid, site=site).Q)
+        q_naive[:, 1:] *= -1
+        table = np.array(quat.G3VectorQuat(q_ref) *
+                         quat.G3VectorQuat(q_naive))
+        table[table[:, 0] < 0] *= -1
+        table.shape = tuple(len(a) for a in axes) + (4,)
+        return cls(table, t0=axes[0][0], dt=dt, az0=axes[1][0], daz=daz,
+                   el0=axes[2][0], del_=del_)
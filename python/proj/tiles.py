@@ -0,0 +1,149 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+class TiledMap:
+    """A map that lives on disk, split into rectangular tiles.
+
+    Each tile is stored in its own .npy file in the directory ``path``,
+    and is accessed through a memory map.  Only the tiles that are
+    actually touched are ever created, so sparse coverage of a large
+    (e.g. full-sky) geometry costs little disk.  A limited number of
+    tiles is kept open at any time; when more are needed, the least
+    recently used tile is flushed and closed.
+
+    The Projectionist methods to_map, to_weights and to_hits accept a
+    TiledMap as dest_map.  In that case the samples are first bucketed
+    by tile (see Projectionist.get_tile_ranges), and then each tile is
+    visited once, so tile faults stay rare even for large maps.
+
+    Arguments:
+      path: Directory in which to store the tile files.
+      shape: The full map shape, (..., n_y, n_x).  The leading
+        dimensions (e.g. (n_comp,) for a signal map, or (n_comp,
+        n_comp) for a weights map) are carried by every tile.
+      tile_shape: The (tile_ny, tile_nx) shape of each tile; tiles in
+        the last row and column are truncated to fit the map.
+      dtype: The data type of the map.
+      max_cached: The maximum number of tiles to keep open.
+
+    If the directory already contains tiles (from an earlier
+    instance, with the same shape and tiling), they are reused; a
+    ValueError is raised if any of them does not have the expected
+    dtype and shape.
+
+    """
+    def __init__(self, path, shape, tile_shape, dtype='float64',
+                 max_cached=16):
+        self.path = path
+        self.shape = tuple(shape)
+        self.tile_shape = tuple(int(x) for x in tile_shape)
+        self.dtype = np.dtype(dtype)
+        self.max_cached = max_cached
+        ny, nx = self.shape[-2:]
+        ty, tx = self.tile_shape
+        self.tile_grid = ((ny + ty - 1) // ty, (nx + tx - 1) // tx)
+        self._cache = OrderedDict()
+        os.makedirs(path, exist_ok=True)
+        for tile in self.tiles():
+            self._check_tile(tile, np.load(self.tile_filename(tile),
+                                           mmap_mode='r'))
+
+    def __repr__(self):
+        return 'TiledMap(%s, shape=%s, tile_shape=%s)' % (
+            self.path, self.shape, self.tile_shape)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def tile_count(self):
+        return self.tile_grid[0] * self.tile_grid[1]
+
+    def tile_bounds(self, tile):
+        """Returns (y0, y1, x0, x1), the pixel index bounds of the tile."""
+        iy, ix = divmod(tile, self.tile_grid[1])
+        ty, tx = self.tile_shape
+        y0, x0 = iy * ty, ix * tx
+        return (y0, min(y0 + ty, self.shape[-2]),
+                x0, min(x0 + tx, self.shape[-1]))
+
+    def tile_filename(self, tile):
+        return os.path.join(self.path, 'tile_%06i.npy' % tile)
+
+    def tiles(self):
+        """Returns the sorted list of tile indices that have been created."""
+        tiles = []
+        for f in os.listdir(self.path):
+            stem = f[5:-4]
+            if f.startswith('tile_') and f.endswith('.npy') and stem.isdigit():
+                tiles.append(int(stem))
+        return sorted(tiles)
+
+    def _check_tile(self, tile, data):
+        """Raise ValueError unless data, the contents of an existing
+        tile file, has this map's dtype and the tile's shape."""
+        if tile >= self.tile_count:
+            raise ValueError('Tile %i is outside the tile grid %s.'
+                             % (tile, self.tile_grid))
+        y0, y1, x0, x1 = self.tile_bounds(tile)
+        shape = self.shape[:-2] + (y1 - y0, x1 - x0)
+        if data.dtype != self.dtype or data.shape != shape:
+            raise ValueError('Tile file %s has dtype %s and shape %s; '
+                             'expected %s and %s.' % (
+                                 self.tile_filename(tile), data.dtype,
+                                 data.shape, self.dtype, shape))
+
+    def has_tile(self, tile):
+        return tile in self._cache or os.path.exists(self.tile_filename(tile))
+
+    def get_tile(self, tile, create=True):
+        """Returns the tile data as a writable memory-mapped array, with
+        shape (..., y1-y0, x1-x0).  If the tile does not exist yet,
+        it is created and initialized to zero (unless create=False,
+        in which case None is returned).
+
+        """
+        if tile in self._cache:
+            self._cache.move_to_end(tile)
+            return self._cache[tile]
+        filename = self.tile_filename(tile)
+        if os.path.exists(filename):
+            data = np.lib.format.open_memmap(filename, mode='r+')
+            self._check_tile(tile, data)
+        elif create:
+            y0, y1, x0, x1 = self.tile_bounds(tile)
+            data = np.lib.format.open_memmap(
+                filename, mode='w+', dtype=self.dtype,
+                shape=self.shape[:-2] + (y1 - y0, x1 - x0))
+        else:
+            return None
+        self._cache[tile] = data
+        while len(self._cache) > self.max_cached:
+            _, old = self._cache.popitem(last=False)
+            old.flush()
+        return data
+
+    def flush(self):
+        """Flush all open tiles to disk."""
+        for data in self._cache.values():
+            data.flush()
+
+    def close(self):
+        """Flush and close all open tiles."""
+        self.flush()
+        self._cache.clear()
+
+    def to_dense(self):
+        """Assemble and return the full map as an ordinary array.  This
+        is mostly useful for small maps and for testing.
+
+        """
+        output = np.zeros(self.shape, self.dtype)
+        for tile in self.tiles():
+            y0, y1, x0, x1 = self.tile_bounds(tile)
+            output[..., y0:y1, x0:x1] = self.get_tile(tile)
+        return output
@@ -23,3 +23,42 @@ def ces(el, az0, throw, v_scan, t):
     az = phase
     az[phase>2*throw] = 4*throw - phase[phase>2*throw]
     return az - throw + az0, el + az*0
+
+
+def healpix_pix2ang(nside, pix):
+    """Returns the (lon, lat), in radians, of the centers of the HEALPix
+    pixels pix (RING ordering) for resolution parameter nside.
+
+    """
+    pix = np.asarray(pix, dtype=np.int64)
+    n_pix = 12 * nside**2
+    n_cap = 2 * nside * (nside - 1)
+    z = np.empty(pix.shape)
+    phi = np.empty(pix.shape)
+
+    # North polar cap.
+    s = pix < n_cap
+    p = pix[s]
+    iring = (1 + np.sqrt(1 + 2 * p).astype(np.int64)) // 2
+    iphi = p + 1 - 2 * iring * (iring - 1)
+    z[s] = 1 - iring**2 / (3. * nside**2)
+    phi[s] = (iphi - 0.5) * np.pi / (2 * iring)
+
+    # Equatorial belt.
+    s = (pix >= n_cap) & (pix < n_pix - n_cap)
+    p = pix[s] - n_cap
+    iring = p // (4 * nside) + nside
+    iphi = p % (4 * nside) + 1
+    fodd = np.where((iring + nside) % 2 == 1, 1., 0.5)
+    z[s] = (2 * nside - iring) * 2. / (3 * nside)
+    phi[s] = (iphi - fodd) * np.pi / (2 * nside)
+
+    # South polar cap.
+    s = pix >= n_pix - n_cap
+    p = n_pix - pix[s]
+    iring = (1 + np.sqrt(2 * p - 1).astype(np.int64)) // 2
+    iphi = 4 * iring + 1 - (p - 2 * iring * (iring - 1))
+    z[s] = iring**2 / (3. * nside**2) - 1
+    phi[s] = (iphi - 0.5) * np.pi / (2 * iring)
+
+    return phi, np.arcsin(z)
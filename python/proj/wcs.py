@@ -1,9 +1,13 @@
+import copy
+
 import so3g
 from . import quat
+from . import util
 
 import numpy as np
 
 from .ranges import Ranges, RangesMatrix
+from .tiles import TiledMap
 
 class Projectionist:
     """This class assists with analyzing WCS information to populate data
@@ -17,6 +21,30 @@ class Projectionist:
     the combination of an astropy.WCS and object and a 2-d array
     shape.
 
+    The fast_math attribute (default False) selects an approximate
+    (but faster) evaluation of the trigonometric functions in the
+    cylindrical projections (CAR and CEA); the error in the computed
+    sky coordinates is below 0.01 arcsec.  It is passed to the
+    projection engines by get_ProjEng.
+
+    If the profile attribute is set to True, the projection engines
+    record timing and sample counters for each call to to_map,
+    to_weights and from_map.  The counters of the most recent call
+    are then returned by get_last_stats.
+
+    The to_map, to_weights and from_map methods accept a
+    per-detector polarization calibration: pol_eff, the polarization
+    efficiency (default 1), and pol_angle, an offset (in radians) added
+    to the polarization angle of each detector (default 0).  Each may
+    be a scalar or an array of shape (n_det,).  These are applied in
+    the projection engines, so that the detector offsets and signal
+    need not be rebuilt or rescaled to try different calibrations.
+
+    The engines process the samples a block of time at a time, for
+    all detectors, so that the boresight pointing of the block stays
+    in cache.  The time_block attribute, if not None, sets the number
+    of samples per block (0 selects the engine default, 4096).
+
     """
     @staticmethod
     def get_q(wcs):
@@ -43,10 +71,14 @@ class Projectionist:
         return Q
 
     def __init__(self):
-        self._q0 = None
+        self._q_cache = None
         self.naxis = np.array([0, 0])
         self.cdelt = np.array([0., 0.])
         self.crpix = np.array([0., 0.])
+        self.fast_math = False
+        self.profile = False
+        self.time_block = None
+        self._last_projeng = None
 
     @classmethod
     def for_geom(cls, shape, wcs):
@@ -95,22 +127,34 @@ class Projectionist:
             * quat.euler(2, -alpha0 * quat.DEG))
         return self
 
-    def get_pixelizor(self):
+    def get_pixelizor(self, tile_bounds=None):
 
         """Returns the so3g.Pixelizor appropriate for use with the configured
         geometry.
 
+        If tile_bounds=(y0, y1, x0, x1) is passed, the pixelizor will
+        cover only that sub-region of the map (with pixel (y0, x0) at
+        index 0).
+
         """
+        ny, nx = self.naxis[1], self.naxis[0]
+        iy0, ix0 = self.crpix[1], self.crpix[0]
+        if tile_bounds is not None:
+            y0, y1, x0, x1 = tile_bounds
+            ny, nx = y1 - y0, x1 - x0
+            iy0, ix0 = iy0 - y0, ix0 - x0
         # All these casts are required because boost-python doesn't
         # like numpy scalars.
-        return so3g.Pixelizor2_Flat(int(self.naxis[1]), int(self.naxis[0]),
+        return so3g.Pixelizor2_Flat(int(ny), int(nx),
                                     float(self.cdelt[1]), float(self.cdelt[0]),
-                                    float(self.crpix[1]), float(self.crpix[0]))
+                                    float(iy0), float(ix0))
 
     def get_ProjEng(self, comps='TQU', proj_name=None, get=True,
-                    instance=True):
+                    instance=True, tile_bounds=None, fast_math=None):
         """Returns an so3g.ProjEng object appropriate for use with the
-        configured geometry.
+        configured geometry.  The tile_bounds argument is passed
+        through to get_pixelizor.  If fast_math is None, it is taken
+        from self.fast_math.
 
         """
         if proj_name is None:
@@ -126,13 +170,51 @@ class Projectionist:
                              '"{comps}" (tried "{projeng_name}").')
         if not instance:
             return projeng_cls
-        return projeng_cls(self.get_pixelizor())
+        if fast_math is None:
+            fast_math = self.fast_math
+        projeng = projeng_cls(self.get_pixelizor(tile_bounds), bool(fast_math))
+        if self.time_block is not None:
+            projeng.time_block = int(self.time_block)
+        if self.profile:
+            projeng.set_profile(True)
+        return projeng
+
+    def _use_projeng(self, projeng):
+        """Marks projeng as the engine whose stats get_last_stats
+        should return."""
+        if self.profile:
+            self._last_projeng = projeng
+
+    def get_last_stats(self):
+        """Returns the profiling counters of the most recent to_map,
+        to_weights or from_map call, if the profile attribute was set
+        when it was made (otherwise None).  The dict contains:
+
+        - 'method': the engine method called.
+        - 't_inputs': time spent checking inputs, in seconds.
+        - 't_loop': wall time of the main loop, in seconds.
+        - 'n_threads': number of threads in the loop.
+        - 'thread_time', 'thread_samples': time spent working, and
+          samples processed, by each thread.
+        - 'n_samples', 'n_offmap': total samples processed, and the
+          number of those that fell outside the map.
+        - 'efficiency': sum(thread_time) / (n_threads * t_loop); low
+          values indicate load imbalance.
+
+        """
+        if self._last_projeng is None:
+            return None
+        return self._last_projeng.get_stats()
 
     def _get_cached_q(self, new_q0):
-        if new_q0 is not self._q0:
-            self._q0 = new_q0
-            self._qv = self.q_celestial_to_native * self._q0
-        return self._qv
+        # The cache is replaced in a single assignment, so that
+        # concurrent calls (e.g. through the *_async methods) never
+        # see a mismatched pair.
+        cache = self._q_cache
+        if cache is None or new_q0 is not cache[0]:
+            cache = (new_q0, self.q_celestial_to_native * new_q0)
+            self._q_cache = cache
+        return cache[1]
 
     def _guess_comps(self, map_shape):
         if len(map_shape) != 3:
@@ -199,32 +281,134 @@ class Projectionist:
         projeng = self.get_ProjEng('TQU')
         return projeng.coords(q1, assembly.dets, None)
 
-    def get_prec_omp(self, assembly):
+    def get_prec_omp(self, assembly, n_domain=None, tile_shape=None):
         """Perform a quick analysis of the pointing in order to enable OMP in
         tod-to-map operations.  Returns a special object that can be
         passed as the omp= argument of to_map and to_weight_map.
         (Other operations can use OMP without this precomputed object,
         because there are no thread-safety issues.)
 
+        The map is split into n_domain slices, which are handed out
+        to the threads dynamically.  The default is one domain per
+        thread; a few times more than that will help balance the load
+        when the scan covers the map unevenly.
+
+        If tile_shape=(tile_ny, tile_nx) is given, there is instead
+        one domain per map tile touched by the pointing (see
+        get_tile_ranges), in tile order.  Each thread then works on
+        one region of the map at a time, which can make better use of
+        the cache when the map is much larger than it.  Such domains
+        can also be passed to from_map.  Whether this pays off
+        depends on the scan, the tile size and the machine, so
+        compare with the default before relying on it.
+
         See class documentation for description of standard arguments.
 
         """
+        if tile_shape is not None:
+            tile_ranges = self.get_tile_ranges(assembly, tile_shape)
+            return RangesMatrix([tile_ranges[k]
+                                 for k in sorted(tile_ranges.keys())])
         projeng = self.get_ProjEng('T')
         q1 = self._get_cached_q(assembly.Q)
-        omp_ivals = projeng.pixel_ranges(q1, assembly.dets)
+        if n_domain is None:
+            n_domain = 0
+        omp_ivals = projeng.pixel_ranges(q1, assembly.dets, int(n_domain))
         return RangesMatrix([RangesMatrix(x) for x in omp_ivals])
 
-    def to_map(self, signal, assembly, dest_map=None, omp=None, comps=None):
+    def plan(self, assembly, comps='TQU', threads=None, n_domain=None,
+             tile_shape=None):
+        """Returns a ProjectionPlan, for repeated to_map, to_weights and
+        from_map operations on the pointing in assembly.  The
+        projection engine and the rotated boresight are set up once,
+        and the OMP information is computed, when first needed, by
+        the plan itself.
+
+        Arguments:
+          comps: The projection component string, e.g. 'T', 'QU',
+            'TQU'.
+          threads: The number of threads for the plan's operations.
+            If None, the current so3g default is used at each call.
+            When this is 1, the single-thread to_map and to_weights
+            are used, and no OMP information is computed.
+          n_domain: Passed to get_prec_omp.
+          tile_shape: Passed to get_prec_omp.  If given, from_map also
+            uses the OMP information, to visit the samples tile by
+            tile.
+
+        See class documentation for description of standard arguments.
+
+        """
+        return ProjectionPlan(self, assembly, comps, threads=threads,
+                              n_domain=n_domain, tile_shape=tile_shape)
+
+    def get_tile_ranges(self, assembly, tile_shape):
+        """Bucket the samples by map tile, where tile_shape=(tile_ny,
+        tile_nx).  Tiles are numbered in C order, as in TiledMap.
+        Returns a dict mapping each tile index that is touched by the
+        pointing to a RangesMatrix of shape (n_det, n_time), giving
+        the samples that land in that tile.
+
+        See class documentation for description of standard arguments.
+
+        """
+        projeng = self.get_ProjEng('T')
+        q1 = self._get_cached_q(assembly.Q)
+        tile_shape = tuple(int(x) for x in tile_shape)
+        return {tile: RangesMatrix(ivals) for tile, ivals in
+                projeng.tile_ranges(q1, assembly.dets, tile_shape).items()}
+
+    def get_mask_ranges(self, mask, assembly):
+        """Find the samples that land on the pixels set in mask, an
+        array with the map shape (n_y, n_x).  A bool or uint8 mask is
+        used directly; any other type is tested for non-zero values.
+        Returns a RangesMatrix of shape (n_det, n_time).
+
+        See class documentation for description of standard arguments.
+
+        """
+        mask = np.asarray(mask)
+        if mask.dtype.itemsize != 1:
+            mask = (mask != 0)
+        projeng = self.get_ProjEng('T')
+        q1 = self._get_cached_q(assembly.Q)
+        return RangesMatrix(projeng.mask_ranges(mask, q1, assembly.dets))
+
+    def _to_tiled_map(self, dest_map, assembly, comps, method, *args):
+        """Helper for to_map, to_weights and to_hits when dest_map is a
+        TiledMap.  The samples are bucketed by tile, and each tile is
+        then visited once using a projector for just that tile.
+
+        """
+        if dest_map.shape[-2:] != (self.naxis[1], self.naxis[0]):
+            raise ValueError('TiledMap shape %s does not match geometry.'
+                             % (dest_map.shape,))
+        q1 = self._get_cached_q(assembly.Q)
+        tile_ranges = self.get_tile_ranges(assembly, dest_map.tile_shape)
+        for tile, ivals in sorted(tile_ranges.items()):
+            projeng = self.get_ProjEng(
+                comps, tile_bounds=dest_map.tile_bounds(tile))
+            self._use_projeng(projeng)
+            getattr(projeng, method)(dest_map.get_tile(tile), q1,
+                                     assembly.dets, *args, [ivals])
+        return dest_map
+
+    def to_map(self, signal, assembly, dest_map=None, omp=None, comps=None,
+               pol_eff=None, pol_angle=None):
         """Project signal into a map.
 
         Arguments:
           signal (Signal-like): The signal to project.
           dest_map (Map-like): The map into which to accumulate the
-            projected signal.  If None, a map will be initialized internally.
+            projected signal.  If None, a map will be initialized
+            internally.  This may also be a TiledMap, in which case
+            omp is ignored.
           comps: The projection component string, e.g. 'T', 'QU',
             'TQU'.
           omp (ProjectionOmpData): The OMP information (returned by
             get_prec_omp), if OMP acceleration is to be used.
+          pol_eff, pol_angle: The polarization calibration (see class
+            documentation).
 
         See class documentation for description of standard arguments.
 
@@ -234,27 +418,125 @@ class Projectionist:
                              "interest (e.g. comps='TQU').")
         if comps is None:
             comps = self._guess_comps(dest_map.shape)
+        pol_cal = _get_pol_cal(assembly, pol_eff, pol_angle)
+        if isinstance(dest_map, TiledMap):
+            return self._to_tiled_map(dest_map, assembly, comps,
+                                      'to_map_omp', signal, pol_cal)
         projeng = self.get_ProjEng(comps)
+        self._use_projeng(projeng)
         q1 = self._get_cached_q(assembly.Q)
         if omp is None:
             map_out = projeng.to_map(
-                dest_map, q1, assembly.dets, signal, None)
+                dest_map, q1, assembly.dets, signal, pol_cal)
         else:
             map_out = projeng.to_map_omp(
-                dest_map, q1, assembly.dets, signal, None, omp)
+                dest_map, q1, assembly.dets, signal, pol_cal, omp)
         return map_out
 
-    def to_weights(self, assembly, dest_map=None, omp=None, comps=None):
+    @staticmethod
+    def get_pair_assembly(assembly, pairs, pointing='mean'):
+        """Returns an Assembly with one detector per pair, for use with
+        to_map_pairs (and, e.g., get_prec_omp and to_weights).
+
+        Arguments:
+          assembly: The Assembly of the individual detectors.
+          pairs: Array of shape (n_pair, 2), giving the index (into
+            assembly.dets) of the A and B detector of each pair.
+          pointing: 'mean' to place each pair at the mean (xi, eta) of
+            its two detectors, with the polarization angle of the A
+            detector; or 'first' to simply use the A detector's
+            offset.
+
+        """
+        pairs = np.asarray(pairs, dtype='int32')
+        dets = np.asarray(assembly.dets)
+        if pointing == 'first':
+            pair_dets = dets[pairs[:, 0]]
+        elif pointing == 'mean':
+            xi, eta, gamma = quat.decompose_xieta(dets)
+            pair_dets = np.array(quat.rotation_xieta(
+                xi[pairs].mean(axis=1), eta[pairs].mean(axis=1),
+                gamma[pairs[:, 0]]))
+        else:
+            raise ValueError("pointing must be 'mean' or 'first'.")
+        output = assembly.__class__()
+        output.Q = assembly.Q
+        output.dets = pair_dets.reshape(-1, 4)
+        return output
+
+    def to_map_pairs(self, signal, assembly, pairs, dest_map=None, omp=None,
+                     comps=None, pointing='mean'):
+        """Project detector pairs into a map.  The intensity component is
+        accumulated from the pair half-sums, (A+B)/2, and the
+        polarization components from the half-differences, (A-B)/2.
+        These are formed on the fly, so no pair-summed or
+        pair-differenced timestreams need to be stored.
+
+        Arguments:
+          signal (Signal-like): The signal of the individual
+            detectors, of shape (n_det, n_time).
+          pairs: Array of shape (n_pair, 2), giving the indices of the
+            A and B detector of each pair.
+          dest_map (Map-like): The map into which to accumulate the
+            projected signal.  If None, a map will be initialized
+            internally.
+          comps: The projection component string, e.g. 'T', 'QU',
+            'TQU'.
+          omp (ProjectionOmpData): The OMP information, if OMP
+            acceleration is to be used.  This must be computed from
+            get_pair_assembly(assembly, pairs, pointing) or, if
+            pointing='individual', from assembly itself.
+          pointing: 'mean' or 'first', to project each pair with a
+            single pointing (see get_pair_assembly); or 'individual',
+            to project each detector of the pair, in full, with its
+            own pointing and polarization angle (as to_map would).
+            The map should then be normalized by the weights of
+            assembly itself.
+
+        The polarization calibration (pol_eff, pol_angle) is not
+        applied to pair maps; calibrate the signal before differencing
+        if needed.
+
+        See class documentation for description of standard arguments.
+
+        """
+        if dest_map is None and comps is None:
+            raise ValueError("Provide an output map or specify component of "
+                             "interest (e.g. comps='TQU').")
+        if comps is None:
+            comps = self._guess_comps(dest_map.shape)
+        pairs = np.asarray(pairs, dtype='int32')
+        pair_pointing = (pointing != 'individual')
+        if pair_pointing:
+            assembly = self.get_pair_assembly(assembly, pairs, pointing)
+        projeng = self.get_ProjEng(comps)
+        self._use_projeng(projeng)
+        q1 = self._get_cached_q(assembly.Q)
+        if omp is None:
+            map_out = projeng.to_map_pairs(
+                dest_map, q1, assembly.dets, signal, None, pairs,
+                pair_pointing)
+        else:
+            map_out = projeng.to_map_pairs_omp(
+                dest_map, q1, assembly.dets, signal, None, pairs, omp,
+                pair_pointing)
+        return map_out
+
+    def to_weights(self, assembly, dest_map=None, omp=None, comps=None,
+                   pol_eff=None, pol_angle=None):
         """Project pointing into a weights map.
 
         Arguments:
           dest_map (Map-like): The weights map into which to
             accumulate the projected signal.  If None, a map will be
-            initialized internally.
+            initialized internally.  This may also be a TiledMap, in
+            which case omp is ignored.
           comps: The projection component string, e.g. 'T', 'QU',
             'TQU'.
           omp (ProjectionOmpData): The OMP information (returned by
             get_prec_omp), if OMP acceleration is to be used.
+          pol_eff, pol_angle: The polarization calibration (see class
+            documentation).
 
         See class documentation for description of standard arguments.
 
@@ -265,28 +547,88 @@ class Projectionist:
         if comps is None:
             assert(dest_map.shape[0] == dest_map.shape[1])
             comps = self._guess_comps(dest_map.shape[1:])
+        pol_cal = _get_pol_cal(assembly, pol_eff, pol_angle)
+        if isinstance(dest_map, TiledMap):
+            return self._to_tiled_map(dest_map, assembly, comps,
+                                      'to_weight_map_omp', None, pol_cal)
         projeng = self.get_ProjEng(comps)
+        self._use_projeng(projeng)
         q1 = self._get_cached_q(assembly.Q)
         if omp is None:
             map_out = projeng.to_weight_map(
-                dest_map, q1, assembly.dets, None, None)
+                dest_map, q1, assembly.dets, None, pol_cal)
         else:
             map_out = projeng.to_weight_map_omp(
-                dest_map, q1, assembly.dets, None, None, omp)
+                dest_map, q1, assembly.dets, None, pol_cal, omp)
+        return map_out
+
+    def to_hits(self, assembly, dest_map=None, omp=None, det_groups=None,
+                dtype='int32'):
+        """Project pointing into an integer hits map.
+
+        Arguments:
+          dest_map (Map-like): The int32 or uint16 map into which to
+            accumulate the hit counts.  If None, a map will be
+            initialized internally.  This may also be a TiledMap, in
+            which case omp is ignored.
+          omp (ProjectionOmpData): The OMP information (returned by
+            get_prec_omp), if OMP acceleration is to be used.
+          det_groups: If not None, a vector of integer group indices,
+            one per detector, used to produce separate hits maps for
+            each group in a single pass.  The output map then has
+            shape (n_group, ...).  Detectors with negative group index
+            are excluded.
+          dtype: The data type ('int32' or 'uint16') of the map to
+            create, if dest_map is None.  Note that uint16 counts will
+            wrap, silently, on overflow.
+
+        See class documentation for description of standard arguments.
+
+        """
+        if det_groups is not None:
+            det_groups = np.asarray(det_groups, dtype='int32')
+        if dest_map is None:
+            shape = (int(self.naxis[1]), int(self.naxis[0]))
+            if det_groups is not None:
+                n_group = det_groups.max() + 1 if det_groups.size else 0
+                shape = (max(n_group, 0),) + shape
+            dest_map = np.zeros(shape, dtype)
+        if isinstance(dest_map, TiledMap):
+            return self._to_tiled_map(dest_map, assembly, 'T',
+                                      'to_hits_omp', det_groups)
+        projeng = self.get_ProjEng('T')
+        self._use_projeng(projeng)
+        q1 = self._get_cached_q(assembly.Q)
+        if omp is None:
+            map_out = projeng.to_hits(
+                dest_map, q1, assembly.dets, det_groups)
+        else:
+            map_out = projeng.to_hits_omp(
+                dest_map, q1, assembly.dets, det_groups, omp)
         return map_out
 
-    def from_map(self, src_map, assembly, signal=None, comps=None):
+    def from_map(self, src_map, assembly, signal=None, comps=None,
+                 scale=1., omp=None, pol_eff=None, pol_angle=None):
         """De-project from a map, returning a Signal-like object.
 
         Arguments:
           src_map (Map-like): The map from which to sample.
           signal (Signal-like): The object into which to accumulate
             the signal.  If not provided, a suitable object will be
-            created and initialized to zero.
+            created and initialized to zero.  If provided (e.g. an
+            existing float32 TOD array of shape (n_det, n_time)), it
+            is updated in place.
           comps: The projection component string, e.g. 'T', 'QU',
             'TQU'.
-          omp: The OMP information (returned by get_prec_omp), if OMP
-            acceleration is to be used.
+          scale: Factor by which to multiply the map-domain signal
+            before adding it into signal.  Pass scale=-1 to subtract
+            a model map from the TOD, for example.
+          omp: The OMP information (returned by get_prec_omp).  This
+            is not needed for thread safety; but if it was computed
+            with tile_shape, the samples are visited tile by tile
+            (see get_prec_omp).
+          pol_eff, pol_angle: The polarization calibration (see class
+            documentation).
 
         See class documentation for description of standard arguments.
 
@@ -296,8 +638,454 @@ class Projectionist:
             src_map = src_map[None]
         if comps is None:
             comps = self._guess_comps(src_map.shape)
+        pol_cal = _get_pol_cal(assembly, pol_eff, pol_angle)
         projeng = self.get_ProjEng(comps)
+        self._use_projeng(projeng)
         q1 = self._get_cached_q(assembly.Q)
-        signal_out = projeng.from_map(
-            src_map, q1, assembly.dets, signal, None)
+        if omp is None:
+            signal_out = projeng.from_map(
+                src_map, q1, assembly.dets, signal, pol_cal, scale)
+        else:
+            signal_out = projeng.from_map_omp(
+                src_map, q1, assembly.dets, signal, pol_cal, omp, scale)
         return signal_out
+
+    @staticmethod
+    def get_source_rotations(ra, dec, psi=None):
+        """Returns an array of shape (n_source, 4) holding, for each
+        source, the rotation from celestial coordinates to native
+        coordinates with the source at the pole (as in
+        for_source_at).  If psi is given, each source's native
+        coordinates are also rotated by psi about the pole, so that a
+        feature at position angle psi (measured from North through
+        East) lies on the same side of every cutout.  All angles are
+        in radians.
+
+        """
+        ra, dec = np.atleast_1d(ra), np.atleast_1d(dec)
+        q = (quat.euler(2, np.pi)
+             * quat.euler(1, dec - np.pi / 2)
+             * quat.euler(2, -ra))
+        if psi is not None:
+            q = quat.euler(2, np.broadcast_to(psi, ra.shape)) * q
+        return np.asarray(q, dtype='float64').reshape(-1, 4)
+
+    def _get_stack_projeng(self, sources, comps):
+        # Source positions come as a tuple; an array must hold the
+        # rotations themselves.
+        if not isinstance(sources, np.ndarray):
+            sources = self.get_source_rotations(*sources)
+        elif (sources.ndim != 2 or sources.shape[-1] != 4 or
+              sources.dtype != np.float64):
+            raise ValueError('sources array must be the float64 (n_source, 4) '
+                             'rotations from get_source_rotations; pass '
+                             'source positions as a tuple (ra, dec[, psi]).')
+        projeng_name = f'StackProjEng_{self.proj_name}_{comps}'
+        try:
+            projeng_cls = getattr(so3g, projeng_name)
+        except AttributeError:
+            raise ValueError(f'There is no stacking projector for '
+                             f'pixelization "{self.proj_name}", components '
+                             f'"{comps}" (tried "{projeng_name}").')
+        return projeng_cls(self.get_pixelizor(), sources,
+                           bool(self.fast_math))
+
+    def to_stacked_map(self, signal, assembly, sources, dest_map=None,
+                       comps=None, per_source=False):
+        """Project signal into cutouts centered on each of a list of
+        sources, in a single pass through the pointing.  The
+        projectionist describes the cutout geometry, which must use a
+        zenithal projection (ARC, TAN or ZEA) centered on the pole of
+        its native coordinates (e.g. from for_geom, with a WCS whose
+        reference point is the cutout center); its own rotation to
+        native coordinates is not used.
+
+        Arguments:
+          signal (Signal-like): The signal to project.
+          sources: Either a tuple (ra, dec) or (ra, dec, psi), of
+            source positions and orientations (see
+            get_source_rotations), or the float64 (n_source, 4) array
+            returned by that function.  Any other array is rejected.
+          dest_map (Map-like): The map into which to accumulate the
+            projected signal; shape (n_comp, n_y, n_x) to stack the
+            cutouts, or (n_source, n_comp, n_y, n_x) to keep them
+            separate.  If None, a map will be initialized internally.
+          comps: The projection component string, e.g. 'T', 'QU',
+            'TQU'.
+          per_source: If dest_map is None, whether to create separate
+            cutouts rather than a stacked one.
+
+        The OpenMP threads work on separate detectors.  See class
+        documentation for description of standard arguments.
+
+        """
+        if dest_map is None and comps is None:
+            raise ValueError("Provide an output map or specify component of "
+                             "interest (e.g. comps='TQU').")
+        if comps is None:
+            comps = self._guess_comps(dest_map.shape[-3:])
+        projeng = self._get_stack_projeng(sources, comps)
+        if dest_map is None and per_source:
+            dest_map = np.zeros((projeng.n_source, len(comps),
+                                 int(self.naxis[1]), int(self.naxis[0])))
+        return projeng.to_map(dest_map, assembly.Q, assembly.dets,
+                              signal, None)
+
+    def to_stacked_weights(self, assembly, sources, dest_map=None,
+                           comps=None, per_source=False):
+        """Project pointing into source-centered weights maps; see
+        to_stacked_map.  The dest_map has shape (n_comp, n_comp, n_y,
+        n_x), or (n_source, n_comp, n_comp, n_y, n_x) for separate
+        cutouts.
+
+        """
+        if dest_map is None and comps is None:
+            raise ValueError("Provide an output map or specify component of "
+                             "interest (e.g. comps='TQU').")
+        if comps is None:
+            comps = self._guess_comps(dest_map.shape[-3:])
+        projeng = self._get_stack_projeng(sources, comps)
+        if dest_map is None and per_source:
+            n = len(comps)
+            dest_map = np.zeros((projeng.n_source, n, n,
+                                 int(self.naxis[1]), int(self.naxis[0])))
+        return projeng.to_weight_map(dest_map, assembly.Q, assembly.dets,
+                                     None, None)
+
+    def downgraded(self, factor):
+        """Returns a Projectionist for the geometry of maps produced by
+        downgrade_map(..., factor): cdelt is multiplied by factor,
+        naxis is divided by it (rounding up), and crpix is moved so
+        that each new pixel is centered on the block it combines.
+
+        """
+        factor = int(factor)
+        p = copy.copy(self)
+        p._q_cache = None
+        p._last_projeng = None
+        p.naxis = (np.asarray(self.naxis) + factor - 1) // factor
+        p.cdelt = np.asarray(self.cdelt) * factor
+        p.crpix = (np.asarray(self.crpix) - (factor - 1) / 2) / factor
+        return p
+
+    def upgraded(self, factor):
+        """Returns a Projectionist for the geometry of maps produced by
+        upgrade_map(..., factor); this is the inverse of downgraded.
+
+        """
+        factor = int(factor)
+        p = copy.copy(self)
+        p._q_cache = None
+        p._last_projeng = None
+        p.naxis = np.asarray(self.naxis) * factor
+        p.cdelt = np.asarray(self.cdelt) / factor
+        p.crpix = (np.asarray(self.crpix) + 0.5) * factor - 0.5
+        return p
+
+    def downgrade_map(self, src_map, factor, weights=None, output=None):
+        """Combine the pixels of src_map, which has this geometry, in
+        blocks of factor x factor.  If weights (an array of shape
+        (n_y, n_x)) is None, each block is summed, as is appropriate
+        for binned signal, weights and hits maps (an int32 hits map
+        gives an int32 result); otherwise the weighted mean of each
+        block is returned.  The result has the geometry of
+        self.downgraded(factor).  See Pixelizor2_Flat.downgrade.
+
+        """
+        return self.get_pixelizor().downgrade(
+            src_map, int(factor), weights, output)
+
+    def upgrade_map(self, src_map, factor, order=0, output=None):
+        """Split each pixel of src_map, which has this geometry, into
+        factor x factor pixels, by repetition (order=0) or bilinear
+        interpolation (order=1).  The result has the geometry of
+        self.upgraded(factor).  See Pixelizor2_Flat.upgrade.
+
+        """
+        return self.get_pixelizor().upgrade(
+            src_map, int(factor), int(order), output)
+
+    def resample_map(self, src, src_map, order=1, output=None):
+        """Resample src_map, which has the geometry of the
+        Projectionist src, onto this geometry, by nearest pixel
+        (order=0) or bilinear interpolation (order=1).  The two
+        geometries must have the same projection and reference point
+        (e.g. CAR maps of different resolution or extent); pixels that
+        fall outside src_map are set to 0.  See
+        Pixelizor2_Flat.resample.
+
+        """
+        q0, q1 = src.q_celestial_to_native, self.q_celestial_to_native
+        q0, q1 = [np.array([q.a, q.b, q.c, q.d]) for q in [q0, q1]]
+        if (src.proj_name != self.proj_name or
+                not np.allclose(abs(np.dot(q0, q1)), 1.)):
+            raise ValueError('resample_map requires geometries with the same '
+                             'projection and reference point.')
+        return self.get_pixelizor().resample(
+            src.get_pixelizor(), src_map, int(order), output)
+
+    def to_healpix(self, src_map, nside, comps=None, output=None,
+                   chunk_size=2**20):
+        """Sample src_map, which has this geometry, at the centers of
+        the pixels of a HEALPix map (RING ordering) with resolution
+        parameter nside.  Each HEALPix pixel takes the value of the
+        map pixel containing its center; pixels off the map are 0.
+
+        The Q and U components are rotated to the celestial frame, in
+        the polarization convention of the projection engines.  The
+        result is a float32 array of shape (n_comp, 12*nside**2); if
+        output is passed it is overwritten instead.  The pixels are
+        processed chunk_size at a time, to bound the memory used for
+        their pointing.
+
+        """
+        if src_map.ndim == 2:
+            src_map = src_map[None]
+        if comps is None:
+            comps = self._guess_comps(src_map.shape)
+        n_pix = 12 * nside**2
+        if output is None:
+            output = np.zeros((len(comps), n_pix), 'float32')
+        else:
+            output[:] = 0.
+        # Each pixel center is a "sample" seen by one detector per
+        # component, pointed north; the QU detectors are turned by 0
+        # and 45 degrees through the polarization calibration.
+        parts = []
+        if 'T' in comps:
+            parts.append(('T', None))
+        if 'QU' in comps:
+            parts.append(('QU', np.array([[1., 0.], [1., np.pi / 4]])))
+        for part_comps, pol_cal in parts:
+            i0, i1 = comps.index(part_comps[0]), comps.index(part_comps[-1]) + 1
+            projeng = self.get_ProjEng(part_comps)
+            dets = np.array([[1., 0., 0., 0.]] * (i1 - i0))
+            for p0 in range(0, n_pix, chunk_size):
+                p1 = min(p0 + chunk_size, n_pix)
+                lon, lat = util.healpix_pix2ang(nside, np.arange(p0, p1))
+                q1 = self.q_celestial_to_native * quat.rotation_lonlat(lon, lat)
+                projeng.from_map(src_map[i0:i1], q1, dets,
+                                 output[i0:i1, p0:p1], pol_cal)
+        return output
+
+    def to_map_async(self, *args, **kwargs):
+        """Like to_map, but runs in the so3g worker pool (see
+        so3g.threads.submit) and returns a concurrent.futures.Future
+        for the map.  Note the destination map must not be used by
+        other calls until the future is done.
+
+        """
+        return so3g.threads.submit(self.to_map, *args, **kwargs)
+
+    def to_weights_async(self, *args, **kwargs):
+        """Like to_weights, but runs in the so3g worker pool and returns
+        a concurrent.futures.Future for the weights map.
+
+        """
+        return so3g.threads.submit(self.to_weights, *args, **kwargs)
+
+    def from_map_async(self, *args, **kwargs):
+        """Like from_map, but runs in the so3g worker pool and returns a
+        concurrent.futures.Future for the signal.
+
+        """
+        return so3g.threads.submit(self.from_map, *args, **kwargs)
+
+
+class ProjectionPlan:
+    """The projection of one Assembly into one Projectionist's
+    geometry, set up for repeated use (e.g. in iterative map-makers).
+    Get these from Projectionist.plan.
+
+    The plan holds the projection engine and the boresight rotated to
+    native coordinates, and chooses between the single-thread and OMP
+    projection routines according to the number of threads.  The OMP
+    information is computed on the first call that needs it, and then
+    kept (see the omp attribute).
+
+    The plan takes the projectionist's fast_math and profile settings
+    when it is created; the assembly must not be modified while the
+    plan is in use.
+
+    """
+    def __init__(self, projectionist, assembly, comps='TQU', threads=None,
+                 n_domain=None, tile_shape=None):
+        self.projectionist = projectionist
+        self.assembly = assembly
+        self.comps = comps
+        self.threads = threads
+        self.n_domain = n_domain
+        self.tile_shape = tile_shape
+        self.projeng = projectionist.get_ProjEng(comps)
+        self.q1 = projectionist.q_celestial_to_native * assembly.Q
+        self._omp = None
+
+    @property
+    def omp(self):
+        """The OMP information (as returned by get_prec_omp)."""
+        if self._omp is None and self.tile_shape is not None:
+            tile_shape = tuple(int(x) for x in self.tile_shape)
+            tile_ranges = self.projeng.tile_ranges(
+                self.q1, self.assembly.dets, tile_shape)
+            self._omp = RangesMatrix([RangesMatrix(tile_ranges[k])
+                                      for k in sorted(tile_ranges.keys())])
+        elif self._omp is None:
+            n_domain = 0 if self.n_domain is None else self.n_domain
+            omp_ivals = self.projeng.pixel_ranges(
+                self.q1, self.assembly.dets, int(n_domain))
+            self._omp = RangesMatrix([RangesMatrix(x) for x in omp_ivals])
+        return self._omp
+
+    def _limit(self):
+        self.projectionist._use_projeng(self.projeng)
+        return so3g.threads.limit(self.threads)
+
+    def _use_omp(self):
+        if self.threads is None:
+            return so3g.get_num_threads() > 1
+        return self.threads > 1
+
+    def to_map(self, signal, dest_map=None, pol_eff=None, pol_angle=None):
+        """Project signal into a map; see Projectionist.to_map."""
+        if isinstance(dest_map, TiledMap):
+            return self.projectionist.to_map(
+                signal, self.assembly, dest_map, comps=self.comps,
+                pol_eff=pol_eff, pol_angle=pol_angle)
+        pol_cal = _get_pol_cal(self.assembly, pol_eff, pol_angle)
+        with self._limit():
+            if self._use_omp():
+                return self.projeng.to_map_omp(
+                    dest_map, self.q1, self.assembly.dets, signal, pol_cal,
+                    self.omp)
+            return self.projeng.to_map(
+                dest_map, self.q1, self.assembly.dets, signal, pol_cal)
+
+    def to_weights(self, dest_map=None, pol_eff=None, pol_angle=None):
+        """Project pointing into a weights map; see
+        Projectionist.to_weights.
+
+        """
+        if isinstance(dest_map, TiledMap):
+            return self.projectionist.to_weights(
+                self.assembly, dest_map, comps=self.comps,
+                pol_eff=pol_eff, pol_angle=pol_angle)
+        pol_cal = _get_pol_cal(self.assembly, pol_eff, pol_angle)
+        with self._limit():
+            if self._use_omp():
+                return self.projeng.to_weight_map_omp(
+                    dest_map, self.q1, self.assembly.dets, None, pol_cal,
+                    self.omp)
+            return self.projeng.to_weight_map(
+                dest_map, self.q1, self.assembly.dets, None, pol_cal)
+
+    def from_map(self, src_map, signal=None, scale=1., pol_eff=None,
+                 pol_angle=None):
+        """De-project from a map; see Projectionist.from_map."""
+        if src_map.ndim == 2:
+            src_map = src_map[None]
+        pol_cal = _get_pol_cal(self.assembly, pol_eff, pol_angle)
+        with self._limit():
+            if self.tile_shape is not None:
+                return self.projeng.from_map_omp(
+                    src_map, self.q1, self.assembly.dets, signal, pol_cal,
+                    self.omp, scale)
+            return self.projeng.from_map(
+                src_map, self.q1, self.assembly.dets, signal, pol_cal, scale)
+
+
+def _conj(q):
+    return quat.quat(q.a, -q.b, -q.c, -q.d)
+
+
+def _get_pol_cal(assembly, pol_eff, pol_angle):
+    """Returns the (n_det, 2) array of (efficiency, angle offset) that
+    the projection engines take as their weights argument, or None if
+    pol_eff and pol_angle are both None.
+
+    """
+    if pol_eff is None and pol_angle is None:
+        return None
+    pol_cal = np.zeros((len(assembly.dets), 2))
+    pol_cal[:, 0] = 1. if pol_eff is None else pol_eff
+    pol_cal[:, 1] = 0. if pol_angle is None else pol_angle
+    return pol_cal
+
+
+def _get_multi_args(targets):
+    """Helper for multi_to_map and multi_to_weights.  Returns the
+    (proj_name, pixelizor) list for the engine, the shared boresight
+    and detector offsets, and the per-target rotations.
+
+    """
+    p0, asm0 = targets[0]
+    q1_0 = p0._get_cached_q(asm0.Q)
+    dets0 = np.asarray(asm0.dets)
+    eng_targets, rots = [], []
+    for p, asm in targets:
+        if (asm.dets is not asm0.dets and
+                not np.array_equal(np.asarray(asm.dets), dets0)):
+            raise ValueError('All targets must have the same detectors.')
+        eng_targets.append((p.proj_name, p.get_pixelizor()))
+        if p is p0 and asm.Q is asm0.Q:
+            rots.append(None)
+        elif asm.Q is asm0.Q:
+            # Same boresight, so the rotation is constant: from the
+            # native coordinates of the first target to this one's.
+            q = p.q_celestial_to_native * _conj(p0.q_celestial_to_native)
+            rots.append(np.array([q.a, q.b, q.c, q.d]))
+        else:
+            q1 = p._get_cached_q(asm.Q)
+            q1_0_inv = np.asarray(q1_0) * np.array([1., -1., -1., -1.])
+            rots.append(np.asarray(q1 * quat.G3VectorQuat(q1_0_inv)))
+    return eng_targets, q1_0, asm0.dets, rots
+
+
+def multi_to_map(targets, signal, dest_maps=None, comps=None):
+    """Project signal into several maps, in a single pass through the
+    pointing.  This is faster than calling to_map on each target,
+    because the detector quaternions are computed only once.
+
+    Arguments:
+      targets: List of (projectionist, assembly) pairs.  The
+        assemblies must all have the same detectors (in the same
+        order); they may share a boresight (e.g. for a celestial map
+        and a source-centered map) or not (e.g. for a celestial map
+        and a horizon-frame map).  The projections must be spherical
+        (not Flat).
+      signal (Signal-like): The signal to project.
+      dest_maps: List of maps (or None) into which to accumulate the
+        projected signal, one per target.  If None, maps are
+        initialized internally.
+      comps: The projection component string, e.g. 'T', 'QU',
+        'TQU'.
+
+    The fast_math setting of the first Projectionist is used for all
+    targets.  Returns the list of maps.
+
+    """
+    if comps is None:
+        if dest_maps is None or dest_maps[0] is None:
+            raise ValueError("Provide output maps or specify component of "
+                             "interest (e.g. comps='TQU').")
+        comps = targets[0][0]._guess_comps(dest_maps[0].shape)
+    eng_targets, q1, dets, rots = _get_multi_args(targets)
+    projeng = getattr(so3g, f'MultiProjEng_{comps}')(
+        eng_targets, bool(targets[0][0].fast_math))
+    return projeng.to_map(dest_maps, q1, dets, rots, signal, None)
+
+
+def multi_to_weights(targets, dest_maps=None, comps=None):
+    """Project pointing into several weights maps, in a single pass
+    through the pointing.  See multi_to_map for the description of
+    the arguments.
+
+    """
+    if comps is None:
+        if dest_maps is None or dest_maps[0] is None:
+            raise ValueError("Provide output maps or specify component of "
+                             "interest (e.g. comps='TQU').")
+        comps = targets[0][0]._guess_comps(dest_maps[0].shape[1:])
+    eng_targets, q1, dets, rots = _get_multi_args(targets)
+    projeng = getattr(so3g, f'MultiProjEng_{comps}')(
+        eng_targets, bool(targets[0][0].fast_math))
+    return projeng.to_weight_map(dest_maps, q1, dets, rots, None, None)
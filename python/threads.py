@@ -0,0 +1,123 @@
+"""Control of the threads used by the so3g OpenMP routines, and
+background execution of so3g calls.
+
+By default, each parallel region in so3g uses the OpenMP default
+number of threads (e.g. from OMP_NUM_THREADS).  The limit can instead
+be set, for calls made from the current thread, with
+so3g.set_num_threads, or temporarily with the context manager here::
+
+  with so3g.threads.limit(8):
+      p.to_map(signal, asm, comps='TQU', omp=omp)
+
+The threads can also be pinned to particular CPUs (Linux only)::
+
+  with so3g.threads.limit(8, cpus=range(8, 16)):
+      ...
+
+The heavy so3g routines release the GIL while they work, so they can
+run in the background while Python does something else (e.g. reads
+the next frame).  The submit function here runs a call in a small
+pool of worker threads and returns a concurrent.futures.Future::
+
+  fut = so3g.threads.submit(bank.apply, data, out)
+  ...
+  fut.result()
+
+In asyncio code, wrap the future with asyncio.wrap_future to await it.
+
+"""
+import concurrent.futures
+import contextlib
+import threading
+
+import so3g
+
+#: Number of worker threads used by submit.
+ASYNC_WORKERS = 2
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def limit(n_threads=None, cpus=None):
+    """Context manager that sets the number of threads used by so3g
+    routines called from this thread, and optionally pins those
+    threads to particular CPUs.
+
+    Arguments:
+      n_threads: The number of threads.  If None, it is taken from
+        the length of cpus (or left unchanged, if cpus is also None).
+      cpus: A list of CPU indices.  Thread i of the team is pinned to
+        cpus[i % len(cpus)].  Note the calling thread is thread 0.
+
+    The calling thread is pinned at once, and the other threads as
+    they join each parallel region started from it.  On exit, the
+    previous thread count is restored and, if cpus was passed, the
+    threads are restored (in the same way) to the affinity the process
+    had when so3g was loaded.
+
+    """
+    if cpus is not None:
+        cpus = [int(c) for c in cpus]
+        if n_threads is None:
+            n_threads = len(cpus)
+    old = None
+    if n_threads is not None:
+        old = so3g.set_num_threads(int(n_threads))
+    try:
+        if cpus is not None:
+            so3g.set_affinity(cpus)
+        yield
+    finally:
+        if cpus is not None:
+            so3g.set_affinity(None)
+        if old is not None:
+            so3g.set_num_threads(old)
+
+
+def get_executor():
+    """Returns the concurrent.futures.ThreadPoolExecutor used by
+    submit, creating it (with ASYNC_WORKERS threads) if necessary.
+
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=ASYNC_WORKERS, thread_name_prefix='so3g')
+        return _executor
+
+
+def shutdown(wait=True):
+    """Shut down the worker pool used by submit.  A new one will be
+    created on the next call to submit.
+
+    """
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=wait)
+
+
+def submit(func, *args, **kwargs):
+    """Run func(*args, **kwargs) in the so3g worker pool, returning a
+    concurrent.futures.Future.  The call will use the same number of
+    OpenMP threads as it would have in the calling thread (e.g. inside
+    a limit() block).
+
+    The arguments are not copied, so arrays that are written by the
+    call (output maps, signal being updated in place, filter state)
+    must not be touched until the future is done.
+
+    """
+    n_threads = so3g.get_num_threads()
+
+    def _run():
+        old = so3g.set_num_threads(n_threads)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            so3g.set_num_threads(old)
+    return get_executor().submit(_run)
@@ -0,0 +1,297 @@
+#include <pybindings.h>
+
+#include <math.h>
+#include <string.h>
+
+#include <memory>
+
+#include <omp.h>
+
+#include "Boresight.h"
+#include "Threads.h"
+#include "exceptions.h"
+
+typedef boost::math::quaternion<double> quatd;
+
+// Rotation by angle about the x (axis=0), y (1) or z (2) axis.
+static inline quatd euler(int axis, double angle)
+{
+    double c = cos(angle / 2), s = sin(angle / 2);
+    switch(axis) {
+    case 0: return quatd(c, s, 0, 0);
+    case 1: return quatd(c, 0, s, 0);
+    }
+    return quatd(c, 0, 0, s);
+}
+
+static double _get_param(bp::object &params, const char *key)
+{
+    return bp::extract<double>(params.attr("get")(key, 0.));
+}
+
+PointingModel::PointingModel(bp::object params)
+{
+    if (params.ptr() != Py_None) {
+        az_offset = _get_param(params, "az_offset");
+        el_offset = _get_param(params, "el_offset");
+        roll_offset = _get_param(params, "roll_offset");
+        collimation = _get_param(params, "collimation");
+        npae = _get_param(params, "npae");
+        base_tilt_x = _get_param(params, "base_tilt_x");
+        base_tilt_y = _get_param(params, "base_tilt_y");
+    }
+    _q_tilt = euler(0, base_tilt_x) * euler(1, base_tilt_y);
+    _q_npae = euler(0, npae);
+    _q_coll = euler(0, collimation);
+}
+
+void PointingModel::Apply(double &az, double &el, double &roll) const
+{
+    quatd q = (_q_tilt * euler(2, -(az + az_offset)) * _q_npae *
+               euler(1, M_PI/2 - (el + el_offset)) * _q_coll *
+               euler(2, M_PI + roll + roll_offset));
+
+    // Decompose as Rz(alpha) Ry(beta) Rz(gamma).
+    const double a = q.R_component_1(), b = q.R_component_2();
+    const double c = q.R_component_3(), d = q.R_component_4();
+    const double sum = 2 * atan2(d, a);     // alpha + gamma
+    const double dif = 2 * atan2(-b, c);    // alpha - gamma
+    const double beta = 2 * atan2(sqrt(b*b + c*c), sqrt(a*a + d*d));
+
+    // Stay on the same branch as the inputs, so scans across az=0 are
+    // not unwrapped.
+    const double new_az = -(sum + dif) / 2;
+    const double new_roll = (sum - dif) / 2 - M_PI;
+    az += remainder(new_az - az, 2 * M_PI);
+    roll += remainder(new_roll - roll, 2 * M_PI);
+    el = M_PI/2 - beta;
+}
+
+PointingCorrection::PointingCorrection(bp::object correction)
+{
+    bp::object table = correction.attr("table");
+    if (PyObject_GetBuffer(table.ptr(), &_buf.view,
+                           PyBUF_RECORDS_RO) == -1) {
+        PyErr_Clear();
+        throw buffer_exception("table");
+    }
+    if (_buf.view.ndim != 4 || _buf.view.shape[3] != 4)
+        throw shape_exception("table", "must have shape (n_t, n_az, n_el, 4)");
+    if (strcmp(_buf.view.format, "d") != 0)
+        throw dtype_exception("table", "float64");
+    _data = (const char*)_buf.view.buf;
+    for (int i=0; i<4; i++)
+        _strides[i] = _buf.view.strides[i];
+
+    const char *x0_names[3] = {"t0", "az0", "el0"};
+    const char *dx_names[3] = {"dt", "daz", "del_"};
+    for (int i=0; i<3; i++) {
+        _n[i] = _buf.view.shape[i];
+        if (_n[i] < 1)
+            throw shape_exception("table", "must not be empty");
+        _x0[i] = bp::extract<double>(correction.attr(x0_names[i]));
+        _dx[i] = bp::extract<double>(correction.attr(dx_names[i]));
+        if (_n[i] > 1 && _dx[i] <= 0)
+            throw general_agreement_exception(
+                "Correction grid spacing must be positive.");
+    }
+}
+
+boost::math::quaternion<double> PointingCorrection::Get(
+    double t, double az, double el) const
+{
+    // Cell index and fractional offset along each axis.
+    const double x[3] = {t, az, el};
+    int idx[3];
+    double f[3];
+    for (int i=0; i<3; i++) {
+        idx[i] = 0;
+        f[i] = 0.;
+        if (_n[i] == 1)
+            continue;
+        double u = (x[i] - _x0[i]) / _dx[i];
+        if (u <= 0)
+            continue;
+        if (u >= _n[i] - 1) {
+            idx[i] = _n[i] - 2;
+            f[i] = 1.;
+            continue;
+        }
+        idx[i] = int(u);
+        f[i] = u - idx[i];
+    }
+
+    double c[4] = {0, 0, 0, 0};
+    for (int corner=0; corner<8; corner++) {
+        double w = 1.;
+        const char *p = _data;
+        for (int i=0; i<3; i++) {
+            int step = (corner >> i) & 1;
+            if (step && _n[i] == 1)
+                w = 0;
+            w *= step ? f[i] : 1 - f[i];
+            p += _strides[i] * (idx[i] + step);
+        }
+        if (w == 0)
+            continue;
+        for (int k=0; k<4; k++)
+            c[k] += w * *(const double*)(p + _strides[3]*k);
+    }
+    const double norm = sqrt(c[0]*c[0] + c[1]*c[1] + c[2]*c[2] + c[3]*c[3]);
+    return quatd(c[0] / norm, c[1] / norm, c[2] / norm, c[3] / norm);
+}
+
+void apply_pointing_model(bp::object params, bp::object az,
+                          bp::object el, bp::object roll)
+{
+    PointingModel model(params);
+
+    BufferWrapper bufs[3];
+    const char *names[3] = {"az", "el", "roll"};
+    bp::object args[3] = {az, el, roll};
+    for (int i=0; i<3; i++) {
+        if (PyObject_GetBuffer(args[i].ptr(), &bufs[i].view,
+                               PyBUF_RECORDS) == -1) {
+            PyErr_Clear();
+            throw buffer_exception(names[i]);
+        }
+        if (bufs[i].view.readonly)
+            throw buffer_exception(names[i]);
+        if (bufs[i].view.ndim != 1)
+            throw shape_exception(names[i], "must be 1-d");
+        if (strcmp(bufs[i].view.format, "d") != 0)
+            throw dtype_exception(names[i], "float64");
+        if (bufs[i].view.shape[0] != bufs[0].view.shape[0])
+            throw agreement_exception("az", names[i], "shape");
+    }
+
+    const int n = bufs[0].view.shape[0];
+    char *p[3];
+    Py_ssize_t s[3];
+    for (int i=0; i<3; i++) {
+        p[i] = (char*)bufs[i].view.buf;
+        s[i] = bufs[i].view.strides[0];
+    }
+
+    ReleaseGIL _nogil;
+    ThreadPin _pin;
+#pragma omp parallel for num_threads(so3g_get_num_threads()) \
+    firstprivate(_pin)
+    for (int i=0; i<n; i++) {
+        model.Apply(*(double*)(p[0] + s[0]*i),
+                    *(double*)(p[1] + s[1]*i),
+                    *(double*)(p[2] + s[2]*i));
+    }
+}
+
+// Horizon to celestial boresight rotation, computed as in
+// CelestialSightLine.naive_az_el:
+//
+//   Rz(lst) Ry(pi/2 - lat) Rz(pi) Rz(-az) Ry(pi/2 - el) Rz(pi + roll)
+//
+// where lst = era_rate * (t - era_epoch) / 86400 + era_offset + lon,
+// and the site parts are fixed.  Inputs are 1-d float64 vectors (with
+// any strides, including 0 for broadcast scalars), and the output is
+// a float64 array of shape (n, 4), such as a G3VectorQuat.
+void naive_boresight(bp::object output, bp::object t, bp::object az,
+                     bp::object el, bp::object roll, double lon,
+                     double lat, double era_epoch, double era_rate,
+                     double era_offset, bp::object pointing_model,
+                     bp::object correction)
+{
+    const bool use_model = (pointing_model.ptr() != Py_None);
+    PointingModel model(pointing_model);
+    std::unique_ptr<PointingCorrection> corr;
+    if (correction.ptr() != Py_None)
+        corr.reset(new PointingCorrection(correction));
+
+    BufferWrapper bufs[4];
+    const char *names[4] = {"t", "az", "el", "roll"};
+    bp::object args[4] = {t, az, el, roll};
+    for (int i=0; i<4; i++) {
+        if (PyObject_GetBuffer(args[i].ptr(), &bufs[i].view,
+                               PyBUF_RECORDS_RO) == -1) {
+            PyErr_Clear();
+            throw buffer_exception(names[i]);
+        }
+        if (bufs[i].view.ndim != 1)
+            throw shape_exception(names[i], "must be 1-d");
+        if (strcmp(bufs[i].view.format, "d") != 0)
+            throw dtype_exception(names[i], "float64");
+        if (bufs[i].view.shape[0] != bufs[0].view.shape[0])
+            throw agreement_exception("t", names[i], "shape");
+    }
+    const int n = bufs[0].view.shape[0];
+
+    BufferWrapper qbuf;
+    if (PyObject_GetBuffer(output.ptr(), &qbuf.view,
+                           PyBUF_RECORDS) == -1) {
+        PyErr_Clear();
+        throw buffer_exception("output");
+    }
+    if (qbuf.view.ndim != 2 || qbuf.view.shape[1] != 4)
+        throw shape_exception("output", "must have shape (n, 4)");
+    if (strcmp(qbuf.view.format, "d") != 0)
+        throw dtype_exception("output", "float64");
+    if (qbuf.view.shape[0] != n)
+        throw agreement_exception("t", "output", "shape");
+
+    const char *p[4];
+    Py_ssize_t s[4];
+    for (int i=0; i<4; i++) {
+        p[i] = (const char*)bufs[i].view.buf;
+        s[i] = bufs[i].view.strides[0];
+    }
+    char *q = (char*)qbuf.view.buf;
+    const Py_ssize_t qs0 = qbuf.view.strides[0];
+    const Py_ssize_t qs1 = qbuf.view.strides[1];
+
+    const quatd q_site = euler(1, M_PI/2 - lat) * euler(2, M_PI);
+
+    ReleaseGIL _nogil;
+    ThreadPin _pin;
+#pragma omp parallel for num_threads(so3g_get_num_threads()) \
+    firstprivate(_pin)
+    for (int i=0; i<n; i++) {
+        const double t_i = *(const double*)(p[0] + s[0]*i);
+        double az_i = *(const double*)(p[1] + s[1]*i);
+        double el_i = *(const double*)(p[2] + s[2]*i);
+        double roll_i = *(const double*)(p[3] + s[3]*i);
+        if (use_model)
+            model.Apply(az_i, el_i, roll_i);
+        const double lst = (era_rate * ((t_i - era_epoch) / 86400) +
+                            era_offset) + lon;
+        quatd r = (euler(2, lst) * q_site * euler(2, -az_i) *
+                   euler(1, M_PI/2 - el_i) * euler(2, M_PI + roll_i));
+        if (corr)
+            r = corr->Get(t_i, az_i, el_i) * r;
+        char *qi = q + qs0*i;
+        *(double*)(qi) = r.R_component_1();
+        *(double*)(qi + qs1) = r.R_component_2();
+        *(double*)(qi + 2*qs1) = r.R_component_3();
+        *(double*)(qi + 3*qs1) = r.R_component_4();
+    }
+}
+
+
+PYBINDINGS("so3g")
+{
+    bp::def("apply_pointing_model", apply_pointing_model,
+            (bp::arg("params"), bp::arg("az"), bp::arg("el"),
+             bp::arg("roll")),
+            "Apply a pointing model (a dict of parameters, see "
+            "so3g.proj.PointingModel) to float64 az, el and roll vectors, "
+            "in place.");
+    bp::def("naive_boresight", naive_boresight,
+            (bp::arg("output"), bp::arg("t"), bp::arg("az"), bp::arg("el"),
+             bp::arg("roll"), bp::arg("lon"), bp::arg("lat"),
+             bp::arg("era_epoch"), bp::arg("era_rate"),
+             bp::arg("era_offset"), bp::arg("pointing_model")=bp::object(),
+             bp::arg("correction")=bp::object()),
+            "Compute naive horizon to celestial boresight quaternions "
+            "from float64 t, az, el and roll vectors, into output of "
+            "shape (n, 4).  The site lon, lat are in radians; see "
+            "so3g.proj.CelestialSightLine.naive_az_el.  If correction "
+            "(a so3g.proj.PointingCorrection) is passed, its tabulated "
+            "rotation is applied on the left.");
+}
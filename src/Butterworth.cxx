@@ -5,6 +5,7 @@
 #include <container_pybindings.h>
 
 #include "Butterworth.h"
+#include "Threads.h"
 #include "exceptions.h"
 
 using namespace std;
@@ -66,10 +67,12 @@ void BFilterBank::apply_buffer(boost::python::object input,
     if (strcmp(inbuf.view.format, "i")==0) {
         int *in = reinterpret_cast<int*>(inbuf.view.buf);
         int *out = reinterpret_cast<int*>(outbuf.view.buf);
+        ReleaseGIL _nogil;
         apply(in, out, n_samp);
     } else if (strcmp(inbuf.view.format, "f") == 0) {
         float *in = reinterpret_cast<float*>(inbuf.view.buf);
         float *out = reinterpret_cast<float*>(outbuf.view.buf);
+        ReleaseGIL _nogil;
         apply_to_float(in, out, 1., n_samp);
     } else {
         throw dtype_exception("input", "int or float32");
@@ -83,7 +86,9 @@ void BFilterBank::apply(int32_t* input, int32_t* output, int n_samp)
     assert(n_filt == par.size());
     int n_chan = w[0].size();
 
-#pragma omp parallel for shared(input, output)
+    ThreadPin _pin;
+#pragma omp parallel for shared(input, output) num_threads(so3g_get_num_threads()) \
+    firstprivate(_pin)
     for (int ic=0; ic<n_chan; ic++) {
         for (int i=0; i<n_samp; i++) {
             int32_t x = input[i];
@@ -107,7 +112,9 @@ void BFilterBank::apply_to_float(float *input, float *output, float unit, int n_
     assert(n_filt == par.size());
     int n_chan = w[0].size();
 
-#pragma omp parallel for shared(input, output)
+    ThreadPin _pin;
+#pragma omp parallel for shared(input, output) num_threads(so3g_get_num_threads()) \
+    firstprivate(_pin)
     for (int ic=0; ic<n_chan; ic++) {
         float *src = input  + ic*n_samp;
         float *dst = output + ic*n_samp;
@@ -9,6 +9,12 @@ using namespace std;
 #include <assert.h>
 #include <math.h>
 
+#include <algorithm>
+#include <array>
+#include <map>
+#include <memory>
+#include <mutex>
+
 #include <omp.h>
 
 #include <container_pybindings.h>
@@ -16,6 +22,7 @@ using namespace std;
 #include "so3g_numpy.h"
 #include <Projection.h>
 #include <Ranges.h>
+#include "Threads.h"
 #include "exceptions.h"
 
 #include <boost/math/quaternion.hpp>
@@ -55,6 +62,17 @@ bool Pointer<CoordSys>::TestInputs(
     if (_pdetbuf.view.shape[1] != 4)
         throw shape_exception("pdet", "must have shape (n_det,4)");
 
+    // Either float64 or float32 is accepted; the latter is promoted
+    // to double when it is loaded.
+    if (strcmp(_pborebuf.view.format, "d") != 0 &&
+        strcmp(_pborebuf.view.format, "f") != 0)
+        throw dtype_exception("pbore", "float64 or float32");
+    if (strcmp(_pdetbuf.view.format, "d") != 0 &&
+        strcmp(_pdetbuf.view.format, "f") != 0)
+        throw dtype_exception("pdet", "float64 or float32");
+    _pbore_f32 = (strcmp(_pborebuf.view.format, "f") == 0);
+    _pdet_f32 = (strcmp(_pdetbuf.view.format, "f") == 0);
+
     n_time = _pborebuf.view.shape[0];
     n_det = _pdetbuf.view.shape[0];
 
@@ -67,30 +85,60 @@ void Pointer<CoordSys>::InitPerDet(int i_det, double *dofs)
 {
     const char *det = (char*)_pdetbuf.view.buf
         + _pdetbuf.view.strides[0] * i_det;
-    for (int ic = 0; ic < 4; ++ic)
-        dofs[ic] = *(double*)(det + _pdetbuf.view.strides[1] * ic);
+    if (_pdet_f32) {
+        for (int ic = 0; ic < 4; ++ic)
+            dofs[ic] = *(float*)(det + _pdetbuf.view.strides[1] * ic);
+    } else {
+        for (int ic = 0; ic < 4; ++ic)
+            dofs[ic] = *(double*)(det + _pdetbuf.view.strides[1] * ic);
+    }
 }
 
-/* ProjQuat: Not a projection -- returns the quaternion rotation
- * components.
- */
+template <typename CoordSys>
+inline
+void Pointer<CoordSys>::_GetBore(int i_time, double *qbore)
+{
+    const char *bore = (char*)_pborebuf.view.buf
+        + _pborebuf.view.strides[0] * i_time;
+    if (_pbore_f32) {
+        for (int ic = 0; ic < 4; ++ic)
+            qbore[ic] = *(float*)(bore + _pborebuf.view.strides[1] * ic);
+    } else {
+        for (int ic = 0; ic < 4; ++ic)
+            qbore[ic] = *(double*)(bore + _pborebuf.view.strides[1] * ic);
+    }
+}
 
-template <>
+/* For the spherical projections, GetCoords computes the detector
+ * quaternion and then passes it to the projection-specific
+ * QuatToCoords. */
+
+template <typename CoordSys>
 inline
-void Pointer<ProjQuat>::GetCoords(int i_det, int i_time,
+void Pointer<CoordSys>::GetCoords(int i_det, int i_time,
                                   const double *dofs, double *coords)
 {
     double _qbore[4];
-    for (int ic=0; ic<4; ic++)
-        _qbore[ic] = *(double*)((char*)_pborebuf.view.buf +
-                            _pborebuf.view.strides[0] * i_time +
-                            _pborebuf.view.strides[1] * ic);
+    _GetBore(i_time, _qbore);
 
     // What could possibly go wrong.
     const quatd *qbore = reinterpret_cast<const quatd*>(_qbore);
     const quatd *qofs = reinterpret_cast<const quatd*>(dofs);
-    quatd *qdet = reinterpret_cast<quatd*>(coords);
-    *qdet =(*qbore) * (*qofs);
+    quatd qdet = (*qbore) * (*qofs);
+    QuatToCoords(reinterpret_cast<const double*>(&qdet), coords, fast_math);
+}
+
+/* ProjQuat: Not a projection -- returns the quaternion rotation
+ * components.
+ */
+
+template <>
+inline
+void Pointer<ProjQuat>::QuatToCoords(const double *qdet, double *coords,
+                                     bool fast_math)
+{
+    for (int ic=0; ic<4; ic++)
+        coords[ic] = qdet[ic];
 }
 
 /* ProjFlat: Not a spherical projection -- assumes flat space (as in
@@ -101,10 +149,7 @@ inline
 void Pointer<ProjFlat>::GetCoords(int i_det, int i_time,
                                   const double *dofs, double *coords)
 {
-    for (int ic=0; ic<4; ic++)
-        coords[ic] = *(double*)((char*)_pborebuf.view.buf +
-                                _pborebuf.view.strides[0] * i_time +
-                                _pborebuf.view.strides[1] * ic);
+    _GetBore(i_time, coords);
     coords[0] += dofs[0];
     coords[1] += dofs[1];
     const double coords_2_ = coords[2];
@@ -121,24 +166,13 @@ void Pointer<ProjFlat>::GetCoords(int i_det, int i_time,
 
 template <>
 inline
-void Pointer<ProjARC>::GetCoords(int i_det, int i_time,
-                                 const double *dofs, double *coords)
+void Pointer<ProjARC>::QuatToCoords(const double *qdet, double *coords,
+                                    bool fast_math)
 {
-    double _qbore[4];
-    for (int ic=0; ic<4; ic++)
-        _qbore[ic] = *(double*)((char*)_pborebuf.view.buf +
-                            _pborebuf.view.strides[0] * i_time +
-                            _pborebuf.view.strides[1] * ic);
-
-    // What could possibly go wrong.
-    const quatd *qbore = reinterpret_cast<const quatd*>(_qbore);
-    const quatd *qofs = reinterpret_cast<const quatd*>(dofs);
-    quatd qdet = (*qbore) * (*qofs);
-
-    const double a = qdet.R_component_1();
-    const double b = qdet.R_component_2();
-    const double c = qdet.R_component_3();
-    const double d = qdet.R_component_4();
+    const double a = qdet[0];
+    const double b = qdet[1];
+    const double c = qdet[2];
+    const double d = qdet[3];
 
     const double cos_theta2_sq = a*a + d*d;
 
@@ -166,24 +200,13 @@ void Pointer<ProjARC>::GetCoords(int i_det, int i_time,
 
 template <>
 inline
-void Pointer<ProjTAN>::GetCoords(int i_det, int i_time,
-                                 const double *dofs, double *coords)
+void Pointer<ProjTAN>::QuatToCoords(const double *qdet, double *coords,
+                                    bool fast_math)
 {
-    double _qbore[4];
-    for (int ic=0; ic<4; ic++)
-        _qbore[ic] = *(double*)((char*)_pborebuf.view.buf +
-                            _pborebuf.view.strides[0] * i_time +
-                            _pborebuf.view.strides[1] * ic);
-
-    // What could possibly go wrong.
-    const quatd *qbore = reinterpret_cast<const quatd*>(_qbore);
-    const quatd *qofs = reinterpret_cast<const quatd*>(dofs);
-    quatd qdet = (*qbore) * (*qofs);
-
-    const double a = qdet.R_component_1();
-    const double b = qdet.R_component_2();
-    const double c = qdet.R_component_3();
-    const double d = qdet.R_component_4();
+    const double a = qdet[0];
+    const double b = qdet[1];
+    const double c = qdet[2];
+    const double d = qdet[3];
 
     const double cos_theta2_sq = a*a + d*d;
     const double cos_theta = 2*cos_theta2_sq - 1;
@@ -203,24 +226,13 @@ void Pointer<ProjTAN>::GetCoords(int i_det, int i_time,
 
 template <>
 inline
-void Pointer<ProjZEA>::GetCoords(int i_det, int i_time,
-                                 const double *dofs, double *coords)
+void Pointer<ProjZEA>::QuatToCoords(const double *qdet, double *coords,
+                                    bool fast_math)
 {
-    double _qbore[4];
-    for (int ic=0; ic<4; ic++)
-        _qbore[ic] = *(double*)((char*)_pborebuf.view.buf +
-                            _pborebuf.view.strides[0] * i_time +
-                            _pborebuf.view.strides[1] * ic);
-
-    // What could possibly go wrong.
-    const quatd *qbore = reinterpret_cast<const quatd*>(_qbore);
-    const quatd *qofs = reinterpret_cast<const quatd*>(dofs);
-    quatd qdet = (*qbore) * (*qofs);
-
-    const double a = qdet.R_component_1();
-    const double b = qdet.R_component_2();
-    const double c = qdet.R_component_3();
-    const double d = qdet.R_component_4();
+    const double a = qdet[0];
+    const double b = qdet[1];
+    const double c = qdet[2];
+    const double d = qdet[3];
 
     const double cos_theta2_sq = a*a + d*d;
     const double cos_theta = 2*cos_theta2_sq - 1;
@@ -232,6 +244,42 @@ void Pointer<ProjZEA>::GetCoords(int i_det, int i_time,
     coords[3] = (2*a*d) / cos_theta2_sq;
 }
 
+/* fast_atan2: polynomial approximation to atan2, used by the
+ * cylindrical projections when fast_math is enabled.  The argument is
+ * reduced to the first octant, where atan(z) = z*P(z^2) for a minimax
+ * polynomial P of degree 7.  The maximum absolute error is 3.8e-8
+ * radians (0.008 arcsec).
+ */
+
+static inline
+double fast_atan2(double y, double x)
+{
+    const double ax = fabs(x);
+    const double ay = fabs(y);
+    const bool swap = ay > ax;
+    double z;
+    if (swap)
+        z = ax / ay;
+    else if (ax > 0)
+        z = ay / ax;
+    else
+        return 0.;
+    const double z2 = z*z;
+    double r = z * (0.99999933560726051 +
+                    z2 * (-0.33329860842516146 +
+                    z2 * (0.19946566011691369 +
+                    z2 * (-0.13908630472969541 +
+                    z2 * (0.096421982349644553 +
+                    z2 * (-0.055912325462840036 +
+                    z2 * (0.021862950128878469 +
+                    z2 * -0.0040545636623092879)))))));
+    if (swap)
+        r = M_PI_2 - r;
+    if (x < 0)
+        r = M_PI - r;
+    return (y < 0) ? -r : r;
+}
+
 /* ProjCEA: Cylindrical projection.
  *
  * First two coordinates are lon (in radians) and sin(lat).  Then cos
@@ -240,29 +288,21 @@ void Pointer<ProjZEA>::GetCoords(int i_det, int i_time,
 
 template <>
 inline
-void Pointer<ProjCEA>::GetCoords(int i_det, int i_time,
-                                 const double *dofs, double *coords)
+void Pointer<ProjCEA>::QuatToCoords(const double *qdet, double *coords,
+                                    bool fast_math)
 {
-    double _qbore[4];
-    for (int ic=0; ic<4; ic++)
-        _qbore[ic] = *(double*)((char*)_pborebuf.view.buf +
-                            _pborebuf.view.strides[0] * i_time +
-                            _pborebuf.view.strides[1] * ic);
-
-    // What could possibly go wrong.
-    const quatd *qbore = reinterpret_cast<const quatd*>(_qbore);
-    const quatd *qofs = reinterpret_cast<const quatd*>(dofs);
-    quatd qdet = (*qbore) * (*qofs);
-
-    const double a = qdet.R_component_1();
-    const double b = qdet.R_component_2();
-    const double c = qdet.R_component_3();
-    const double d = qdet.R_component_4();
+    const double a = qdet[0];
+    const double b = qdet[1];
+    const double c = qdet[2];
+    const double d = qdet[3];
 
     const double cos_theta = a*a - b*b - c*c + d*d;
     const double half_sin_theta = 0.5 * sqrt(1 - cos_theta*cos_theta);
 
-    coords[0] = atan2(c*d - a*b, c*a + d*b);
+    if (fast_math)
+        coords[0] = fast_atan2(c*d - a*b, c*a + d*b);
+    else
+        coords[0] = atan2(c*d - a*b, c*a + d*b);
     coords[1] = cos_theta; // Yes, cos(theta) = sin(lat).
     coords[2] = (a*c - b*d) / half_sin_theta;
     coords[3] = (c*d + a*b) / half_sin_theta;
@@ -276,30 +316,25 @@ void Pointer<ProjCEA>::GetCoords(int i_det, int i_time,
 
 template <>
 inline
-void Pointer<ProjCAR>::GetCoords(int i_det, int i_time,
-                                      const double *dofs, double *coords)
+void Pointer<ProjCAR>::QuatToCoords(const double *qdet, double *coords,
+                                    bool fast_math)
 {
-    double _qbore[4];
-    for (int ic=0; ic<4; ic++)
-        _qbore[ic] = *(double*)((char*)_pborebuf.view.buf +
-                            _pborebuf.view.strides[0] * i_time +
-                            _pborebuf.view.strides[1] * ic);
-
-    // What could possibly go wrong.
-    const quatd *qbore = reinterpret_cast<const quatd*>(_qbore);
-    const quatd *qofs = reinterpret_cast<const quatd*>(dofs);
-    quatd qdet = (*qbore) * (*qofs);
-
-    const double a = qdet.R_component_1();
-    const double b = qdet.R_component_2();
-    const double c = qdet.R_component_3();
-    const double d = qdet.R_component_4();
+    const double a = qdet[0];
+    const double b = qdet[1];
+    const double c = qdet[2];
+    const double d = qdet[3];
 
     const double cos_theta = a*a - b*b - c*c + d*d;
     const double half_sin_theta = 0.5 * sqrt(1 - cos_theta*cos_theta);
 
-    coords[0] = atan2(c*d - a*b, c*a + d*b);
-    coords[1] = asin(cos_theta);   // Yes, cos(theta) = sin(lat).
+    if (fast_math) {
+        // lat = asin(cos_theta) = atan2(cos_theta, sin_theta).
+        coords[0] = fast_atan2(c*d - a*b, c*a + d*b);
+        coords[1] = fast_atan2(cos_theta, 2*half_sin_theta);
+    } else {
+        coords[0] = atan2(c*d - a*b, c*a + d*b);
+        coords[1] = asin(cos_theta);   // Yes, cos(theta) = sin(lat).
+    }
     coords[2] = (a*c - b*d) / half_sin_theta;
     coords[3] = (c*d + a*b) / half_sin_theta;
 }
@@ -357,6 +392,11 @@ bool Pixelizor2_Flat::TestInputs(bp::object &map, bp::object &pbore, bp::object
 }
 
 bp::object Pixelizor2_Flat::zeros(int count)
+{
+    return zeros(count, NPY_FLOAT64);
+}
+
+bp::object Pixelizor2_Flat::zeros(int count, int dtype)
 {
     int size = 1;
     int dimi = 0;
@@ -371,7 +411,6 @@ bp::object Pixelizor2_Flat::zeros(int count)
     dims[dimi++] = naxis[1];
     size *= naxis[0] * naxis[1];
 
-    int dtype = NPY_FLOAT64;
     PyObject *v = PyArray_ZEROS(dimi, dims, dtype, 0);
     return bp::object(bp::handle<>(v));
 }
@@ -398,6 +437,342 @@ std::pair<int,int> Pixelizor2_Flat::IndexRange()
     return make_pair(0,naxis[0]*naxis[1]);
 }
 
+/* Tiles are (tile_ny, tile_nx) blocks of pixels, numbered in C
+ * order; the tiles in the last row and column may be smaller. */
+
+inline
+int Pixelizor2_Flat::GetTile(int pixel_index, int tile_ny, int tile_nx)
+{
+    // Requires naive C-ordered pixel indices (i.e. TestInputs with
+    // map=None).
+    if (pixel_index < 0)
+        return -1;
+    const int n_tx = (naxis[1] + tile_nx - 1) / tile_nx;
+    const int iy = pixel_index / naxis[1];
+    const int ix = pixel_index % naxis[1];
+    return (iy / tile_ny) * n_tx + ix / tile_nx;
+}
+
+/* The largest distance, in the projection plane, from the reference
+ * point to any point of the map (including the outer half of the
+ * edge pixels). */
+
+double Pixelizor2_Flat::MaxRadius()
+{
+    double r2 = 0.;
+    for (int i = 0; i < 2; i++) {
+        const double lo = fabs((-crpix[i] - 0.5) * cdelt[i]);
+        const double hi = fabs((naxis[i] - crpix[i] - 0.5) * cdelt[i]);
+        r2 += std::max(lo, hi) * std::max(lo, hi);
+    }
+    return sqrt(r2);
+}
+
+/* Map resampling.
+ *
+ * The maps passed to these routines are float64 arrays of shape
+ * (..., n_y, n_x); the leading axes (e.g. the components of a signal
+ * or weights map) are carried through unchanged.  If output is None,
+ * a new array is returned; otherwise it must be an array of the
+ * right shape, and of the same dtype as the input map, which is
+ * overwritten and returned.
+ */
+
+// Check that map is a float64 (or, if allow_int, int32) array of
+// shape (..., ny, nx) (if ny, nx >= 0), and fill in the byte offsets
+// of its (ny, nx) planes.
+static
+void map_planes(BufferWrapper &buf, bp::object &map, const char *name,
+                int ny, int nx, vector<long> &offsets, bool writable=false,
+                bool allow_int=false)
+{
+    if (PyObject_GetBuffer(map.ptr(), &buf.view,
+                           writable ? PyBUF_RECORDS : PyBUF_RECORDS_RO) == -1) {
+        PyErr_Clear();
+        throw buffer_exception(name);
+    }
+    const int ndim = buf.view.ndim;
+    if (ndim < 2)
+        throw shape_exception(name, "must have shape (...,n_y,n_x)");
+    if ((ny >= 0 && buf.view.shape[ndim-2] != ny) ||
+        (nx >= 0 && buf.view.shape[ndim-1] != nx))
+        throw shape_exception(name, "does not match the map geometry");
+    if (strcmp(buf.view.format, "d") != 0 &&
+        !(allow_int && strcmp(buf.view.format, "i") == 0))
+        throw dtype_exception(name, allow_int ? "float64 or int32" : "float64");
+    offsets.assign(1, 0);
+    for (int d = ndim - 3; d >= 0; d--) {
+        vector<long> o;
+        for (int i = 0; i < buf.view.shape[d]; i++)
+            for (auto x: offsets)
+                o.push_back(x + i * buf.view.strides[d]);
+        offsets.swap(o);
+    }
+}
+
+// Get the output array for a resampling of map (with buffer inbuf)
+// into (ny, nx) planes: a new one, of the same dtype as map, if output
+// is None; otherwise output after checking it.
+static
+bp::object map_output(BufferWrapper &outbuf, bp::object &output,
+                      const BufferWrapper &inbuf, int ny, int nx,
+                      vector<long> &offsets)
+{
+    const int ndim = inbuf.view.ndim;
+    const bool is_int = (strcmp(inbuf.view.format, "i") == 0);
+    if (isNone(output)) {
+        npy_intp dims[32];
+        for (int d = 0; d < ndim - 2; d++)
+            dims[d] = inbuf.view.shape[d];
+        dims[ndim-2] = ny;
+        dims[ndim-1] = nx;
+        output = bp::object(bp::handle<>(
+            PyArray_ZEROS(ndim, dims, is_int ? NPY_INT32 : NPY_FLOAT64, 0)));
+    }
+    map_planes(outbuf, output, "output", ny, nx, offsets, true, is_int);
+    if (strcmp(outbuf.view.format, inbuf.view.format) != 0)
+        throw dtype_exception("output", "the same dtype as the map");
+    bool match = (outbuf.view.ndim == ndim);
+    for (int d = 0; match && d < ndim - 2; d++)
+        match = (outbuf.view.shape[d] == inbuf.view.shape[d]);
+    if (!match)
+        throw shape_exception("output", "leading dimensions must match the map");
+    return output;
+}
+
+// Bilinear interpolation in a plane at fractional index (fy, fx),
+// which is clamped to the pixel centers at the edges.
+static inline
+double interp_bilinear(const char *plane, const Py_ssize_t *strides,
+                       int ny, int nx, double fy, double fx)
+{
+    fy = std::max(0., std::min(fy, double(ny - 1)));
+    fx = std::max(0., std::min(fx, double(nx - 1)));
+    const int y0 = std::min(int(fy), ny - 1);
+    const int x0 = std::min(int(fx), nx - 1);
+    const int y1 = std::min(y0 + 1, ny - 1);
+    const int x1 = std::min(x0 + 1, nx - 1);
+    const double wy = fy - y0;
+    const double wx = fx - x0;
+    auto v = [&](int y, int x) {
+        return *(double*)(plane + strides[0] * y + strides[1] * x);
+    };
+    return ((1 - wy) * ((1 - wx) * v(y0, x0) + wx * v(y0, x1)) +
+            wy * ((1 - wx) * v(y1, x0) + wx * v(y1, x1)));
+}
+
+/** downgrade(map, factor, weights=None, output=None)
+ *
+ *  Combine the map pixels in blocks of factor x factor; the output
+ *  has shape (..., ceil(n_y/factor), ceil(n_x/factor)), and the
+ *  blocks at the high edges may be partial.  If weights is None, each
+ *  output pixel is the sum of its block (appropriate for binned
+ *  signal, weights and hits maps); in that case the map may also be
+ *  int32 (e.g. a hits map), and the output then is too.  Otherwise
+ *  the map must be float64, weights must be a float64 or int32 array
+ *  of shape (n_y, n_x), and each output pixel is the weighted mean of
+ *  its block (0 where the weights sum to 0).
+ *
+ *  The output pixel (j, i) covers the input pixels (j*factor, i*factor)
+ *  to ((j+1)*factor - 1, (i+1)*factor - 1); in that geometry cdelt is
+ *  multiplied by factor and crpix becomes (crpix - (factor-1)/2) /
+ *  factor.
+ */
+
+bp::object Pixelizor2_Flat::downgrade(bp::object map, int factor,
+                                      bp::object weights, bp::object output)
+{
+    if (factor < 1)
+        throw general_agreement_exception("factor must be >= 1.");
+    const int ny = naxis[0], nx = naxis[1];
+    const int ny_out = (ny + factor - 1) / factor;
+    const int nx_out = (nx + factor - 1) / factor;
+
+    BufferWrapper inbuf, outbuf, wbuf;
+    vector<long> in_ofs, out_ofs, w_ofs;
+    const bool weighted = !isNone(weights);
+    map_planes(inbuf, map, "map", ny, nx, in_ofs, false, !weighted);
+    output = map_output(outbuf, output, inbuf, ny_out, nx_out, out_ofs);
+    const bool map_int = (strcmp(inbuf.view.format, "i") == 0);
+    bool w_int = false;
+    if (weighted) {
+        map_planes(wbuf, weights, "weights", ny, nx, w_ofs, false, true);
+        if (wbuf.view.ndim != 2)
+            throw shape_exception("weights", "must have shape (n_y,n_x)");
+        w_int = (strcmp(wbuf.view.format, "i") == 0);
+    }
+
+    const char *src = (char*)inbuf.view.buf;
+    char *dest = (char*)outbuf.view.buf;
+    const Py_ssize_t *s_in = inbuf.view.strides + inbuf.view.ndim - 2;
+    const Py_ssize_t *s_out = outbuf.view.strides + outbuf.view.ndim - 2;
+    const Py_ssize_t *s_w = weighted ? wbuf.view.strides : nullptr;
+    const char *wts = (char*)wbuf.view.buf;
+    const int n_plane = in_ofs.size();
+
+    {
+        ReleaseGIL _nogil;
+        ThreadPin _pin;
+#pragma omp parallel for collapse(2) num_threads(so3g_get_num_threads()) \
+    firstprivate(_pin)
+        for (int i_plane = 0; i_plane < n_plane; i_plane++) {
+            for (int oy = 0; oy < ny_out; oy++) {
+                const char *plane = src + in_ofs[i_plane];
+                char *out_row = dest + out_ofs[i_plane] + s_out[0] * oy;
+                const int y1 = std::min(ny, (oy + 1) * factor);
+                for (int ox = 0; ox < nx_out; ox++) {
+                    const int x1 = std::min(nx, (ox + 1) * factor);
+                    double sum = 0., sum_w = 0.;
+                    for (int y = oy * factor; y < y1; y++) {
+                        for (int x = ox * factor; x < x1; x++) {
+                            const char *pv = plane + s_in[0] * y + s_in[1] * x;
+                            const double v = map_int ?
+                                *(int32_t*)pv : *(double*)pv;
+                            if (weighted) {
+                                const char *pw = wts + s_w[0] * y + s_w[1] * x;
+                                const double w = w_int ?
+                                    *(int32_t*)pw : *(double*)pw;
+                                sum += w * v;
+                                sum_w += w;
+                            } else
+                                sum += v;
+                        }
+                    }
+                    if (weighted)
+                        sum = (sum_w != 0.) ? sum / sum_w : 0.;
+                    if (map_int)
+                        *(int32_t*)(out_row + s_out[1] * ox) = int32_t(sum);
+                    else
+                        *(double*)(out_row + s_out[1] * ox) = sum;
+                }
+            }
+        }
+    }
+    return output;
+}
+
+/** upgrade(map, factor, order=0, output=None)
+ *
+ *  Split each map pixel into factor x factor pixels; the output has
+ *  shape (..., n_y*factor, n_x*factor).  With order=0 each new pixel
+ *  takes the value of its parent; with order=1 the values are
+ *  interpolated bilinearly between the centers of the parent pixels.
+ */
+
+bp::object Pixelizor2_Flat::upgrade(bp::object map, int factor, int order,
+                                    bp::object output)
+{
+    if (factor < 1)
+        throw general_agreement_exception("factor must be >= 1.");
+    if (order != 0 && order != 1)
+        throw general_agreement_exception("order must be 0 or 1.");
+    const int ny = naxis[0], nx = naxis[1];
+    const int ny_out = ny * factor, nx_out = nx * factor;
+
+    BufferWrapper inbuf, outbuf;
+    vector<long> in_ofs, out_ofs;
+    map_planes(inbuf, map, "map", ny, nx, in_ofs);
+    output = map_output(outbuf, output, inbuf, ny_out, nx_out, out_ofs);
+
+    const char *src = (char*)inbuf.view.buf;
+    char *dest = (char*)outbuf.view.buf;
+    const Py_ssize_t *s_in = inbuf.view.strides + inbuf.view.ndim - 2;
+    const Py_ssize_t *s_out = outbuf.view.strides + outbuf.view.ndim - 2;
+    const int n_plane = in_ofs.size();
+
+    {
+        ReleaseGIL _nogil;
+        ThreadPin _pin;
+#pragma omp parallel for collapse(2) num_threads(so3g_get_num_threads()) \
+    firstprivate(_pin)
+        for (int i_plane = 0; i_plane < n_plane; i_plane++) {
+            for (int y = 0; y < ny_out; y++) {
+                const char *plane = src + in_ofs[i_plane];
+                char *out_row = dest + out_ofs[i_plane] + s_out[0] * y;
+                const double fy = (y + 0.5) / factor - 0.5;
+                for (int x = 0; x < nx_out; x++) {
+                    double v;
+                    if (order == 0)
+                        v = *(double*)(plane + s_in[0] * (y / factor) +
+                                       s_in[1] * (x / factor));
+                    else
+                        v = interp_bilinear(plane, s_in, ny, nx, fy,
+                                            (x + 0.5) / factor - 0.5);
+                    *(double*)(out_row + s_out[1] * x) = v;
+                }
+            }
+        }
+    }
+    return output;
+}
+
+/** resample(src, src_map, order=1, output=None)
+ *
+ *  Resample src_map, which has the geometry of the Pixelizor2_Flat
+ *  src, onto this geometry.  The two must share the projection and
+ *  its reference point, and differ only in the pixel grid.  With
+ *  order=0 each pixel takes the value of the source pixel containing
+ *  its center; with order=1 the source is interpolated bilinearly.
+ *  Pixels whose center falls outside the source map are set to 0.
+ */
+
+bp::object Pixelizor2_Flat::resample(Pixelizor2_Flat &src, bp::object src_map,
+                                     int order, bp::object output)
+{
+    if (order != 0 && order != 1)
+        throw general_agreement_exception("order must be 0 or 1.");
+    const int ny_s = src.naxis[0], nx_s = src.naxis[1];
+
+    BufferWrapper inbuf, outbuf;
+    vector<long> in_ofs, out_ofs;
+    map_planes(inbuf, src_map, "src_map", ny_s, nx_s, in_ofs);
+    output = map_output(outbuf, output, inbuf, naxis[0], naxis[1], out_ofs);
+
+    // Index in src of the center of each of our pixels, along each
+    // axis (as in GetPixel, but shifted by 0.5 to pixel centers).
+    vector<double> fy(naxis[0]), fx(naxis[1]);
+    for (int y = 0; y < naxis[0]; y++)
+        fy[y] = (y - crpix[0]) * cdelt[0] / src.cdelt[0] + src.crpix[0];
+    for (int x = 0; x < naxis[1]; x++)
+        fx[x] = (x - crpix[1]) * cdelt[1] / src.cdelt[1] + src.crpix[1];
+
+    const char *srcp = (char*)inbuf.view.buf;
+    char *dest = (char*)outbuf.view.buf;
+    const Py_ssize_t *s_in = inbuf.view.strides + inbuf.view.ndim - 2;
+    const Py_ssize_t *s_out = outbuf.view.strides + outbuf.view.ndim - 2;
+    const int n_plane = in_ofs.size();
+    const int ny = naxis[0], nx = naxis[1];
+
+    {
+        ReleaseGIL _nogil;
+        ThreadPin _pin;
+#pragma omp parallel for collapse(2) num_threads(so3g_get_num_threads()) \
+    firstprivate(_pin)
+        for (int i_plane = 0; i_plane < n_plane; i_plane++) {
+            for (int y = 0; y < ny; y++) {
+                const char *plane = srcp + in_ofs[i_plane];
+                char *out_row = dest + out_ofs[i_plane] + s_out[0] * y;
+                const double sy = fy[y];
+                const bool y_in = (sy + 0.5 >= 0 && sy + 0.5 < ny_s);
+                for (int x = 0; x < nx; x++) {
+                    const double sx = fx[x];
+                    double v = 0.;
+                    if (y_in && sx + 0.5 >= 0 && sx + 0.5 < nx_s) {
+                        if (order == 0)
+                            v = *(double*)(plane + s_in[0] * int(sy + 0.5) +
+                                           s_in[1] * int(sx + 0.5));
+                        else
+                            v = interp_bilinear(plane, s_in, ny_s, nx_s, sy, sx);
+                    }
+                    *(double*)(out_row + s_out[1] * x) = v;
+                }
+            }
+        }
+    }
+    return output;
+}
+
+
 
 
 /** Accumulator - transfer signal from map domain to time domain.
@@ -439,18 +814,65 @@ bool Accumulator<SpinClass>::TestInputs(
             signal, "signal", FSIGNAL_NPY_TYPE, n_det, n_time);
     }
 
-    // Insist that user passed in None for the weights.
+    // The optional per-detector polarization calibration, an array of
+    // (efficiency, angle offset) pairs; stored as the coefficients of
+    // the rotation and scaling of (cos 2 phi, sin 2 phi).
+    _pol_cal.clear();
     if (weight.ptr() != Py_None) {
-        throw shape_exception("weight", "must be None");
+        BufferWrapper wbuf;
+        if (PyObject_GetBuffer(weight.ptr(), &wbuf.view,
+                               PyBUF_RECORDS) == -1) {
+            PyErr_Clear();
+            throw buffer_exception("weight");
+        }
+        if (wbuf.view.ndim != 2 || wbuf.view.shape[0] != n_det ||
+            wbuf.view.shape[1] != 2)
+            throw shape_exception("weight", "must be None or the (n_det,2) "
+                                  "polarization calibration, of (efficiency, "
+                                  "angle offset) per detector");
+        if (strcmp(wbuf.view.format, "d") != 0)
+            throw dtype_exception("weight", "float64 (polarization calibration)");
+        _pol_cal.resize(2 * n_det);
+        for (int i_det = 0; i_det < n_det; i_det++) {
+            const char *row = (char*)wbuf.view.buf + wbuf.view.strides[0] * i_det;
+            const double eff = *(double*)row;
+            const double ang = *(double*)(row + wbuf.view.strides[1]);
+            _pol_cal[2 * i_det] = eff * cos(2 * ang);
+            _pol_cal[2 * i_det + 1] = eff * sin(2 * ang);
+        }
     }
 
     return true;
 }
 
+/* The polarization response of detector i_det is rotated by twice
+ * its angle offset and scaled by its efficiency, if a calibration was
+ * passed (and i_det >= 0). */
+
+template <typename SpinClass>
+inline
+void Accumulator<SpinClass>::PolWeight(
+    const int i_det, const double* coords, FSIGNAL *pwt)
+{
+    const double c = coords[2];
+    const double s = coords[3];
+    const double cos2 = c*c - s*s;
+    const double sin2 = 2*c*s;
+    if (_pol_cal.size() == 0 || i_det < 0) {
+        pwt[0] = cos2;
+        pwt[1] = sin2;
+        return;
+    }
+    const double a = _pol_cal[2 * i_det];
+    const double b = _pol_cal[2 * i_det + 1];
+    pwt[0] = a * cos2 - b * sin2;
+    pwt[1] = a * sin2 + b * cos2;
+}
+
 template <>
 inline
 void Accumulator<SpinT>::PixelWeight(
-    const double* coords, FSIGNAL *pwt)
+    const int i_det, const double* coords, FSIGNAL *pwt)
 {
     pwt[0] = 1;
 }
@@ -458,24 +880,18 @@ void Accumulator<SpinT>::PixelWeight(
 template <>
 inline
 void Accumulator<SpinQU>::PixelWeight(
-    const double* coords, FSIGNAL *pwt)
+    const int i_det, const double* coords, FSIGNAL *pwt)
 {
-    const double c = coords[2];
-    const double s = coords[3];
-    pwt[0] = c*c - s*s;
-    pwt[1] = 2*c*s;
+    PolWeight(i_det, coords, pwt);
 }
 
 template<>
 inline
 void Accumulator<SpinTQU>::PixelWeight(
-    const double* coords, FSIGNAL *pwt)
+    const int i_det, const double* coords, FSIGNAL *pwt)
 {
-    const double c = coords[2];
-    const double s = coords[3];
     pwt[0] = 1.;
-    pwt[1] = c*c - s*s;
-    pwt[2] = 2*c*s;
+    PolWeight(i_det, coords, pwt + 1);
 }
 
 template <typename SpinClass>
@@ -489,7 +905,7 @@ void Accumulator<SpinClass>::Forward(
                           _signalspace->steps[0]*i_time);
     const int N = SpinClass::comp_count;
     FSIGNAL wt[N];
-    PixelWeight(coords, wt);
+    PixelWeight(i_det, coords, wt);
     for (int imap=0; imap<N; ++imap) {
         *(double*)((char*)_mapbuf.view.buf +
                    _mapbuf.view.strides[0]*imap +
@@ -506,7 +922,7 @@ void Accumulator<SpinClass>::ForwardWeight(
     if (pixel_offset < 0) return;
     const int N = SpinClass::comp_count;
     FSIGNAL wt[N];
-    PixelWeight(coords, wt);
+    PixelWeight(i_det, coords, wt);
     for (int imap=0; imap<N; ++imap) {
         for (int jmap=imap; jmap<N; ++jmap) {
             *(double*)((char*)_mapbuf.view.buf +
@@ -526,7 +942,7 @@ void Accumulator<SpinClass>::Reverse(
     if (pixel_offset < 0) return;
     const int N = SpinClass::comp_count;
     FSIGNAL wt[N];
-    PixelWeight(coords, wt);
+    PixelWeight(i_det, coords, wt);
     double _sig = 0.;
     for (int imap=0; imap<N; ++imap) {
         _sig += *(double*)((char*)_mapbuf.view.buf +
@@ -535,7 +951,138 @@ void Accumulator<SpinClass>::Reverse(
     }
     FSIGNAL *sig = (_signalspace->data_ptr[i_det] +
                     _signalspace->steps[0]*i_time);
-    *sig += _sig;
+    *sig += scale * _sig;
+}
+
+/* For detector pairs, the intensity map is made from the pair sum
+ * and the polarization maps from the pair difference. */
+
+template <>
+inline
+void Accumulator<SpinT>::PairSignal(
+    const FSIGNAL sum, const FSIGNAL diff, FSIGNAL *sig)
+{
+    sig[0] = sum;
+}
+
+template <>
+inline
+void Accumulator<SpinQU>::PairSignal(
+    const FSIGNAL sum, const FSIGNAL diff, FSIGNAL *sig)
+{
+    sig[0] = diff;
+    sig[1] = diff;
+}
+
+template <>
+inline
+void Accumulator<SpinTQU>::PairSignal(
+    const FSIGNAL sum, const FSIGNAL diff, FSIGNAL *sig)
+{
+    sig[0] = sum;
+    sig[1] = diff;
+    sig[2] = diff;
+}
+
+/* Accumulate the half-sum and half-difference of detectors i_a and
+ * i_b, with the pointing (and polarization angle) of the pair.  If i_b
+ * < 0, detector i_a is taken alone, with its own pointing; it then
+ * contributes its full signal to every component, so that the maps of
+ * A and B add up to the pair sum and difference (the B detector's
+ * angle being orthogonal to A's) and are normalized by the weights of
+ * the individual detectors. */
+
+template <typename SpinClass>
+inline
+void Accumulator<SpinClass>::ForwardPair(
+    const int i_a, const int i_b, const int i_time,
+    const int pixel_offset, const double* coords)
+{
+    if (pixel_offset < 0) return;
+    const FSIGNAL a = *(_signalspace->data_ptr[i_a] +
+                        _signalspace->steps[0]*i_time);
+    const int N = SpinClass::comp_count;
+    FSIGNAL wt[N], sig[N];
+    // No polarization calibration (see to_map_pairs).
+    PixelWeight(-1, coords, wt);
+    if (i_b < 0) {
+        PairSignal(a, a, sig);
+    } else {
+        const FSIGNAL b = *(_signalspace->data_ptr[i_b] +
+                            _signalspace->steps[0]*i_time);
+        PairSignal((a + b) / 2, (a - b) / 2, sig);
+    }
+    for (int imap=0; imap<N; ++imap) {
+        *(double*)((char*)_mapbuf.view.buf +
+                   _mapbuf.view.strides[0]*imap +
+                   pixel_offset) += sig[imap] * wt[imap];
+    }
+}
+
+
+/** HitCounter - integer hit accumulation, optionally per detector
+ *  group.
+ */
+
+// Buffer format codes of the supported hits map types.
+template <typename DTYPE> const char *hits_format();
+template <> const char *hits_format<int32_t>() { return "i"; }
+template <> const char *hits_format<uint16_t>() { return "H"; }
+
+template <typename DTYPE>
+bool HitCounter<DTYPE>::TestInputs(
+    bp::object &map, bp::object &pbore, bp::object &pdet,
+    bp::object &signal, bp::object &weight)
+{
+    if (PyObject_GetBuffer(map.ptr(), &_mapbuf.view,
+                           PyBUF_RECORDS) == -1) {
+        PyErr_Clear();
+        throw buffer_exception("map");
+    }
+    if (strcmp(_mapbuf.view.format, hits_format<DTYPE>()) != 0)
+        throw dtype_exception("map", "int32 or uint16");
+    if (_mapbuf.view.ndim < 2 || _mapbuf.view.ndim > 3)
+        throw shape_exception("map", "must have shape ([n_group,]n_y,n_x)");
+    int n_group = 1;
+    if (_mapbuf.view.ndim == 3)
+        n_group = _mapbuf.view.shape[0];
+
+    // Byte offset to the plane for each detector; -1 to skip.
+    _plane_offsets.assign(n_det, 0);
+    if (!isNone(groups)) {
+        BufferWrapper gbuf;
+        if (PyObject_GetBuffer(groups.ptr(), &gbuf.view,
+                               PyBUF_RECORDS) == -1) {
+            PyErr_Clear();
+            throw buffer_exception("groups");
+        }
+        if (gbuf.view.ndim != 1 || gbuf.view.shape[0] != n_det)
+            throw shape_exception("groups", "must have shape (n_det,)");
+        if (strcmp(gbuf.view.format, "i") != 0)
+            throw dtype_exception("groups", "int32");
+        if (_mapbuf.view.ndim != 3)
+            throw shape_exception("map", "must have shape (n_group,n_y,n_x)");
+        for (int i_det=0; i_det<n_det; i_det++) {
+            int g = *(int32_t*)((char*)gbuf.view.buf +
+                                gbuf.view.strides[0] * i_det);
+            if (g >= n_group)
+                throw shape_exception("map", "must have n_group > max(groups)");
+            _plane_offsets[i_det] = (g < 0) ? -1 : _mapbuf.view.strides[0] * g;
+        }
+    } else if (n_group != 1)
+        throw shape_exception("map", "must have n_group=1 if groups is None");
+
+    return true;
+}
+
+template <typename DTYPE>
+inline
+void HitCounter<DTYPE>::Forward(
+    const int i_det, const int i_time, const int pixel_offset)
+{
+    if (pixel_offset < 0) return;
+    *(DTYPE*)((char*)_mapbuf.view.buf + _plane_offsets[i_det] +
+              pixel_offset) += 1;
 }
 
 
@@ -628,68 +1175,372 @@ SignalSpace<DTYPE>::SignalSpace(
 }
 
 
-/** to_map(map, qpoint, pofs, signal, weights)
- *
- *  Each argument is an ndarray.  In the general case the dimensionalities are:
- *
- *     map:      (n_map, ny, nx, ...)
- *     pbore:    (n_t, n_coord)
- *     pofs:     (n_det, n_coord)
- *     signal:   (n_det, n_t)
- *     weight:   (n_det, n_map)
- *
- *  Notes:
- *
- *  - The map dimensions (ny, nx, ...) are meant to be general enough
- *    to also capture 1-dimensional pixelization systems (such as
- *    healpix), or higher dimensional grids, e.g., (nz, ny, nx).
- *
- *  - Normally we will have n_coord=4.  In the special case of a Flat
- *    (2-d cartesian) projection space with no detector orientation
- *    information, n_coord=2.
- *
- */
+/* Decode the thread_intervals argument of the *_omp methods -- a
+ * nested sequence of Ranges, indexed by [i_domain][i_det] -- into a
+ * flat list of work items, (i_det, start, stop), for each domain.
+ * Detectors with no samples in a domain do not appear in its list, so
+ * the threads don't waste time looping over them.  The items are then
+ * cut into blocks of time_block samples and ordered block by block
+ * (see DetTimeTiles, below). */
 
-template<typename P, typename Z, typename A>
-ProjectionEngine<P,Z,A>::ProjectionEngine(Z pixelizor)
+struct OmpWorkItem {
+    int i_det;
+    int start;
+    int stop;
+};
+
+static
+void split_time_blocks(vector<OmpWorkItem> &items, int time_block)
 {
-    _pixelizor = pixelizor;
+    vector<OmpWorkItem> split;
+    for (auto const &item: items) {
+        for (int start = item.start; start < item.stop; ) {
+            int stop = item.stop;
+            const int block_end = (start / time_block + 1) * time_block;
+            if (block_end > start && block_end < stop)
+                stop = block_end;
+            split.push_back({item.i_det, start, stop});
+            start = stop;
+        }
+    }
+    // Within a block, the items stay in detector order.
+    std::stable_sort(split.begin(), split.end(),
+                     [time_block](const OmpWorkItem &a, const OmpWorkItem &b) {
+                         return a.start / time_block < b.start / time_block;
+                     });
+    items.swap(split);
 }
 
-template<typename P, typename Z, typename A>
-bp::object ProjectionEngine<P,Z,A>::to_map(
-    bp::object map, bp::object pbore, bp::object pofs, bp::object signal, bp::object weight)
+static
+vector<vector<OmpWorkItem>> extract_thread_intervals(bp::object &thread_intervals,
+                                                     int n_det, int time_block)
 {
-    //Initialize it / check inputs.
-    auto pointer = P();
-    pointer.TestInputs(map, pbore, pofs, signal, weight);
-    int n_det = pointer.DetCount();
-    int n_time = pointer.TimeCount();
+    vector<vector<OmpWorkItem>> work;
 
-    auto accumulator = A(true, true, false, n_det, n_time);
+    // Descend two levels.. don't assume it's a list, just that it has
+    // len and [].
+    for (int i=0; i<bp::len(thread_intervals); i++) {
+        bp::object ival_list = thread_intervals[i];
+        if (bp::len(ival_list) != n_det)
+            throw shape_exception("thread_intervals",
+                                  "must have shape (n_domain,n_det)");
+        vector<OmpWorkItem> v;
+        for (int j=0; j<n_det; j++) {
+            RangesInt32 &r = bp::extract<RangesInt32&>(ival_list[j])();
+            for (auto const &seg: r.segments)
+                v.push_back({j, seg.first, seg.second});
+        }
+        split_time_blocks(v, time_block);
+        work.push_back(v);
+    }
+    return work;
+}
+
+/* DetTimeTiles - the order in which the sample loops visit the
+ * (detector, time) plane.
+ *
+ * All detectors are pointed from the same boresight samples, so
+ * rather than running through all of the samples of one detector
+ * before starting the next (which streams the whole boresight array
+ * through the cache once per detector), the loops take a block of
+ * time_block samples and process it for every detector, and then move
+ * on to the next block.
+ *
+ * For the det-parallel loops, the plane is first cut into tiles --
+ * a group of detectors by a chunk of samples -- which are shared out
+ * between the threads.  With at least as many detectors as threads,
+ * there is one group of detectors per thread and one chunk; with
+ * fewer (e.g. the boresight alone), each detector is its own group
+ * and its samples are split into about 4*n_thread/n_det chunks of at
+ * least TIME_CHUNK_MIN samples, so that all threads have work.
+ * Single-threaded loops use a single tile.
+ */
+
+#define TIME_BLOCK_DEFAULT 4096
+#define TIME_CHUNK_MIN 1024
+
+struct DetTimeTiles {
+    DetTimeTiles(int n_det, int n_time, int time_block, int n_thread,
+                 bool split_time=true);
+    int Count() const { return n_group * n_chunk; }
+    void Get(int i_tile, int &det0, int &det1, int &time0, int &time1) const;
+    long Size(int i_tile) const;
+    // Calls f(i_det, start, stop) for each detector and block of
+    // samples in the tile, block by block.
+    template <typename F>
+    void Visit(int i_tile, F f) const;
+
+    int n_det;
+    int n_time;
+    int block;
+    int n_group;
+    int n_chunk;
+};
+
+DetTimeTiles::DetTimeTiles(int n_det, int n_time, int time_block,
+                           int n_thread, bool split_time)
+    : n_det(n_det), n_time(n_time), block(time_block),
+      n_group(1), n_chunk(1)
+{
+    if (n_thread > 1) {
+        n_group = std::min(n_det, n_thread);
+        if (split_time && n_det < n_thread) {
+            n_chunk = (4 * n_thread + n_det - 1) / n_det;
+            n_chunk = std::max(1, std::min(n_chunk, n_time / TIME_CHUNK_MIN));
+        }
+    }
+    if (n_det == 0)
+        n_group = 0;
+}
+
+void DetTimeTiles::Get(int i_tile, int &det0, int &det1,
+                       int &time0, int &time1) const
+{
+    const int i_group = i_tile / n_chunk;
+    const int i_chunk = i_tile % n_chunk;
+    det0 = (long)n_det * i_group / n_group;
+    det1 = (long)n_det * (i_group + 1) / n_group;
+    time0 = (long)n_time * i_chunk / n_chunk;
+    time1 = (long)n_time * (i_chunk + 1) / n_chunk;
+}
+
+long DetTimeTiles::Size(int i_tile) const
+{
+    int det0, det1, time0, time1;
+    Get(i_tile, det0, det1, time0, time1);
+    return (long)(det1 - det0) * (time1 - time0);
+}
+
+template <typename F>
+void DetTimeTiles::Visit(int i_tile, F f) const
+{
+    int det0, det1, time0, time1;
+    Get(i_tile, det0, det1, time0, time1);
+    for (int start = time0; start < time1; ) {
+        const int stop = (time1 - start > block) ? start + block : time1;
+        for (int i_det = det0; i_det < det1; ++i_det)
+            f(i_det, start, stop);
+        start = stop;
+    }
+}
+
+
+/** ProjectionStats
+ */
+
+void ProjectionStats::Start(std::string method)
+{
+    if (!enabled)
+        return;
+    _method = method;
+    _t0 = omp_get_wtime();
+}
+
+void ProjectionStats::StartLoop(int n_threads)
+{
+    if (!enabled)
+        return;
+    _t_inputs = omp_get_wtime() - _t0;
+    t_thread.assign(n_threads, 0.);
+    n_samples.assign(n_threads, 0);
+    n_offmaps.assign(n_threads, 0);
+    _t0 = omp_get_wtime();
+}
+
+void ProjectionStats::EndLoop()
+{
+    if (!enabled)
+        return;
+    _t_loop = omp_get_wtime() - _t0;
+}
+
+bp::object ProjectionStats::ToDict() const
+{
+    if (!enabled || _method.size() == 0)
+        return bp::object();
+    bp::dict output;
+    bp::list times, samples;
+    double t_sum = 0.;
+    long n_samp = 0, n_off = 0;
+    for (int i = 0; i < t_thread.size(); i++) {
+        times.append(t_thread[i]);
+        samples.append(n_samples[i]);
+        t_sum += t_thread[i];
+        n_samp += n_samples[i];
+        n_off += n_offmaps[i];
+    }
+    output["method"] = _method;
+    output["t_inputs"] = _t_inputs;
+    output["t_loop"] = _t_loop;
+    output["n_threads"] = t_thread.size();
+    output["thread_time"] = times;
+    output["thread_samples"] = samples;
+    output["n_samples"] = n_samp;
+    output["n_offmap"] = n_off;
+    // The fraction of the loop's thread-time spent doing work.
+    double efficiency = 0.;
+    if (_t_loop > 0 && t_thread.size() > 0)
+        efficiency = t_sum / (_t_loop * t_thread.size());
+    output["efficiency"] = efficiency;
+    return output;
+}
+
+// The per-sample loop shared by the projection methods: computes
+// the coordinates and pixel of each sample in [start, stop) and
+// passes them to body(i_time, pixel_offset, coords).  The off-map
+// samples are only counted when count_offmap is set, so that the
+// loop carries no profiling overhead otherwise.
+template<bool count_offmap, typename P, typename Z, typename F>
+static inline long _project_samples(
+    P &pointer, Z &pixelizor, int i_det, double *dofs,
+    int start, int stop, F &&body)
+{
+    long n_offmap = 0;
+    for (int i_time = start; i_time < stop; ++i_time) {
+        double coords[4];
+        int pixel_offset;
+        pointer.GetCoords(i_det, i_time, dofs, (double*)coords);
+        pixel_offset = pixelizor.GetPixel(i_det, i_time, (double*)coords);
+        if (count_offmap)
+            n_offmap += (pixel_offset < 0);
+        body(i_time, pixel_offset, (double*)coords);
+    }
+    return n_offmap;
+}
+
+template<typename P, typename Z, typename F>
+static inline long project_samples(
+    bool count_offmap, P &pointer, Z &pixelizor, int i_det, double *dofs,
+    int start, int stop, F &&body)
+{
+    if (count_offmap)
+        return _project_samples<true>(pointer, pixelizor, i_det, dofs,
+                                      start, stop, body);
+    return _project_samples<false>(pointer, pixelizor, i_det, dofs,
+                                   start, stop, body);
+}
+
+template<typename P, typename Z, typename A>
+ProjectionEngine<P,Z,A>::ProjectionEngine(Z pixelizor, bool fast_math)
+{
+    _pixelizor = pixelizor;
+    _fast_math = fast_math;
+    _time_block = 0;
+}
+
+template<typename P, typename Z, typename A>
+void ProjectionEngine<P,Z,A>::set_time_block(int time_block)
+{
+    if (time_block < 0)
+        throw general_agreement_exception("time_block must be >= 0.");
+    _time_block = time_block;
+}
+
+template<typename P, typename Z, typename A>
+int ProjectionEngine<P,Z,A>::_TimeBlock() const
+{
+    return _time_block > 0 ? _time_block : TIME_BLOCK_DEFAULT;
+}
+
+// The stats of the last call are shared by all threads calling into
+// an engine; this guards storing and reading them.
+static std::mutex stats_mutex;
+
+template<typename P, typename Z, typename A>
+void ProjectionEngine<P,Z,A>::_StoreStats(const ProjectionStats &stats)
+{
+    std::lock_guard<std::mutex> lock(stats_mutex);
+    _last_stats = stats;
+}
+
+template<typename P, typename Z, typename A>
+bp::object ProjectionEngine<P,Z,A>::get_stats()
+{
+    ProjectionStats stats;
+    {
+        std::lock_guard<std::mutex> lock(stats_mutex);
+        stats = _last_stats;
+    }
+    return stats.ToDict();
+}
+
+/** to_map(map, qpoint, pofs, signal, weights)
+ *
+ *  Each argument is an ndarray.  In the general case the dimensionalities are:
+ *
+ *     map:      (n_map, ny, nx, ...)
+ *     pbore:    (n_t, n_coord)
+ *     pofs:     (n_det, n_coord)
+ *     signal:   (n_det, n_t)
+ *     weight:   None, or (n_det, 2) float64
+ *
+ *  The weight argument, if not None, holds the polarization
+ *  calibration of each detector: its efficiency and its polarization
+ *  angle offset (in radians).
+ *
+ *  Notes:
+ *
+ *  - The map dimensions (ny, nx, ...) are meant to be general enough
+ *    to also capture 1-dimensional pixelization systems (such as
+ *    healpix), or higher dimensional grids, e.g., (nz, ny, nx).
+ *
+ *  - Normally we will have n_coord=4.  In the special case of a Flat
+ *    (2-d cartesian) projection space with no detector orientation
+ *    information, n_coord=2.
+ *
+ */
+
+template<typename P, typename Z, typename A>
+bp::object ProjectionEngine<P,Z,A>::to_map(
+    bp::object map, bp::object pbore, bp::object pofs, bp::object signal, bp::object weight)
+{
+    Z pixelizor = _pixelizor;
+    ProjectionStats stats;
+    stats.enabled = _profile;
+    stats.Start("to_map");
+
+    //Initialize it / check inputs.
+    auto pointer = P();
+    pointer.fast_math = _fast_math;
+    pointer.TestInputs(map, pbore, pofs, signal, weight);
+    int n_det = pointer.DetCount();
+    int n_time = pointer.TimeCount();
+
+    auto accumulator = A(true, true, false, n_det, n_time);
 
     //Do we need a map?  Now is the time.
     if (isNone(map)) {
         int n_comp = accumulator.ComponentCount();
-        map = _pixelizor.zeros(n_comp);
+        map = pixelizor.zeros(n_comp);
     }
 
-    _pixelizor.TestInputs(map, pbore, pofs, signal, weight);
+    pixelizor.TestInputs(map, pbore, pofs, signal, weight);
     accumulator.TestInputs(map, pbore, pofs, signal, weight);
 
-    for (int i_det = 0; i_det < n_det; ++i_det) {
-        double dofs[4];
-        pointer.InitPerDet(i_det, dofs);
-        for (int i_time = 0; i_time < n_time; ++i_time) {
-            double coords[4];
-            FSIGNAL weights[4];
-            int pixel_offset;
-            pointer.GetCoords(i_det, i_time, (double*)dofs, (double*)coords);
-            pixel_offset = _pixelizor.GetPixel(i_det, i_time, (double*)coords);
-            accumulator.Forward(i_det, i_time, pixel_offset, coords, weights);
+    auto tiles = DetTimeTiles(n_det, n_time, _TimeBlock(), 1);
+
+    stats.StartLoop(1);
+    {
+        ReleaseGIL _nogil;
+        for (int i_tile = 0; i_tile < tiles.Count(); ++i_tile) {
+            double t_start = stats.Now();
+            long n_offmap = 0;
+            tiles.Visit(i_tile, [&](int i_det, int start, int stop) {
+                double dofs[4];
+                pointer.InitPerDet(i_det, dofs);
+                n_offmap += project_samples(
+                    stats.enabled, pointer, pixelizor, i_det, dofs, start, stop,
+                    [&](int i_time, int pixel_offset, double *coords) {
+                        FSIGNAL weights[4];
+                        accumulator.Forward(i_det, i_time, pixel_offset, coords, weights);
+                    });
+            });
+            stats.AddWork(t_start, tiles.Size(i_tile), n_offmap);
         }
     }
+    stats.EndLoop();
 
+    _StoreStats(stats);
     return map;
 }
 
@@ -698,10 +1549,15 @@ bp::object ProjectionEngine<P,Z,A>::to_map_omp(
     bp::object map, bp::object pbore, bp::object pofs, bp::object signal, bp::object weight,
     bp::object thread_intervals)
 {
+    Z pixelizor = _pixelizor;
     auto _none = bp::object();
+    ProjectionStats stats;
+    stats.enabled = _profile;
+    stats.Start("to_map_omp");
 
     //Initialize it / check inputs.
     auto pointer = P();
+    pointer.fast_math = _fast_math;
     pointer.TestInputs(map, pbore, pofs, signal, weight);
     int n_det = pointer.DetCount();
     int n_time = pointer.TimeCount();
@@ -711,46 +1567,51 @@ bp::object ProjectionEngine<P,Z,A>::to_map_omp(
     //Do we need a map?  Now is the time.
     if (isNone(map)) {
         int n_comp = accumulator.ComponentCount();
-        map = _pixelizor.zeros(n_comp);
+        map = pixelizor.zeros(n_comp);
     }
 
-    _pixelizor.TestInputs(map, pbore, pofs, signal, weight);
+    pixelizor.TestInputs(map, pbore, pofs, signal, weight);
     accumulator.TestInputs(map, pbore, pofs, signal, weight);
 
-    // Indexed by i_thread, i_det.
-    vector<vector<RangesInt32>> ivals;
+    // Indexed by i_domain; (i_det, start, stop) items.
+    auto work = extract_thread_intervals(thread_intervals, n_det, _TimeBlock());
 
-    // Descend two levels.. don't assume it's a list, just that it has
-    // len and [].
-    for (int i=0; i<bp::len(thread_intervals); i++) {
-        bp::object ival_list = thread_intervals[i];
-        vector<RangesInt32> v(bp::len(ival_list));
-        for (int j=0; j<bp::len(ival_list); j++)
-            v[j] = bp::extract<RangesInt32>(ival_list[j])();
-        ivals.push_back(v);
-    }
-
-#pragma omp parallel
+    stats.StartLoop(so3g_get_num_threads());
     {
-        // The principle here is that all threads loop over all
-        // detectors, but the sample ranges encoded in ivals are
-        // disjoint.
-        const int i_thread = omp_get_thread_num();
-        for (int i_det = 0; i_det < n_det; ++i_det) {
+        ReleaseGIL _nogil;
+        ThreadPin _pin;
+        // The principle here is that the sample ranges in each
+        // domain, work[i_dom], map to a set of pixels disjoint from
+        // those of other domains.  Domains are handed out to the
+        // threads dynamically, so the number of domains need not
+        // match the number of threads (and using several domains per
+        // thread helps to balance the load).
+#pragma omp parallel for schedule(dynamic) num_threads(so3g_get_num_threads()) \
+    firstprivate(_pin)
+        for (int i_dom = 0; i_dom < work.size(); ++i_dom) {
+            double t_start = stats.Now();
+            long n_samp = 0, n_offmap = 0;
+            int last_det = -1;
             double dofs[4];
-            pointer.InitPerDet(i_det, dofs);
-            for (auto const &rng: ivals[i_thread][i_det].segments) {
-                for (int i_time = rng.first; i_time < rng.second; ++i_time) {
-                    double coords[4];
-                    FSIGNAL weights[4];
-                    int pixel_offset;
-                    pointer.GetCoords(i_det, i_time, (double*)dofs, (double*)coords);
-                    pixel_offset = _pixelizor.GetPixel(i_det, i_time, (double*)coords);
-                    accumulator.Forward(i_det, i_time, pixel_offset, coords, weights);
+            for (auto const &item: work[i_dom]) {
+                n_samp += item.stop - item.start;
+                const int i_det = item.i_det;
+                if (i_det != last_det) {
+                    pointer.InitPerDet(i_det, dofs);
+                    last_det = i_det;
                 }
+                n_offmap += project_samples(
+                    stats.enabled, pointer, pixelizor, i_det, dofs, item.start, item.stop,
+                    [&](int i_time, int pixel_offset, double *coords) {
+                        FSIGNAL weights[4];
+                        accumulator.Forward(i_det, i_time, pixel_offset, coords, weights);
+                    });
             }
+            stats.AddWork(t_start, n_samp, n_offmap);
         }
     }
+    stats.EndLoop();
+    _StoreStats(stats);
     return map;
 }
 
@@ -758,8 +1619,14 @@ template<typename P, typename Z, typename A>
 bp::object ProjectionEngine<P,Z,A>::to_weight_map(
     bp::object map, bp::object pbore, bp::object pofs, bp::object signal, bp::object weight)
 {
+    Z pixelizor = _pixelizor;
+    ProjectionStats stats;
+    stats.enabled = _profile;
+    stats.Start("to_weight_map");
+
     //Initialize it / check inputs.
     auto pointer = P();
+    pointer.fast_math = _fast_math;
     pointer.TestInputs(map, pbore, pofs, signal, weight);
     int n_det = pointer.DetCount();
     int n_time = pointer.TimeCount();
@@ -769,7 +1636,7 @@ bp::object ProjectionEngine<P,Z,A>::to_weight_map(
     //Do we need a map?  Now is the time.
     if (isNone(map)) {
         int n_comp = accumulator.ComponentCount();
-        map = _pixelizor.zeros(n_comp * n_comp);
+        map = pixelizor.zeros(n_comp * n_comp);
         auto v0 = (PyArrayObject*)map.ptr();
         npy_intp dims[32] = {n_comp, n_comp};
         int dimi = 2;
@@ -780,23 +1647,33 @@ bp::object ProjectionEngine<P,Z,A>::to_weight_map(
         map = bp::object(bp::handle<>(v1));
     }
 
-    _pixelizor.TestInputs(map, pbore, pofs, signal, weight);
+    pixelizor.TestInputs(map, pbore, pofs, signal, weight);
     accumulator.TestInputs(map, pbore, pofs, signal, weight);
 
-    for (int i_det = 0; i_det < n_det; ++i_det) {
-        // pointer.InitPerDet(i_det);
-        double dofs[4];
-        pointer.InitPerDet(i_det, dofs);
-        for (int i_time = 0; i_time < n_time; ++i_time) {
-            double coords[4];
-            FSIGNAL weights[4];
-            int pixel_offset;
-            pointer.GetCoords(i_det, i_time, (double*)dofs, (double*)coords);
-            pixel_offset = _pixelizor.GetPixel(i_det, i_time, (double*)coords);
-            accumulator.ForwardWeight(i_det, i_time, pixel_offset, coords, weights);
+    auto tiles = DetTimeTiles(n_det, n_time, _TimeBlock(), 1);
+
+    stats.StartLoop(1);
+    {
+        ReleaseGIL _nogil;
+        for (int i_tile = 0; i_tile < tiles.Count(); ++i_tile) {
+            double t_start = stats.Now();
+            long n_offmap = 0;
+            tiles.Visit(i_tile, [&](int i_det, int start, int stop) {
+                double dofs[4];
+                pointer.InitPerDet(i_det, dofs);
+                n_offmap += project_samples(
+                    stats.enabled, pointer, pixelizor, i_det, dofs, start, stop,
+                    [&](int i_time, int pixel_offset, double *coords) {
+                        FSIGNAL weights[4];
+                        accumulator.ForwardWeight(i_det, i_time, pixel_offset, coords, weights);
+                    });
+            });
+            stats.AddWork(t_start, tiles.Size(i_tile), n_offmap);
         }
     }
+    stats.EndLoop();
 
+    _StoreStats(stats);
     return map;
 }
 
@@ -805,10 +1682,15 @@ bp::object ProjectionEngine<P,Z,A>::to_weight_map_omp(
     bp::object map, bp::object pbore, bp::object pofs, bp::object signal, bp::object weight,
     bp::object thread_intervals)
 {
+    Z pixelizor = _pixelizor;
     auto _none = bp::object();
+    ProjectionStats stats;
+    stats.enabled = _profile;
+    stats.Start("to_weight_map_omp");
 
     //Initialize it / check inputs.
     auto pointer = P();
+    pointer.fast_math = _fast_math;
     pointer.TestInputs(map, pbore, pofs, signal, weight);
     int n_det = pointer.DetCount();
     int n_time = pointer.TimeCount();
@@ -818,7 +1700,7 @@ bp::object ProjectionEngine<P,Z,A>::to_weight_map_omp(
     //Do we need a map?  Now is the time.
     if (isNone(map)) {
         int n_comp = accumulator.ComponentCount();
-        map = _pixelizor.zeros(n_comp * n_comp);
+        map = pixelizor.zeros(n_comp * n_comp);
         auto v0 = (PyArrayObject*)map.ptr();
         npy_intp dims[32] = {n_comp, n_comp};
         int dimi = 2;
@@ -829,53 +1711,373 @@ bp::object ProjectionEngine<P,Z,A>::to_weight_map_omp(
         map = bp::object(bp::handle<>(v1));
     }
 
-    _pixelizor.TestInputs(map, pbore, pofs, signal, weight);
+    pixelizor.TestInputs(map, pbore, pofs, signal, weight);
     accumulator.TestInputs(map, pbore, pofs, signal, weight);
 
-    // Indexed by i_thread, i_det.
-    vector<vector<RangesInt32>> ivals;
+    // Indexed by i_domain; (i_det, start, stop) items.
+    auto work = extract_thread_intervals(thread_intervals, n_det, _TimeBlock());
 
-    // Descend two levels.. don't assume it's a list, just that it has
-    // len and [].
-    for (int i=0; i<bp::len(thread_intervals); i++) {
-        bp::object ival_list = thread_intervals[i];
-        vector<RangesInt32> v(bp::len(ival_list));
-        for (int j=0; j<bp::len(ival_list); j++)
-            v[j] = bp::extract<RangesInt32>(ival_list[j])();
-        ivals.push_back(v);
+    stats.StartLoop(so3g_get_num_threads());
+    {
+        ReleaseGIL _nogil;
+        ThreadPin _pin;
+        // The principle here is that the sample ranges in each
+        // domain, work[i_dom], map to a set of pixels disjoint from
+        // those of other domains.  Domains are handed out to the
+        // threads dynamically, so the number of domains need not
+        // match the number of threads (and using several domains per
+        // thread helps to balance the load).
+#pragma omp parallel for schedule(dynamic) num_threads(so3g_get_num_threads()) \
+    firstprivate(_pin)
+        for (int i_dom = 0; i_dom < work.size(); ++i_dom) {
+            double t_start = stats.Now();
+            long n_samp = 0, n_offmap = 0;
+            int last_det = -1;
+            double dofs[4];
+            for (auto const &item: work[i_dom]) {
+                n_samp += item.stop - item.start;
+                const int i_det = item.i_det;
+                if (i_det != last_det) {
+                    pointer.InitPerDet(i_det, dofs);
+                    last_det = i_det;
+                }
+                n_offmap += project_samples(
+                    stats.enabled, pointer, pixelizor, i_det, dofs, item.start, item.stop,
+                    [&](int i_time, int pixel_offset, double *coords) {
+                        FSIGNAL weights[4];
+                        accumulator.ForwardWeight(i_det, i_time, pixel_offset, coords, weights);
+                    });
+            }
+            stats.AddWork(t_start, n_samp, n_offmap);
+        }
     }
+    stats.EndLoop();
+
+    _StoreStats(stats);
+    return map;
+}
+
+/** to_hits(map, pbore, pofs, groups)
+ *
+ *  Accumulate hit counts into an integer map.  The map must be int32
+ *  or uint16; if None, an int32 map is created.  If groups is not
+ *  None, it must be an int32 vector with one entry per detector,
+ *  giving the index of the map plane (axis 0) into which that
+ *  detector's hits are accumulated (or -1 to exclude the detector).
+ *  Note that uint16 counts wrap silently on overflow.
+ */
+
+template<typename P, typename Z, typename A>
+template<typename DTYPE>
+void ProjectionEngine<P,Z,A>::_to_hits(
+    bp::object &map, bp::object &pbore, bp::object &pofs,
+    bp::object &groups, bp::object &thread_intervals)
+{
+    Z pixelizor = _pixelizor;
+    auto _none = bp::object();
+
+    auto pointer = P();
+    pointer.fast_math = _fast_math;
+    pointer.TestInputs(map, pbore, pofs, _none, _none);
+    int n_det = pointer.DetCount();
+    int n_time = pointer.TimeCount();
+
+    auto counter = HitCounter<DTYPE>(groups, n_det);
+    pixelizor.TestInputs(map, pbore, pofs, _none, _none);
+    counter.TestInputs(map, pbore, pofs, _none, _none);
+
+    if (isNone(thread_intervals)) {
+        auto tiles = DetTimeTiles(n_det, n_time, _TimeBlock(), 1);
+        ReleaseGIL _nogil;
+        for (int i_tile = 0; i_tile < tiles.Count(); ++i_tile) {
+            tiles.Visit(i_tile, [&](int i_det, int start, int stop) {
+                if (counter.Skip(i_det))
+                    return;
+                double dofs[4];
+                pointer.InitPerDet(i_det, dofs);
+                for (int i_time = start; i_time < stop; ++i_time) {
+                    double coords[4];
+                    pointer.GetCoords(i_det, i_time, (double*)dofs, (double*)coords);
+                    int pixel_offset = pixelizor.GetPixel(i_det, i_time, (double*)coords);
+                    counter.Forward(i_det, i_time, pixel_offset);
+                }
+            });
+        }
+        return;
+    }
+
+    // Indexed by i_domain; (i_det, start, stop) items.
+    auto work = extract_thread_intervals(thread_intervals, n_det, _TimeBlock());
 
-#pragma omp parallel
     {
-        // The principle here is that all threads loop over all
-        // detectors, but the sample ranges encoded in ivals are
-        // disjoint.
-        const int i_thread = omp_get_thread_num();
-        for (int i_det = 0; i_det < n_det; ++i_det) {
+        ReleaseGIL _nogil;
+        ThreadPin _pin;
+        // As in to_map_omp, each domain touches its own pixels only.
+#pragma omp parallel for schedule(dynamic) num_threads(so3g_get_num_threads()) \
+    firstprivate(_pin)
+        for (int i_dom = 0; i_dom < work.size(); ++i_dom) {
+            int last_det = -1;
             double dofs[4];
-            pointer.InitPerDet(i_det, dofs);
-            for (auto const &rng: ivals[i_thread][i_det].segments) {
-                for (int i_time = rng.first; i_time < rng.second; ++i_time) {
+            for (auto const &item: work[i_dom]) {
+                const int i_det = item.i_det;
+                if (counter.Skip(i_det))
+                    continue;
+                if (i_det != last_det) {
+                    pointer.InitPerDet(i_det, dofs);
+                    last_det = i_det;
+                }
+                for (int i_time = item.start; i_time < item.stop; ++i_time) {
                     double coords[4];
-                    FSIGNAL weights[4];
-                    int pixel_offset;
                     pointer.GetCoords(i_det, i_time, (double*)dofs, (double*)coords);
-                    pixel_offset = _pixelizor.GetPixel(i_det, i_time, (double*)coords);
-                    accumulator.ForwardWeight(i_det, i_time, pixel_offset, coords, weights);
+                    int pixel_offset = pixelizor.GetPixel(i_det, i_time, (double*)coords);
+                    counter.Forward(i_det, i_time, pixel_offset);
                 }
             }
         }
     }
+}
+
+template<typename P, typename Z, typename A>
+bp::object ProjectionEngine<P,Z,A>::to_hits(
+    bp::object map, bp::object pbore, bp::object pofs, bp::object groups)
+{
+    auto _none = bp::object();
+    return to_hits_omp(map, pbore, pofs, groups, _none);
+}
+
+template<typename P, typename Z, typename A>
+bp::object ProjectionEngine<P,Z,A>::to_hits_omp(
+    bp::object map, bp::object pbore, bp::object pofs, bp::object groups,
+    bp::object thread_intervals)
+{
+    Z pixelizor = _pixelizor;
+    //Do we need a map?  Now is the time.
+    if (isNone(map)) {
+        int n_group = -1;
+        if (!isNone(groups)) {
+            BufferWrapper gbuf;
+            if (PyObject_GetBuffer(groups.ptr(), &gbuf.view,
+                                   PyBUF_RECORDS) == -1) {
+                PyErr_Clear();
+                throw buffer_exception("groups");
+            }
+            if (gbuf.view.ndim != 1)
+                throw shape_exception("groups", "must have shape (n_det,)");
+            if (strcmp(gbuf.view.format, "i") != 0)
+                throw dtype_exception("groups", "int32");
+            n_group = 0;
+            for (int i=0; i<gbuf.view.shape[0]; i++) {
+                int g = *(int32_t*)((char*)gbuf.view.buf +
+                                    gbuf.view.strides[0] * i);
+                if (g >= n_group)
+                    n_group = g + 1;
+            }
+        }
+        map = pixelizor.zeros(n_group, NPY_INT32);
+    }
+
+    BufferWrapper mapbuf;
+    if (PyObject_GetBuffer(map.ptr(), &mapbuf.view,
+                           PyBUF_RECORDS) == -1) {
+        PyErr_Clear();
+        throw buffer_exception("map");
+    }
+    if (strcmp(mapbuf.view.format, hits_format<int32_t>()) == 0)
+        _to_hits<int32_t>(map, pbore, pofs, groups, thread_intervals);
+    else if (strcmp(mapbuf.view.format, hits_format<uint16_t>()) == 0)
+        _to_hits<uint16_t>(map, pbore, pofs, groups, thread_intervals);
+    else
+        throw dtype_exception("map", "int32 or uint16");
 
     return map;
 }
 
+/* Decode the pairs argument of to_map_pairs -- an int32 array of
+ * shape (n_pair,2) holding the signal indices of the A and B
+ * detectors of each pair -- into one (i_a, i_b) entry per row of
+ * pofs.  If pair_pointing, pofs has one row per pair, giving the
+ * pointing used for the whole pair, and the entry is (A, B).
+ * Otherwise pofs has one row per signal vector, and each detector is
+ * projected alone, with its own pointing: A as (A, -1) and B as (B,
+ * -1).  Rows for detectors that are not in any pair get i_a = -1. */
+
+struct PairRow {
+    int i_a;
+    int i_b;
+};
+
+static
+vector<PairRow> extract_pairs(bp::object &pairs, int n_row, int n_sig,
+                              bool pair_pointing)
+{
+    BufferWrapper pbuf;
+    if (PyObject_GetBuffer(pairs.ptr(), &pbuf.view,
+                           PyBUF_RECORDS) == -1) {
+        PyErr_Clear();
+        throw buffer_exception("pairs");
+    }
+    if (pbuf.view.ndim != 2 || pbuf.view.shape[1] != 2)
+        throw shape_exception("pairs", "must have shape (n_pair,2)");
+    if (strcmp(pbuf.view.format, "i") != 0)
+        throw dtype_exception("pairs", "int32");
+    int n_pair = pbuf.view.shape[0];
+    if (pair_pointing && n_row != n_pair)
+        throw shape_exception("pofs", "must have shape (n_pair,4) "
+                              "when pair_pointing is set");
+    if (!pair_pointing && n_row != n_sig)
+        throw shape_exception("pofs", "must have shape (n_det,4) "
+                              "when pair_pointing is not set");
+
+    vector<PairRow> rows(n_row, {-1, -1});
+    for (int i=0; i<n_pair; i++) {
+        int ab[2];
+        for (int j=0; j<2; j++) {
+            ab[j] = *(int32_t*)((char*)pbuf.view.buf +
+                                pbuf.view.strides[0] * i +
+                                pbuf.view.strides[1] * j);
+            if (ab[j] < 0 || ab[j] >= n_sig)
+                throw general_agreement_exception(
+                    "pairs must index the signal vectors.");
+        }
+        if (pair_pointing) {
+            rows[i] = {ab[0], ab[1]};
+        } else {
+            rows[ab[0]] = {ab[0], -1};
+            rows[ab[1]] = {ab[1], -1};
+        }
+    }
+    return rows;
+}
+
+/** to_map_pairs(map, pbore, pofs, signal, weights, pairs,
+ *               pair_pointing=True)
+ *
+ *  Accumulate the map from the half-sum and half-difference of
+ *  detector pairs, without forming those timestreams in memory.  The
+ *  T component (if any) is projected from the half-sum, (A+B)/2, and
+ *  the Q and U components (if any) from the half-difference, (A-B)/2.
+ *
+ *  The signal has shape (n_det, n_t) as usual, and pairs is an int32
+ *  array of shape (n_pair,2) indexing into it.  If pair_pointing,
+ *  pofs has shape (n_pair,4), and each row gives the pointing of the
+ *  corresponding pair (for example, the mean of the two detectors);
+ *  the thread_intervals of to_map_pairs_omp are then indexed by pair.
+ *  Otherwise, pofs has shape (n_det,4), and each detector of a pair is projected
+ *  with its own pointing and angle, as in to_map (so the result should
+ *  be normalized by the weights of the individual detectors);
+ *  detectors that do not belong to a pair are ignored.
+ *
+ *  The pair maps are not calibrated: weights must be None, and the
+ *  difference is projected with unit polarization efficiency and no
+ *  angle offset (a polarization calibration is per detector, and
+ *  cannot be applied to a difference of two detectors).
+ */
+
+template<typename P, typename Z, typename A>
+bp::object ProjectionEngine<P,Z,A>::to_map_pairs(
+    bp::object map, bp::object pbore, bp::object pofs, bp::object signal,
+    bp::object weight, bp::object pairs, bool pair_pointing)
+{
+    auto _none = bp::object();
+    return to_map_pairs_omp(map, pbore, pofs, signal, weight, pairs, _none,
+                            pair_pointing);
+}
+
+template<typename P, typename Z, typename A>
+bp::object ProjectionEngine<P,Z,A>::to_map_pairs_omp(
+    bp::object map, bp::object pbore, bp::object pofs, bp::object signal,
+    bp::object weight, bp::object pairs, bp::object thread_intervals,
+    bool pair_pointing)
+{
+    Z pixelizor = _pixelizor;
+    //Initialize it / check inputs.
+    auto pointer = P();
+    pointer.fast_math = _fast_math;
+    pointer.TestInputs(map, pbore, pofs, signal, weight);
+    int n_row = pointer.DetCount();
+    int n_time = pointer.TimeCount();
+    int n_sig = bp::len(signal);
+
+    auto rows = extract_pairs(pairs, n_row, n_sig, pair_pointing);
+    // The polarization calibration is per detector, not per pair.
+    if (!isNone(weight))
+        throw shape_exception("weight", "must be None");
+    auto accumulator = A(true, true, false, n_sig, n_time);
+
+    //Do we need a map?  Now is the time.
+    if (isNone(map)) {
+        int n_comp = accumulator.ComponentCount();
+        map = pixelizor.zeros(n_comp);
+    }
+
+    pixelizor.TestInputs(map, pbore, pofs, signal, weight);
+    accumulator.TestInputs(map, pbore, pofs, signal, weight);
+
+    // Indexed by i_domain; (i_row, start, stop) items.  Without
+    // thread_intervals, there is a single domain.
+    vector<vector<OmpWorkItem>> work;
+    if (isNone(thread_intervals)) {
+        work.resize(1);
+        for (int i_row = 0; i_row < n_row; ++i_row)
+            work[0].push_back({i_row, 0, n_time});
+        split_time_blocks(work[0], _TimeBlock());
+    } else
+        work = extract_thread_intervals(thread_intervals, n_row, _TimeBlock());
+
+    {
+        ReleaseGIL _nogil;
+        ThreadPin _pin;
+        // As in to_map_omp, each domain touches its own pixels only.
+#pragma omp parallel for schedule(dynamic) num_threads(so3g_get_num_threads()) \
+    firstprivate(_pin)
+        for (int i_dom = 0; i_dom < work.size(); ++i_dom) {
+            int last_row = -1;
+            double dofs[4];
+            for (auto const &item: work[i_dom]) {
+                const int i_row = item.i_det;
+                const PairRow &row = rows[i_row];
+                if (row.i_a < 0)
+                    continue;
+                if (i_row != last_row) {
+                    pointer.InitPerDet(i_row, dofs);
+                    last_row = i_row;
+                }
+                for (int i_time = item.start; i_time < item.stop; ++i_time) {
+                    double coords[4];
+                    int pixel_offset;
+                    pointer.GetCoords(i_row, i_time, (double*)dofs, (double*)coords);
+                    pixel_offset = pixelizor.GetPixel(i_row, i_time, (double*)coords);
+                    accumulator.ForwardPair(row.i_a, row.i_b, i_time,
+                                            pixel_offset, coords);
+                }
+            }
+        }
+    }
+    return map;
+}
+
+/** from_map(map, pbore, pofs, signal, weights, scale=1.)
+ *
+ *  Sample the map into the time domain, adding the result into
+ *  signal.  If signal is None, it is created and initialized to zero;
+ *  otherwise it is updated in place.  The sampled values are
+ *  multiplied by scale before being added, so passing scale=-1 will
+ *  subtract the map signal from the TOD.
+ */
+
 template<typename P, typename Z, typename A>
 bp::object ProjectionEngine<P,Z,A>::from_map(
-    bp::object map, bp::object pbore, bp::object pofs, bp::object signal, bp::object weight)
+    bp::object map, bp::object pbore, bp::object pofs, bp::object signal, bp::object weight,
+    double scale)
 {
-    // Initialize pointer and _pixelizor.
+    Z pixelizor = _pixelizor;
+    ProjectionStats stats;
+    stats.enabled = _profile;
+    stats.Start("from_map");
+
+    // Initialize pointer and pixelizor.
     auto pointer = P();
+    pointer.fast_math = _fast_math;
     pointer.TestInputs(map, pbore, pofs, signal, weight);
     int n_det = pointer.DetCount();
     int n_time = pointer.TimeCount();
@@ -883,23 +2085,111 @@ bp::object ProjectionEngine<P,Z,A>::from_map(
     // Initialize accumulator -- create signal if it DNE.
     auto accumulator = A(true, true, false, n_det, n_time);
     accumulator.TestInputs(map, pbore, pofs, signal, weight);
+    accumulator.scale = scale;
 
-    _pixelizor.TestInputs(map, pbore, pofs, signal, weight);
+    pixelizor.TestInputs(map, pbore, pofs, signal, weight);
 
-#pragma omp parallel for
-    for (int i_det = 0; i_det < n_det; ++i_det) {
-        double dofs[4];
-        pointer.InitPerDet(i_det, dofs);
-        for (int i_time = 0; i_time < n_time; ++i_time) {
-            double coords[4];
-            FSIGNAL weights[4];
-            int pixel_offset;
-            pointer.GetCoords(i_det, i_time, (double*)dofs, (double*)coords);
-            pixel_offset = _pixelizor.GetPixel(i_det, i_time, (double*)coords);
-            accumulator.Reverse(i_det, i_time, pixel_offset, coords, weights);
+    auto tiles = DetTimeTiles(n_det, n_time, _TimeBlock(),
+                              so3g_get_num_threads());
+
+    stats.StartLoop(so3g_get_num_threads());
+    {
+        ReleaseGIL _nogil;
+        ThreadPin _pin;
+#pragma omp parallel for num_threads(so3g_get_num_threads()) \
+    firstprivate(_pin)
+        for (int i_tile = 0; i_tile < tiles.Count(); ++i_tile) {
+            double t_start = stats.Now();
+            long n_offmap = 0;
+            tiles.Visit(i_tile, [&](int i_det, int start, int stop) {
+                double dofs[4];
+                pointer.InitPerDet(i_det, dofs);
+                n_offmap += project_samples(
+                    stats.enabled, pointer, pixelizor, i_det, dofs, start, stop,
+                    [&](int i_time, int pixel_offset, double *coords) {
+                        FSIGNAL weights[4];
+                        accumulator.Reverse(i_det, i_time, pixel_offset, coords, weights);
+                    });
+            });
+            stats.AddWork(t_start, tiles.Size(i_tile), n_offmap);
         }
     }
+    stats.EndLoop();
 
+    _StoreStats(stats);
+    return accumulator._signalspace->ret_val;
+}
+
+/** from_map_omp(map, pbore, pofs, signal, weights, thread_intervals,
+ *               scale=1.)
+ *
+ *  Like from_map, but the samples are visited domain by domain, as in
+ *  to_map_omp; samples not in any domain are not touched.  Each
+ *  sample must be in at most one domain.  With domains from
+ *  tile_ranges, each thread reads one tile of the map at a time,
+ *  which can help when the map is much larger than the cache.
+ */
+
+template<typename P, typename Z, typename A>
+bp::object ProjectionEngine<P,Z,A>::from_map_omp(
+    bp::object map, bp::object pbore, bp::object pofs, bp::object signal, bp::object weight,
+    bp::object thread_intervals, double scale)
+{
+    Z pixelizor = _pixelizor;
+    ProjectionStats stats;
+    stats.enabled = _profile;
+    stats.Start("from_map_omp");
+
+    // Initialize pointer and pixelizor.
+    auto pointer = P();
+    pointer.fast_math = _fast_math;
+    pointer.TestInputs(map, pbore, pofs, signal, weight);
+    int n_det = pointer.DetCount();
+    int n_time = pointer.TimeCount();
+
+    // Initialize accumulator -- create signal if it DNE.
+    auto accumulator = A(true, true, false, n_det, n_time);
+    accumulator.TestInputs(map, pbore, pofs, signal, weight);
+    accumulator.scale = scale;
+
+    pixelizor.TestInputs(map, pbore, pofs, signal, weight);
+
+    // Indexed by i_domain; (i_det, start, stop) items.
+    auto work = extract_thread_intervals(thread_intervals, n_det, _TimeBlock());
+
+    stats.StartLoop(so3g_get_num_threads());
+    {
+        ReleaseGIL _nogil;
+        ThreadPin _pin;
+        // The domains cover disjoint samples, so the threads never
+        // write to the same part of signal.
+#pragma omp parallel for schedule(dynamic) num_threads(so3g_get_num_threads()) \
+    firstprivate(_pin)
+        for (int i_dom = 0; i_dom < work.size(); ++i_dom) {
+            double t_start = stats.Now();
+            long n_samp = 0, n_offmap = 0;
+            int last_det = -1;
+            double dofs[4];
+            for (auto const &item: work[i_dom]) {
+                n_samp += item.stop - item.start;
+                const int i_det = item.i_det;
+                if (i_det != last_det) {
+                    pointer.InitPerDet(i_det, dofs);
+                    last_det = i_det;
+                }
+                n_offmap += project_samples(
+                    stats.enabled, pointer, pixelizor, i_det, dofs, item.start, item.stop,
+                    [&](int i_time, int pixel_offset, double *coords) {
+                        FSIGNAL weights[4];
+                        accumulator.Reverse(i_det, i_time, pixel_offset, coords, weights);
+                    });
+            }
+            stats.AddWork(t_start, n_samp, n_offmap);
+        }
+    }
+    stats.EndLoop();
+
+    _StoreStats(stats);
     return accumulator._signalspace->ret_val;
 }
 
@@ -909,6 +2199,7 @@ bp::object ProjectionEngine<P,Z,A>::coords(
 {
     auto _none = bp::object();
     auto pointer = P();
+    pointer.fast_math = _fast_math;
     pointer.TestInputs(_none, pbore, pofs, _none, _none);
 
     int n_det = pointer.DetCount();
@@ -918,20 +2209,30 @@ bp::object ProjectionEngine<P,Z,A>::coords(
     auto coord_buf_man = SignalSpace<double>(
         coord, "coord", NPY_FLOAT64, n_det, n_time, n_coord);
 
-#pragma omp parallel for
-    for (int i_det = 0; i_det < n_det; ++i_det) {
-        double dofs[4];
-        pointer.InitPerDet(i_det, dofs);
-
-        double* const coords_det = coord_buf_man.data_ptr[i_det];
-        const int step0 = coord_buf_man.steps[0];
-        const int step1 = coord_buf_man.steps[1];
-
-        for (int i_time = 0; i_time < n_time; ++i_time) {
-            double coords[4];
-            pointer.GetCoords(i_det, i_time, (double*)dofs, (double*)coords);
-            for (int ic=0; ic<4; ic++)
-                *(coords_det + step0 * i_time + step1 * ic) = coords[ic];
+    auto tiles = DetTimeTiles(n_det, n_time, _TimeBlock(),
+                              so3g_get_num_threads());
+
+    {
+        ReleaseGIL _nogil;
+        ThreadPin _pin;
+#pragma omp parallel for num_threads(so3g_get_num_threads()) \
+    firstprivate(_pin)
+        for (int i_tile = 0; i_tile < tiles.Count(); ++i_tile) {
+            tiles.Visit(i_tile, [&](int i_det, int start, int stop) {
+                double dofs[4];
+                pointer.InitPerDet(i_det, dofs);
+
+                double* const coords_det = coord_buf_man.data_ptr[i_det];
+                const int step0 = coord_buf_man.steps[0];
+                const int step1 = coord_buf_man.steps[1];
+
+                for (int i_time = start; i_time < stop; ++i_time) {
+                    double coords[4];
+                    pointer.GetCoords(i_det, i_time, (double*)dofs, (double*)coords);
+                    for (int ic=0; ic<4; ic++)
+                        *(coords_det + step0 * i_time + step1 * ic) = coords[ic];
+                }
+            });
         }
     }
 
@@ -942,11 +2243,13 @@ template<typename P, typename Z, typename A>
 bp::object ProjectionEngine<P,Z,A>::pixels(
     bp::object pbore, bp::object pofs, bp::object pixel)
 {
+    Z pixelizor = _pixelizor;
     auto _none = bp::object();
 
     auto pointer = P();
+    pointer.fast_math = _fast_math;
     pointer.TestInputs(_none, pbore, pofs, _none, _none);
-    _pixelizor.TestInputs(_none, _none, _none, _none, _none);
+    pixelizor.TestInputs(_none, _none, _none, _none, _none);
 
     int n_det = pointer.DetCount();
     int n_time = pointer.TimeCount();
@@ -954,18 +2257,27 @@ bp::object ProjectionEngine<P,Z,A>::pixels(
     auto pixel_buf_man = SignalSpace<int32_t>(
         pixel, "pixel", NPY_INT32, n_det, n_time);
 
-#pragma omp parallel for
-    for (int i_det = 0; i_det < n_det; ++i_det) {
-        double dofs[4];
-        pointer.InitPerDet(i_det, dofs);
-        int* const pix_buf = pixel_buf_man.data_ptr[i_det];
-        const int step = pixel_buf_man.steps[0];
-        for (int i_time = 0; i_time < n_time; ++i_time) {
-            double coords[4];
-            pointer.GetCoords(i_det, i_time, (double*)dofs, (double*)coords);
-            int pixel_offset = _pixelizor.GetPixel(i_det, i_time, (double*)coords);
-            pix_buf[i_time * step] = pixel_offset;
-            // pix_buf[i_time * pixel_buf_man.steps[0]] = pixel_offset;
+    auto tiles = DetTimeTiles(n_det, n_time, _TimeBlock(),
+                              so3g_get_num_threads());
+
+    {
+        ReleaseGIL _nogil;
+        ThreadPin _pin;
+#pragma omp parallel for num_threads(so3g_get_num_threads()) \
+    firstprivate(_pin)
+        for (int i_tile = 0; i_tile < tiles.Count(); ++i_tile) {
+            tiles.Visit(i_tile, [&](int i_det, int start, int stop) {
+                double dofs[4];
+                pointer.InitPerDet(i_det, dofs);
+                int* const pix_buf = pixel_buf_man.data_ptr[i_det];
+                const int step = pixel_buf_man.steps[0];
+                for (int i_time = start; i_time < stop; ++i_time) {
+                    double coords[4];
+                    pointer.GetCoords(i_det, i_time, (double*)dofs, (double*)coords);
+                    int pixel_offset = pixelizor.GetPixel(i_det, i_time, (double*)coords);
+                    pix_buf[i_time * step] = pixel_offset;
+                }
+            });
         }
     }
 
@@ -973,64 +2285,93 @@ bp::object ProjectionEngine<P,Z,A>::pixels(
 }
 
 
+/** pixel_ranges(pbore, pofs, n_domain=0)
+ *
+ *  Split the map into n_domain slices of pixel index (by default,
+ *  one per thread), and return the sample ranges that land in each,
+ *  as a list [i_domain][i_det] of Ranges.  This is the
+ *  thread_intervals argument of the *_omp methods.  Using more
+ *  domains than threads gives those methods room to balance the
+ *  load.
+ */
+
 template<typename P, typename Z, typename A>
 bp::object ProjectionEngine<P,Z,A>::pixel_ranges(
-    bp::object pbore, bp::object pofs)
+    bp::object pbore, bp::object pofs, int n_domain)
 {
+    Z pixelizor = _pixelizor;
     auto pointer = P();
+    pointer.fast_math = _fast_math;
     auto _none = bp::object();
 
     pointer.TestInputs(_none, pbore, pofs, _none, _none);
-    _pixelizor.TestInputs(_none, _none, _none, _none, _none);
+    pixelizor.TestInputs(_none, _none, _none, _none, _none);
 
     int n_det = pointer.DetCount();
     int n_time = pointer.TimeCount();
 
-    auto pix_range = _pixelizor.IndexRange();
+    auto pix_range = pixelizor.IndexRange();
+
+    if (n_domain <= 0)
+        n_domain = so3g_get_num_threads();
 
     vector<vector<RangesInt32>> ranges;
 
-#pragma omp parallel
     {
-        int n_domain = omp_get_num_threads();
-#pragma omp single
+        ReleaseGIL _nogil;
+        ThreadPin _pin;
+#pragma omp parallel num_threads(so3g_get_num_threads()) \
+    firstprivate(_pin)
         {
-            for (int i=0; i<n_domain; ++i) {
-                vector<RangesInt32> v(n_det);
-                for (auto &_v: v)
-                    _v.count = n_time;
-                ranges.push_back(v);
+#pragma omp single
+            {
+                for (int i=0; i<n_domain; ++i) {
+                    vector<RangesInt32> v(n_det);
+                    for (auto &_v: v)
+                        _v.count = n_time;
+                    ranges.push_back(v);
+                }
             }
-        }
 
-        int pix_lo = pix_range.first;
-        int pix_step = (pix_range.second - pix_range.first +
-                        n_domain - 1) / n_domain;
+            int pix_lo = pix_range.first;
+            int pix_step = (pix_range.second - pix_range.first +
+                            n_domain - 1) / n_domain;
+
+            // The samples of a detector must be visited in order, so
+            // don't split them between threads.
+            auto tiles = DetTimeTiles(n_det, n_time, _TimeBlock(),
+                                      omp_get_num_threads(), false);
 
 #pragma omp for
-        for (int i_det = 0; i_det < n_det; ++i_det) {
-            double dofs[4];
-            pointer.InitPerDet(i_det, dofs);
-            int last_slice = -1;
-            int slice_start = 0;
-            for (int i_time = 0; i_time < n_time; ++i_time) {
-                double coords[4];
-                pointer.GetCoords(i_det, i_time, (double*)dofs, (double*)coords);
-                int pixel_offset = _pixelizor.GetPixel(i_det, i_time, (double*)coords);
-                int this_slice = -1;
-                if (pixel_offset >= 0)
-                    this_slice = (pixel_offset - pix_lo) / pix_step;
-                if (this_slice != last_slice) {
-                    if (last_slice >= 0)
-                        ranges[last_slice][i_det].append_interval_no_check(
-                            slice_start, i_time);
-                    slice_start = i_time;
-                    last_slice = this_slice;
+            for (int i_tile = 0; i_tile < tiles.Count(); ++i_tile) {
+                // Per-detector state, carried from block to block.
+                vector<int> last_slice(n_det, -1);
+                vector<int> slice_start(n_det, 0);
+                tiles.Visit(i_tile, [&](int i_det, int start, int stop) {
+                    double dofs[4];
+                    pointer.InitPerDet(i_det, dofs);
+                    for (int i_time = start; i_time < stop; ++i_time) {
+                        double coords[4];
+                        pointer.GetCoords(i_det, i_time, (double*)dofs, (double*)coords);
+                        int pixel_offset = pixelizor.GetPixel(i_det, i_time, (double*)coords);
+                        int this_slice = -1;
+                        if (pixel_offset >= 0)
+                            this_slice = (pixel_offset - pix_lo) / pix_step;
+                        if (this_slice != last_slice[i_det]) {
+                            if (last_slice[i_det] >= 0)
+                                ranges[last_slice[i_det]][i_det].append_interval_no_check(
+                                    slice_start[i_det], i_time);
+                            slice_start[i_det] = i_time;
+                            last_slice[i_det] = this_slice;
+                        }
+                    }
+                });
+                for (int i_det = 0; i_det < n_det; ++i_det) {
+                    if (last_slice[i_det] >= 0)
+                        ranges[last_slice[i_det]][i_det].append_interval_no_check(
+                            slice_start[i_det], n_time);
                 }
             }
-            if (last_slice >= 0)
-                ranges[last_slice][i_det].append_interval_no_check(
-                    slice_start, n_time);
         }
     }
 
@@ -1047,6 +2388,633 @@ bp::object ProjectionEngine<P,Z,A>::pixel_ranges(
     return bp::extract<bp::object>(ivals_out);
 }
 
+/** tile_ranges(pbore, pofs, tile_shape)
+ *
+ *  Bucket the samples by map tile, where tile_shape=(tile_ny,
+ *  tile_nx) gives the size of each tile (see Pixelizor2_Flat::GetTile
+ *  for the numbering).  Returns a dict that maps each tile index that
+ *  is touched by any sample to a list of n_det Ranges, giving the
+ *  samples that land in that tile.
+ */
+
+template<typename P, typename Z, typename A>
+bp::object ProjectionEngine<P,Z,A>::tile_ranges(
+    bp::object pbore, bp::object pofs, bp::object tile_shape)
+{
+    Z pixelizor = _pixelizor;
+    auto pointer = P();
+    pointer.fast_math = _fast_math;
+    auto _none = bp::object();
+
+    pointer.TestInputs(_none, pbore, pofs, _none, _none);
+    pixelizor.TestInputs(_none, _none, _none, _none, _none);
+
+    int n_det = pointer.DetCount();
+    int n_time = pointer.TimeCount();
+
+    if (bp::len(tile_shape) != 2)
+        throw general_agreement_exception("tile_shape must be (tile_ny, tile_nx).");
+    const int tile_ny = bp::extract<int>(tile_shape[0]);
+    const int tile_nx = bp::extract<int>(tile_shape[1]);
+    if (tile_ny <= 0 || tile_nx <= 0)
+        throw general_agreement_exception("tile_shape must be positive.");
+
+    // For each detector, a list of (tile, start, end) segments.
+    vector<vector<array<int,3>>> segs(n_det);
+
+    {
+        ReleaseGIL _nogil;
+        // The samples of a detector must be visited in order.
+        auto tiles = DetTimeTiles(n_det, n_time, _TimeBlock(),
+                                  so3g_get_num_threads(), false);
+        ThreadPin _pin;
+#pragma omp parallel for num_threads(so3g_get_num_threads()) \
+    firstprivate(_pin)
+        for (int i_tile = 0; i_tile < tiles.Count(); ++i_tile) {
+            // Per-detector state, carried from block to block.
+            vector<int> last_tile(n_det, -1);
+            vector<int> tile_start(n_det, 0);
+            tiles.Visit(i_tile, [&](int i_det, int start, int stop) {
+                double dofs[4];
+                pointer.InitPerDet(i_det, dofs);
+                for (int i_time = start; i_time < stop; ++i_time) {
+                    double coords[4];
+                    pointer.GetCoords(i_det, i_time, (double*)dofs, (double*)coords);
+                    int pixel_index = pixelizor.GetPixel(i_det, i_time, (double*)coords);
+                    int this_tile = pixelizor.GetTile(pixel_index, tile_ny, tile_nx);
+                    if (this_tile != last_tile[i_det]) {
+                        if (last_tile[i_det] >= 0)
+                            segs[i_det].push_back(
+                                {{last_tile[i_det], tile_start[i_det], i_time}});
+                        tile_start[i_det] = i_time;
+                        last_tile[i_det] = this_tile;
+                    }
+                }
+            });
+            for (int i_det = 0; i_det < n_det; ++i_det) {
+                if (last_tile[i_det] >= 0)
+                    segs[i_det].push_back(
+                        {{last_tile[i_det], tile_start[i_det], n_time}});
+            }
+        }
+    }
+
+    // Regroup by tile; only the tiles that are hit are represented.
+    map<int,vector<RangesInt32>> tiles;
+    for (int i_det = 0; i_det < n_det; ++i_det) {
+        for (auto const &seg: segs[i_det]) {
+            auto it = tiles.find(seg[0]);
+            if (it == tiles.end())
+                it = tiles.emplace(seg[0], vector<RangesInt32>(
+                                       n_det, RangesInt32(n_time))).first;
+            it->second[i_det].append_interval_no_check(seg[1], seg[2]);
+        }
+    }
+
+    auto output = bp::dict();
+    for (auto const &kv: tiles) {
+        auto ivals = bp::list();
+        for (auto const &iv: kv.second)
+            ivals.append(bp::object(iv));
+        output[kv.first] = ivals;
+    }
+    return output;
+}
+
+/** mask_ranges(map, pbore, pofs)
+ *
+ *  Returns a list of n_det Ranges, giving the samples that land on a
+ *  non-zero pixel of map, which must be a bool or uint8 array of
+ *  shape (n_y,n_x).  Samples that fall outside the map are not
+ *  included.
+ */
+
+template<typename P, typename Z, typename A>
+bp::object ProjectionEngine<P,Z,A>::mask_ranges(
+    bp::object map, bp::object pbore, bp::object pofs)
+{
+    Z pixelizor = _pixelizor;
+    auto pointer = P();
+    pointer.fast_math = _fast_math;
+    auto _none = bp::object();
+
+    pointer.TestInputs(map, pbore, pofs, _none, _none);
+    pixelizor.TestInputs(map, pbore, pofs, _none, _none);
+
+    BufferWrapper mapbuf;
+    if (PyObject_GetBuffer(map.ptr(), &mapbuf.view,
+                           PyBUF_RECORDS) == -1) {
+        PyErr_Clear();
+        throw buffer_exception("map");
+    }
+    if (mapbuf.view.ndim != 2)
+        throw shape_exception("map", "must have shape (n_y,n_x)");
+    if (mapbuf.view.itemsize != 1)
+        throw dtype_exception("map", "bool or uint8");
+    const char *mask = (const char*)mapbuf.view.buf;
+
+    int n_det = pointer.DetCount();
+    int n_time = pointer.TimeCount();
+
+    vector<RangesInt32> ranges(n_det, RangesInt32(n_time));
+
+    {
+        ReleaseGIL _nogil;
+        // The samples of a detector must be visited in order.
+        auto tiles = DetTimeTiles(n_det, n_time, _TimeBlock(),
+                                  so3g_get_num_threads(), false);
+        ThreadPin _pin;
+#pragma omp parallel for num_threads(so3g_get_num_threads()) \
+    firstprivate(_pin)
+        for (int i_tile = 0; i_tile < tiles.Count(); ++i_tile) {
+            // Per-detector state, carried from block to block.
+            vector<int> run_start(n_det, -1);
+            tiles.Visit(i_tile, [&](int i_det, int start, int stop) {
+                double dofs[4];
+                pointer.InitPerDet(i_det, dofs);
+                for (int i_time = start; i_time < stop; ++i_time) {
+                    double coords[4];
+                    pointer.GetCoords(i_det, i_time, (double*)dofs, (double*)coords);
+                    int pixel_offset = pixelizor.GetPixel(i_det, i_time, (double*)coords);
+                    bool set = (pixel_offset >= 0 && mask[pixel_offset] != 0);
+                    if (set && run_start[i_det] < 0) {
+                        run_start[i_det] = i_time;
+                    } else if (!set && run_start[i_det] >= 0) {
+                        ranges[i_det].append_interval_no_check(run_start[i_det], i_time);
+                        run_start[i_det] = -1;
+                    }
+                }
+            });
+            for (int i_det = 0; i_det < n_det; ++i_det) {
+                if (run_start[i_det] >= 0)
+                    ranges[i_det].append_interval_no_check(run_start[i_det], n_time);
+            }
+        }
+    }
+
+    auto ivals = bp::list();
+    for (auto const &iv: ranges)
+        ivals.append(bp::object(iv));
+    return ivals;
+}
+
+/** MultiProjectionEngine
+ *
+ *  The projection of each target is selected at run time, from this
+ *  list.  (Flat is not included, as it does not work with
+ *  quaternions.)
+ */
+
+enum MultiProj {
+    MULTI_CAR = 0,
+    MULTI_CEA,
+    MULTI_ARC,
+    MULTI_TAN,
+    MULTI_ZEA,
+};
+
+/* The detector quaternions are computed for a block of samples at a
+ * time, and then each target processes the whole block.  This keeps
+ * the per-target loop free of run-time dispatch. */
+
+#define MULTI_BLOCK 256
+
+template <typename CoordSys, bool weight_map, typename A>
+static inline
+void multi_block(A &accumulator, Pixelizor2_Flat &pixelizor,
+                 const double (*qdet)[4], const Py_buffer *rot, int rot_step,
+                 bool fast_math, int i_det, int t0, int n)
+{
+    for (int i = 0; i < n; ++i) {
+        const int i_time = t0 + i;
+        double coords[4];
+        FSIGNAL weights[4];
+        if (rot_step < 0) {
+            Pointer<CoordSys>::QuatToCoords(qdet[i], coords, fast_math);
+        } else {
+            const char *r = (char*)rot->buf + rot_step * i_time;
+            const int s = rot->strides[rot->ndim - 1];
+            const quatd qrot(*(double*)r, *(double*)(r + s),
+                             *(double*)(r + 2*s), *(double*)(r + 3*s));
+            const quatd q = qrot * (*reinterpret_cast<const quatd*>(qdet[i]));
+            Pointer<CoordSys>::QuatToCoords(
+                reinterpret_cast<const double*>(&q), coords, fast_math);
+        }
+        int pixel_offset = pixelizor.GetPixel(i_det, i_time, coords);
+        if (weight_map)
+            accumulator.ForwardWeight(i_det, i_time, pixel_offset,
+                                      coords, weights);
+        else
+            accumulator.Forward(i_det, i_time, pixel_offset,
+                                coords, weights);
+    }
+}
+
+template<typename A>
+MultiProjectionEngine<A>::MultiProjectionEngine(bp::object targets,
+                                                bool fast_math)
+{
+    const std::map<std::string, int> names = {
+        {"CAR", MULTI_CAR}, {"CEA", MULTI_CEA}, {"ARC", MULTI_ARC},
+        {"TAN", MULTI_TAN}, {"ZEA", MULTI_ZEA}};
+    int n_target = bp::len(targets);
+    if (n_target < 1)
+        throw general_agreement_exception("targets must not be empty.");
+    for (int i = 0; i < n_target; i++) {
+        bp::object target = targets[i];
+        if (bp::len(target) != 2)
+            throw general_agreement_exception(
+                "each target must be a (proj_name, pixelizor) pair.");
+        std::string name = bp::extract<std::string>(target[0]);
+        auto it = names.find(name);
+        if (it == names.end())
+            throw general_agreement_exception(
+                "unsupported projection for multi-target engine: " + name);
+        _projs.push_back(it->second);
+        _pixelizors.push_back(bp::extract<Pixelizor2_Flat>(target[1]));
+    }
+    _fast_math = fast_math;
+}
+
+template<typename A>
+template<bool weight_map>
+bp::object MultiProjectionEngine<A>::_accumulate(
+    bp::object &maps, bp::object &pbore, bp::object &pofs,
+    bp::object &rots, bp::object &signal, bp::object &weight)
+{
+    vector<Pixelizor2_Flat> pixelizors = _pixelizors;
+    const int n_target = _projs.size();
+    auto _none = bp::object();
+
+    // The shared part of the pointing is just the detector quaternion.
+    auto pointer = Pointer<ProjQuat>();
+    pointer.TestInputs(_none, pbore, pofs, signal, weight);
+    int n_det = pointer.DetCount();
+    int n_time = pointer.TimeCount();
+
+    if (!isNone(maps) && bp::len(maps) != n_target)
+        throw shape_exception("maps", "must have one entry per target");
+    if (!isNone(rots) && bp::len(rots) != n_target)
+        throw shape_exception("rots", "must have one entry per target");
+
+    auto output = bp::list();
+    vector<std::unique_ptr<A>> accumulators;
+    vector<std::unique_ptr<BufferWrapper>> rotbufs;
+    vector<int> rot_step(n_target, -1);
+    for (int k = 0; k < n_target; k++) {
+        accumulators.emplace_back(new A(!weight_map, !weight_map, weight_map,
+                                        n_det, n_time));
+        auto &accumulator = *accumulators.back();
+
+        //Do we need a map?  Now is the time.
+        bp::object map = isNone(maps) ? _none : bp::object(maps[k]);
+        if (isNone(map)) {
+            int n_comp = accumulator.ComponentCount();
+            if (!weight_map) {
+                map = pixelizors[k].zeros(n_comp);
+            } else {
+                map = pixelizors[k].zeros(n_comp * n_comp);
+                auto v0 = (PyArrayObject*)map.ptr();
+                npy_intp dims[32] = {n_comp, n_comp};
+                int dimi = 2;
+                for (int d=1; d<PyArray_NDIM(v0); d++)
+                    dims[dimi++] = PyArray_DIM(v0, d);
+                PyArray_Dims padims = {dims, dimi};
+                PyObject *v1 = PyArray_Newshape(v0, &padims,  NPY_ANYORDER);
+                map = bp::object(bp::handle<>(v1));
+            }
+        }
+        pixelizors[k].TestInputs(map, pbore, pofs, signal, weight);
+        accumulator.TestInputs(map, pbore, pofs, signal, weight);
+        output.append(map);
+
+        // Rotation: None, (4,) or (n_time,4).  rot_step is the
+        // per-sample byte step, or -1 for no rotation.
+        rotbufs.emplace_back(new BufferWrapper());
+        bp::object rot = isNone(rots) ? _none : bp::object(rots[k]);
+        if (isNone(rot))
+            continue;
+        auto &view = rotbufs.back()->view;
+        if (PyObject_GetBuffer(rot.ptr(), &view, PyBUF_RECORDS) == -1) {
+            PyErr_Clear();
+            throw buffer_exception("rots");
+        }
+        if (view.itemsize != sizeof(double))
+            throw dtype_exception("rots", "float64");
+        if (view.ndim == 1 && view.shape[0] == 4)
+            rot_step[k] = 0;
+        else if (view.ndim == 2 && view.shape[0] == n_time &&
+                 view.shape[1] == 4)
+            rot_step[k] = view.strides[0];
+        else
+            throw shape_exception("rots", "each entry must have shape (4,) "
+                                  "or (n_t,4)");
+    }
+
+    // The threads split the targets, so that each map is only ever
+    // updated by one thread.  (Splitting the detectors or samples
+    // instead would have threads adding into the same pixels; the
+    // single-target engines avoid that with the pixel domains of
+    // thread_intervals, which are specific to one geometry.)  Each
+    // thread computes the detector quaternions for itself.
+    {
+        ReleaseGIL _nogil;
+        ThreadPin _pin;
+#pragma omp parallel num_threads(std::min(so3g_get_num_threads(), n_target)) \
+    firstprivate(_pin)
+        {
+            const int n_thread = omp_get_num_threads();
+            const int i_thread = omp_get_thread_num();
+            for (int i_det = 0; i_det < n_det; ++i_det) {
+                double dofs[4];
+                pointer.InitPerDet(i_det, dofs);
+                for (int t0 = 0; t0 < n_time; t0 += MULTI_BLOCK) {
+                    const int n = std::min(MULTI_BLOCK, n_time - t0);
+                    double qdet[MULTI_BLOCK][4];
+                    for (int i = 0; i < n; ++i)
+                        pointer.GetCoords(i_det, t0 + i, (double*)dofs, qdet[i]);
+                    for (int k = i_thread; k < n_target; k += n_thread) {
+                        auto &acc = *accumulators[k];
+                        auto &pix = pixelizors[k];
+                        const Py_buffer *rot = &rotbufs[k]->view;
+                        switch(_projs[k]) {
+                        case MULTI_CAR:
+                            multi_block<ProjCAR, weight_map>(
+                                acc, pix, qdet, rot, rot_step[k], _fast_math, i_det, t0, n);
+                            break;
+                        case MULTI_CEA:
+                            multi_block<ProjCEA, weight_map>(
+                                acc, pix, qdet, rot, rot_step[k], _fast_math, i_det, t0, n);
+                            break;
+                        case MULTI_ARC:
+                            multi_block<ProjARC, weight_map>(
+                                acc, pix, qdet, rot, rot_step[k], _fast_math, i_det, t0, n);
+                            break;
+                        case MULTI_TAN:
+                            multi_block<ProjTAN, weight_map>(
+                                acc, pix, qdet, rot, rot_step[k], _fast_math, i_det, t0, n);
+                            break;
+                        case MULTI_ZEA:
+                            multi_block<ProjZEA, weight_map>(
+                                acc, pix, qdet, rot, rot_step[k], _fast_math, i_det, t0, n);
+                            break;
+                        }
+                    }
+                }
+            }
+        }
+    }
+    return output;
+}
+
+template<typename A>
+bp::object MultiProjectionEngine<A>::to_map(
+    bp::object maps, bp::object pbore, bp::object pofs, bp::object rots,
+    bp::object signal, bp::object weights)
+{
+    return _accumulate<false>(maps, pbore, pofs, rots, signal, weights);
+}
+
+template<typename A>
+bp::object MultiProjectionEngine<A>::to_weight_map(
+    bp::object maps, bp::object pbore, bp::object pofs, bp::object rots,
+    bp::object signal, bp::object weights)
+{
+    return _accumulate<true>(maps, pbore, pofs, rots, signal, weights);
+}
+
+/** StackingEngine
+ *
+ *  The sources are indexed with a grid of cubic cells on the unit
+ *  vectors, with cell size equal to the largest chord between a
+ *  source and a point of its cutout.  The sources near a sample are
+ *  then all in the 27 cells around the sample's cell.  Consecutive
+ *  samples of a detector are usually in the same cell, so the
+ *  candidate list is only rebuilt when the cell changes.
+ *
+ *  For the zenithal projections, the distance R from the reference
+ *  point in the projection plane is theta (ARC), tan(theta) (TAN) or
+ *  2 sin(theta/2) (ZEA), where theta is the angle from the source.
+ *  The chord, 2 sin(theta/2), is no larger than R in all three
+ *  cases, so the pixelizor's MaxRadius bounds it.
+ */
+
+template<typename CoordSys, typename A>
+StackingEngine<CoordSys,A>::StackingEngine(Pixelizor2_Flat pixelizor,
+                                           bp::object sources,
+                                           bool fast_math)
+{
+    _pixelizor = pixelizor;
+    _fast_math = fast_math;
+
+    BufferWrapper srcbuf;
+    if (PyObject_GetBuffer(sources.ptr(), &srcbuf.view,
+                           PyBUF_RECORDS) == -1) {
+        PyErr_Clear();
+        throw buffer_exception("sources");
+    }
+    if (srcbuf.view.ndim != 2 || srcbuf.view.shape[1] != 4)
+        throw shape_exception("sources", "must have shape (n_source,4)");
+    if (strcmp(srcbuf.view.format, "d") != 0)
+        throw dtype_exception("sources", "float64");
+    _n_source = srcbuf.view.shape[0];
+
+    _cell = std::max(std::min(_pixelizor.MaxRadius(), 2.), 1e-6);
+    _n_cell = (long)(2. / _cell) + 3;
+    for (int i = 0; i < _n_source; i++) {
+        const char *r = (char*)srcbuf.view.buf + srcbuf.view.strides[0] * i;
+        double q[4];
+        for (int ic = 0; ic < 4; ic++) {
+            q[ic] = *(double*)(r + srcbuf.view.strides[1] * ic);
+            _qsrc.push_back(q[ic]);
+        }
+        // The source direction is the inverse rotation of the pole.
+        const double v[3] = {2 * (q[1]*q[3] - q[0]*q[2]),
+                             2 * (q[2]*q[3] + q[0]*q[1]),
+                             q[0]*q[0] - q[1]*q[1] - q[2]*q[2] + q[3]*q[3]};
+        for (int ic = 0; ic < 3; ic++)
+            _vsrc.push_back(v[ic]);
+        const long key = (_CellIndex(v[0]) * _n_cell + _CellIndex(v[1]))
+            * _n_cell + _CellIndex(v[2]);
+        _cells[key].push_back(i);
+    }
+}
+
+template<typename CoordSys, typename A>
+void StackingEngine<CoordSys,A>::_Candidates(const double *v, long &last_key,
+                                             vector<int> &cand)
+{
+    const long ix = _CellIndex(v[0]);
+    const long iy = _CellIndex(v[1]);
+    const long iz = _CellIndex(v[2]);
+    const long key = (ix * _n_cell + iy) * _n_cell + iz;
+    if (key == last_key)
+        return;
+    last_key = key;
+    cand.clear();
+    for (int dx = -1; dx <= 1; dx++) {
+        for (int dy = -1; dy <= 1; dy++) {
+            for (int dz = -1; dz <= 1; dz++) {
+                auto it = _cells.find(((ix + dx) * _n_cell + iy + dy)
+                                      * _n_cell + iz + dz);
+                if (it != _cells.end())
+                    cand.insert(cand.end(), it->second.begin(),
+                                it->second.end());
+            }
+        }
+    }
+}
+
+template<typename CoordSys, typename A>
+template<bool weight_map>
+bp::object StackingEngine<CoordSys,A>::_accumulate(
+    bp::object &map, bp::object &pbore, bp::object &pofs,
+    bp::object &signal, bp::object &weight)
+{
+    Pixelizor2_Flat pixelizor = _pixelizor;
+    auto _none = bp::object();
+
+    // The shared part of the pointing is just the detector quaternion.
+    auto pointer = Pointer<ProjQuat>();
+    pointer.TestInputs(_none, pbore, pofs, signal, weight);
+    int n_det = pointer.DetCount();
+    int n_time = pointer.TimeCount();
+
+    auto accumulator = A(false, !weight_map, false, n_det, n_time);
+    accumulator.TestInputs(map, pbore, pofs, signal, weight);
+    const int N = accumulator.ComponentCount();
+    const int n_lead = weight_map ? N * N : N;
+
+    //Do we need a map?  Now is the time.
+    if (isNone(map)) {
+        map = pixelizor.zeros(n_lead);
+        if (weight_map) {
+            auto v0 = (PyArrayObject*)map.ptr();
+            npy_intp dims[32] = {N, N};
+            int dimi = 2;
+            for (int d=1; d<PyArray_NDIM(v0); d++)
+                dims[dimi++] = PyArray_DIM(v0, d);
+            PyArray_Dims padims = {dims, dimi};
+            PyObject *v1 = PyArray_Newshape(v0, &padims,  NPY_ANYORDER);
+            map = bp::object(bp::handle<>(v1));
+        }
+    }
+
+    BufferWrapper mapbuf;
+    if (PyObject_GetBuffer(map.ptr(), &mapbuf.view, PyBUF_RECORDS) == -1) {
+        PyErr_Clear();
+        throw buffer_exception("map");
+    }
+    if (mapbuf.view.itemsize != sizeof(double))
+        throw dtype_exception("map", "float64");
+    const int n_pre = weight_map ? 2 : 1;
+    const int ndim = mapbuf.view.ndim;
+    const bool per_source = (ndim == n_pre + 3);
+    if (ndim != n_pre + 2 && !per_source)
+        throw shape_exception("map", weight_map ?
+                              "must have shape ([n_source,]n_comp,n_comp,n_y,n_x)" :
+                              "must have shape ([n_source,]n_comp,n_y,n_x)");
+    const int a0 = per_source ? 1 : 0;
+    if (per_source && mapbuf.view.shape[0] != _n_source)
+        throw shape_exception("map", "dimension 0 must match n_source");
+    for (int i = 0; i < n_pre; i++) {
+        if (mapbuf.view.shape[a0 + i] != N)
+            throw shape_exception("map", "component dimensions must match n_comp");
+    }
+    pixelizor.TestInputs(map, pbore, pofs, signal, weight);
+
+    const long src_step = per_source ? mapbuf.view.strides[0] : 0;
+    const long comp_step[2] = {mapbuf.view.strides[a0],
+                               weight_map ? mapbuf.view.strides[a0 + 1] : 0};
+    const double max_chord2 = _cell * _cell;
+
+    // The map is updated in place with atomic adds, for separate
+    // cutouts (src_step != 0) and the stacked map alike; so memory
+    // use does not grow with the thread count.
+
+    {
+        ReleaseGIL _nogil;
+        ThreadPin _pin;
+#pragma omp parallel num_threads(so3g_get_num_threads()) \
+    firstprivate(_pin)
+        {
+            vector<int> cand;
+#pragma omp for schedule(dynamic)
+            for (int i_det = 0; i_det < n_det; ++i_det) {
+                long last_key = -1;
+                double dofs[4];
+                pointer.InitPerDet(i_det, dofs);
+                for (int i_time = 0; i_time < n_time; ++i_time) {
+                    double qdet[4];
+                    pointer.GetCoords(i_det, i_time, (double*)dofs, qdet);
+                    const double v[3] = {
+                        2 * (qdet[1]*qdet[3] + qdet[0]*qdet[2]),
+                        2 * (qdet[2]*qdet[3] - qdet[0]*qdet[1]),
+                        qdet[0]*qdet[0] - qdet[1]*qdet[1]
+                        - qdet[2]*qdet[2] + qdet[3]*qdet[3]};
+                    _Candidates(v, last_key, cand);
+                    if (cand.size() == 0)
+                        continue;
+                    FSIGNAL sig = 1.;
+                    if (!weight_map)
+                        sig = *(accumulator._signalspace->data_ptr[i_det] +
+                                accumulator._signalspace->steps[0] * i_time);
+                    for (auto i_src: cand) {
+                        const double *vs = &_vsrc[3 * i_src];
+                        const double dx = v[0] - vs[0];
+                        const double dy = v[1] - vs[1];
+                        const double dz = v[2] - vs[2];
+                        if (dx*dx + dy*dy + dz*dz > max_chord2)
+                            continue;
+                        const double *qs = &_qsrc[4 * i_src];
+                        const quatd q = quatd(qs[0], qs[1], qs[2], qs[3]) *
+                            (*reinterpret_cast<const quatd*>(qdet));
+                        double coords[4];
+                        Pointer<CoordSys>::QuatToCoords(
+                            reinterpret_cast<const double*>(&q), coords,
+                            _fast_math);
+                        const int pix = pixelizor.GetPixel(i_det, i_time, coords);
+                        if (pix < 0)
+                            continue;
+                        FSIGNAL wt[4];
+                        accumulator.PixelWeight(i_det, coords, wt);
+                        for (int imap = 0; imap < N; ++imap) {
+                            for (int jmap = (weight_map ? imap : 0);
+                                 jmap < (weight_map ? N : 1); ++jmap) {
+                                const double x = weight_map ?
+                                    wt[imap] * wt[jmap] : sig * wt[imap];
+                                double *dest = (double*)(
+                                    (char*)mapbuf.view.buf + src_step * i_src +
+                                    comp_step[0] * imap + comp_step[1] * jmap +
+                                    pix);
+#pragma omp atomic
+                                *dest += x;
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+    return map;
+}
+
+template<typename CoordSys, typename A>
+bp::object StackingEngine<CoordSys,A>::to_map(
+    bp::object map, bp::object pbore, bp::object pofs,
+    bp::object signal, bp::object weights)
+{
+    return _accumulate<false>(map, pbore, pofs, signal, weights);
+}
+
+template<typename CoordSys, typename A>
+bp::object StackingEngine<CoordSys,A>::to_weight_map(
+    bp::object map, bp::object pbore, bp::object pofs,
+    bp::object signal, bp::object weights)
+{
+    return _accumulate<true>(map, pbore, pofs, signal, weights);
+}
+
 //Flat.
 typedef ProjectionEngine<Pointer<ProjFlat>,Pixelizor2_Flat,Accumulator<SpinT>>
   ProjEng_Flat_T;
@@ -1089,16 +3057,72 @@ typedef ProjectionEngine<Pointer<ProjZEA>,Pixelizor2_Flat,Accumulator<SpinQU>>
 typedef ProjectionEngine<Pointer<ProjZEA>,Pixelizor2_Flat,Accumulator<SpinTQU>>
   ProjEng_ZEA_TQU;
 
+//Multi-target.
+typedef MultiProjectionEngine<Accumulator<SpinT>> MultiProjEng_T;
+typedef MultiProjectionEngine<Accumulator<SpinQU>> MultiProjEng_QU;
+typedef MultiProjectionEngine<Accumulator<SpinTQU>> MultiProjEng_TQU;
+
+//Stacking.
+typedef StackingEngine<ProjARC,Accumulator<SpinT>> StackProjEng_ARC_T;
+typedef StackingEngine<ProjARC,Accumulator<SpinQU>> StackProjEng_ARC_QU;
+typedef StackingEngine<ProjARC,Accumulator<SpinTQU>> StackProjEng_ARC_TQU;
+typedef StackingEngine<ProjTAN,Accumulator<SpinT>> StackProjEng_TAN_T;
+typedef StackingEngine<ProjTAN,Accumulator<SpinQU>> StackProjEng_TAN_QU;
+typedef StackingEngine<ProjTAN,Accumulator<SpinTQU>> StackProjEng_TAN_TQU;
+typedef StackingEngine<ProjZEA,Accumulator<SpinT>> StackProjEng_ZEA_T;
+typedef StackingEngine<ProjZEA,Accumulator<SpinQU>> StackProjEng_ZEA_QU;
+typedef StackingEngine<ProjZEA,Accumulator<SpinTQU>> StackProjEng_ZEA_TQU;
+
 #define EXPORT_ENGINE(CLASSNAME)                                        \
-    bp::class_<CLASSNAME>(#CLASSNAME, bp::init<Pixelizor2_Flat>())      \
+    bp::class_<CLASSNAME>(#CLASSNAME, bp::init<Pixelizor2_Flat,         \
+                          bp::optional<bool>>())                        \
     .def("to_map", &CLASSNAME::to_map)                                  \
     .def("to_map_omp", &CLASSNAME::to_map_omp)                          \
     .def("to_weight_map", &CLASSNAME::to_weight_map)                    \
     .def("to_weight_map_omp", &CLASSNAME::to_weight_map_omp)            \
-    .def("from_map", &CLASSNAME::from_map)                              \
+    .def("to_hits", &CLASSNAME::to_hits)                                \
+    .def("to_hits_omp", &CLASSNAME::to_hits_omp)                        \
+    .def("to_map_pairs", &CLASSNAME::to_map_pairs,                      \
+         (bp::arg("self"), bp::arg("map"), bp::arg("pbore"),            \
+          bp::arg("pofs"), bp::arg("signal"), bp::arg("weights"),       \
+          bp::arg("pairs"), bp::arg("pair_pointing")=true))             \
+    .def("to_map_pairs_omp", &CLASSNAME::to_map_pairs_omp,              \
+         (bp::arg("self"), bp::arg("map"), bp::arg("pbore"),            \
+          bp::arg("pofs"), bp::arg("signal"), bp::arg("weights"),       \
+          bp::arg("pairs"), bp::arg("thread_intervals"),                \
+          bp::arg("pair_pointing")=true))                               \
+    .def("from_map", &CLASSNAME::from_map,                              \
+         (bp::arg("self"), bp::arg("map"), bp::arg("pbore"),            \
+          bp::arg("pofs"), bp::arg("signal"), bp::arg("weights"),       \
+          bp::arg("scale")=1.))                                         \
+    .def("from_map_omp", &CLASSNAME::from_map_omp,                      \
+         (bp::arg("self"), bp::arg("map"), bp::arg("pbore"),            \
+          bp::arg("pofs"), bp::arg("signal"), bp::arg("weights"),       \
+          bp::arg("thread_intervals"), bp::arg("scale")=1.))            \
     .def("coords", &CLASSNAME::coords)                                  \
     .def("pixels", &CLASSNAME::pixels)                                  \
-    .def("pixel_ranges", &CLASSNAME::pixel_ranges);
+    .def("pixel_ranges", &CLASSNAME::pixel_ranges,                      \
+         (bp::arg("self"), bp::arg("pbore"), bp::arg("pofs"),           \
+          bp::arg("n_domain")=0))                                       \
+    .def("tile_ranges", &CLASSNAME::tile_ranges)                        \
+    .def("mask_ranges", &CLASSNAME::mask_ranges)                        \
+    .def("set_profile", &CLASSNAME::set_profile)                        \
+    .def("get_stats", &CLASSNAME::get_stats)                            \
+    .add_property("time_block", &CLASSNAME::get_time_block,             \
+                  &CLASSNAME::set_time_block);
+
+#define EXPORT_MULTI_ENGINE(CLASSNAME)                                  \
+    bp::class_<CLASSNAME>(#CLASSNAME, bp::init<bp::object,              \
+                          bp::optional<bool>>())                        \
+    .def("to_map", &CLASSNAME::to_map)                                  \
+    .def("to_weight_map", &CLASSNAME::to_weight_map);
+
+#define EXPORT_STACK_ENGINE(CLASSNAME)                                  \
+    bp::class_<CLASSNAME>(#CLASSNAME, bp::init<Pixelizor2_Flat,         \
+                          bp::object, bp::optional<bool>>())            \
+    .def("to_map", &CLASSNAME::to_map)                                  \
+    .def("to_weight_map", &CLASSNAME::to_weight_map)                    \
+    .add_property("n_source", &CLASSNAME::SourceCount);
 
 PYBINDINGS("so3g")
 {
@@ -1120,7 +3144,29 @@ PYBINDINGS("so3g")
     EXPORT_ENGINE(ProjEng_ZEA_T);
     EXPORT_ENGINE(ProjEng_ZEA_QU);
     EXPORT_ENGINE(ProjEng_ZEA_TQU);
+    EXPORT_MULTI_ENGINE(MultiProjEng_T);
+    EXPORT_MULTI_ENGINE(MultiProjEng_QU);
+    EXPORT_MULTI_ENGINE(MultiProjEng_TQU);
+    EXPORT_STACK_ENGINE(StackProjEng_ARC_T);
+    EXPORT_STACK_ENGINE(StackProjEng_ARC_QU);
+    EXPORT_STACK_ENGINE(StackProjEng_ARC_TQU);
+    EXPORT_STACK_ENGINE(StackProjEng_TAN_T);
+    EXPORT_STACK_ENGINE(StackProjEng_TAN_QU);
+    EXPORT_STACK_ENGINE(StackProjEng_TAN_TQU);
+    EXPORT_STACK_ENGINE(StackProjEng_ZEA_T);
+    EXPORT_STACK_ENGINE(StackProjEng_ZEA_QU);
+    EXPORT_STACK_ENGINE(StackProjEng_ZEA_TQU);
     bp::class_<Pixelizor2_Flat>("Pixelizor2_Flat", bp::init<int,int,double,double,
                           double,double>())
-        .def("zeros", &Pixelizor2_Flat::zeros);
+        .def("zeros", (bp::object (Pixelizor2_Flat::*)(int))
+             &Pixelizor2_Flat::zeros)
+        .def("downgrade", &Pixelizor2_Flat::downgrade,
+             (bp::arg("self"), bp::arg("map"), bp::arg("factor"),
+              bp::arg("weights")=bp::object(), bp::arg("output")=bp::object()))
+        .def("upgrade", &Pixelizor2_Flat::upgrade,
+             (bp::arg("self"), bp::arg("map"), bp::arg("factor"),
+              bp::arg("order")=0, bp::arg("output")=bp::object()))
+        .def("resample", &Pixelizor2_Flat::resample,
+             (bp::arg("self"), bp::arg("src"), bp::arg("src_map"),
+              bp::arg("order")=1, bp::arg("output")=bp::object()));
 }
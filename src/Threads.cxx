@@ -0,0 +1,139 @@
+#include <pybindings.h>
+
+#include <atomic>
+#include <vector>
+
+#include <omp.h>
+#ifdef __linux__
+#include <pthread.h>
+#include <sched.h>
+#endif
+
+#include "Threads.h"
+#include "exceptions.h"
+
+using namespace std;
+
+static thread_local int _n_threads = 0;
+
+int so3g_get_num_threads()
+{
+    if (_n_threads > 0)
+        return _n_threads;
+    return omp_get_max_threads();
+}
+
+int so3g_set_num_threads(int n_threads)
+{
+    if (n_threads < 0)
+        throw general_agreement_exception("n_threads must be >= 0.");
+    int old = _n_threads;
+    _n_threads = n_threads;
+    return old;
+}
+
+// The request made by so3g_set_affinity from a thread, for the
+// members of its teams.  Each request gets a new, nonzero,
+// generation; generation 0 means no request (the original affinity).
+struct AffinityRequest {
+    long generation = 0;
+    vector<int> cpus;
+};
+
+static thread_local AffinityRequest _affinity_request;
+
+#ifdef __linux__
+
+// The generation last applied to this thread.
+static thread_local long _pinned_generation = 0;
+
+// The affinity of the process when the module was loaded; used to
+// undo the pinning.
+static cpu_set_t _initial_mask;
+
+static std::atomic<long> _generations(0);
+
+// Pin the calling thread, as thread i_thread of a team, according to
+// request.  Returns false on failure.
+static bool pin_thread(const AffinityRequest &request, int i_thread)
+{
+    cpu_set_t mask;
+    if (request.cpus.size() == 0) {
+        mask = _initial_mask;
+    } else {
+        CPU_ZERO(&mask);
+        CPU_SET(request.cpus[i_thread % request.cpus.size()], &mask);
+    }
+    _pinned_generation = request.generation;
+    return pthread_setaffinity_np(pthread_self(), sizeof(mask), &mask) == 0;
+}
+
+void so3g_set_affinity(bp::object cpus)
+{
+    vector<int> cpu_list;
+    if (cpus.ptr() != Py_None) {
+        for (int i = 0; i < bp::len(cpus); i++) {
+            int cpu = bp::extract<int>(cpus[i]);
+            if (cpu < 0 || cpu >= CPU_SETSIZE)
+                throw general_agreement_exception("invalid CPU index.");
+            if (!CPU_ISSET(cpu, &_initial_mask))
+                throw general_agreement_exception(
+                    "failed to set thread affinity (are the CPUs available?).");
+            cpu_list.push_back(cpu);
+        }
+        if (cpu_list.size() == 0)
+            throw general_agreement_exception("cpus must not be empty.");
+        _affinity_request.generation = ++_generations;
+    } else {
+        // Returning to the original affinity still needs a new
+        // generation, so that pinned threads are released.
+        if (_affinity_request.generation != 0)
+            _affinity_request.generation = ++_generations;
+    }
+    _affinity_request.cpus = cpu_list;
+    // The calling thread is thread 0 of its teams.
+    if (!pin_thread(_affinity_request, 0))
+        throw general_agreement_exception(
+            "failed to set thread affinity (are the CPUs available?).");
+}
+
+ThreadPin::ThreadPin() : _request(&_affinity_request) {}
+
+ThreadPin::ThreadPin(const ThreadPin &other) : _request(other._request)
+{
+    if (_request->generation != _pinned_generation)
+        pin_thread(*_request, omp_get_thread_num());
+}
+
+#else
+
+void so3g_set_affinity(bp::object cpus)
+{
+    throw general_agreement_exception(
+        "thread affinity is only supported on Linux.");
+}
+
+ThreadPin::ThreadPin() : _request(&_affinity_request) {}
+
+ThreadPin::ThreadPin(const ThreadPin &other) : _request(other._request) {}
+
+#endif
+
+PYBINDINGS("so3g")
+{
+#ifdef __linux__
+    sched_getaffinity(0, sizeof(_initial_mask), &_initial_mask);
+#endif
+    bp::def("get_num_threads", so3g_get_num_threads,
+            "Returns the number of threads so3g will use for parallel "
+            "regions started from this thread.");
+    bp::def("set_num_threads", so3g_set_num_threads,
+            "Sets the number of threads so3g will use for parallel regions "
+            "started from this thread (0 for the OpenMP default).  Returns "
+            "the previous setting.");
+    bp::def("set_affinity", so3g_set_affinity,
+            "Pins the threads of this thread's OpenMP teams to the listed "
+            "CPUs, round-robin, or restores their original affinity if "
+            "None is passed.  The calling thread is pinned at once, and "
+            "the others as they join so3g's parallel regions.");
+}
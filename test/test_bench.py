@@ -0,0 +1,79 @@
+"""
+Test the projection benchmark suite (on tiny inputs).
+"""
+
+import unittest
+import copy
+import json
+import os
+import tempfile
+
+import so3g
+from so3g.bench import proj as bench_proj
+
+
+class TestBenchProj(unittest.TestCase):
+
+    def test_run(self):
+        out = bench_proj.run(n_det=4, n_time=200, thread_counts=[2, 1],
+                             repeat=1)
+        self.assertEqual(out['config']['thread_counts'], [1, 2])
+        results = out['results']
+        keys = set((r['engine'], r['operation'], r['n_threads'])
+                   for r in results)
+        self.assertEqual(len(keys), len(results))
+        for proj in bench_proj.PROJECTIONS:
+            for comps in bench_proj.COMPS:
+                engine = 'ProjEng_%s_%s' % (proj, comps)
+                for op in ['to_map_omp', 'from_map_omp',
+                           'to_map_pairs_omp']:
+                    self.assertIn((engine, op, 2), keys)
+                self.assertIn((engine, 'to_map', 1), keys)
+                self.assertNotIn((engine, 'to_map', 2), keys)
+            self.assertIn(('ProjEng_%s_T' % proj, 'pixels', 2), keys)
+        for r in results:
+            self.assertGreater(r['samples_per_sec'], 0)
+            if r['n_threads'] == 1:
+                self.assertEqual(r['efficiency'], 1.)
+
+        # Results are JSON-ready.
+        json.loads(json.dumps(out))
+
+    def test_compare(self):
+        out = bench_proj.run(projections=['CAR'], comps=['T'], n_det=4,
+                             n_time=200, thread_counts=[1], repeat=1)
+        self.assertEqual(bench_proj.compare(out, out), [])
+        faster = copy.deepcopy(out)
+        for r in faster['results']:
+            r['samples_per_sec'] *= 2
+        slower = bench_proj.compare(out, faster)
+        self.assertEqual(len(slower), len(out['results']))
+        self.assertAlmostEqual(slower[0]['ratio'], 0.5)
+        self.assertEqual(bench_proj.compare(out, faster, tolerance=0.6), [])
+
+        other = copy.deepcopy(out)
+        other['config']['n_det'] = 5
+        with self.assertRaises(ValueError):
+            bench_proj.compare(out, other)
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'bench.json')
+            args = ['--projections', 'TAN', '--comps', 'QU', '--n-det', '4',
+                    '--n-time', '200', '--threads', '1', '--repeat', '1',
+                    '-q']
+            self.assertEqual(bench_proj.main(args + ['-o', filename]), 0)
+            with open(filename) as fin:
+                out = json.load(fin)
+            self.assertEqual(out['config']['projections'], ['TAN'])
+            # Compare against a much faster earlier run.
+            for r in out['results']:
+                r['samples_per_sec'] *= 100
+            with open(filename, 'w') as fout:
+                json.dump(out, fout)
+            self.assertEqual(bench_proj.main(['--compare', filename, '-q']),
+                             1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -153,6 +153,29 @@ class TestProjAstrometry(unittest.TestCase):
                 dist/DEG, dist/ARCSEC))
             self.assertLess(dist, 1*ARCSEC)
 
+    @unittest.skipIf(not HAS_QPOINT, "qpoint not found")
+    def test_precise_chunks(self):
+        """Test that chunked, threaded high-precision pointing matches
+        a single call, and fills the output in place.
+
+        """
+        site = so3g.proj.EarthlySite.get_named('act')
+        n = 1000
+        t = 1577836800. + np.arange(n) * 10.
+        az = np.linspace(-30, 400, n) * DEG
+        el = np.linspace(20, 80, n) * DEG
+        roll = np.linspace(-10, 10, n) * DEG
+        csl0 = so3g.proj.CelestialSightLine.az_el(
+            t, az, el, roll, site=site, weather='typical', n_workers=1,
+            chunk_size=n)
+        output = so3g.proj.quat.G3VectorQuat(np.zeros((n, 4)))
+        csl1 = so3g.proj.CelestialSightLine.az_el(
+            t, az, el, roll, site=site, weather='typical', n_workers=3,
+            chunk_size=77, output=output)
+        self.assertIs(csl1.Q, output)
+        np.testing.assert_allclose(np.array(csl1.Q), np.array(csl0.Q),
+                                   atol=1e-12)
+
     def test_horizon(self):
         """This test is not astrometric so much as a test that coordinate
         systems are accurately implemented; e.g. that the focal plane
@@ -175,6 +198,152 @@ class TestProjAstrometry(unittest.TestCase):
               (float(ra0)/DEG, float(dec0)/DEG, float(gamma)/DEG))
         self.assertLess(abs(gamma), 1.*DEG)
 
+    def test_pointing_model(self):
+        """Test the C++ pointing model against a direct quaternion
+        computation."""
+        euler = so3g.proj.quat.euler
+        n = 1000
+        az = np.linspace(-30, 400, n) * DEG
+        el = np.linspace(20, 80, n) * DEG
+        roll = np.linspace(-10, 10, n) * DEG
+
+        # Zero model does nothing; offsets are simply added.
+        pm = so3g.proj.PointingModel()
+        for a, b in zip(pm.apply(az, el, roll), [az, el, roll]):
+            np.testing.assert_allclose(a, b, atol=1e-10)
+        pm = so3g.proj.PointingModel(az_offset=0.1*DEG, el_offset=-0.2*DEG,
+                                     roll_offset=0.3*DEG)
+        for a, b in zip(pm.apply(az, el, roll),
+                        [az + .1*DEG, el - .2*DEG, roll + .3*DEG]):
+            np.testing.assert_allclose(a, b, atol=1e-10)
+
+        pm = so3g.proj.PointingModel(
+            az_offset=0.1*DEG, el_offset=-0.2*DEG, roll_offset=0.3*DEG,
+            collimation=0.02*DEG, npae=-0.01*DEG,
+            base_tilt_x=0.005*DEG, base_tilt_y=0.007*DEG)
+        az1, el1, roll1 = pm.apply(az, el, roll)
+        q_ref = np.array(
+            euler(0, pm['base_tilt_x']) * euler(1, pm['base_tilt_y']) *
+            euler(2, -(az + pm['az_offset'])) * euler(0, pm['npae']) *
+            euler(1, np.pi/2 - (el + pm['el_offset'])) *
+            euler(0, pm['collimation']) *
+            euler(2, np.pi + roll + pm['roll_offset']))
+        q1 = np.array(euler(2, -az1) * euler(1, np.pi/2 - el1) *
+                      euler(2, np.pi + roll1))
+        np.testing.assert_allclose(abs((q_ref * q1).sum(axis=1)), 1.,
+                                   atol=1e-12)
+        # Stays on the input branch.
+        self.assertLess(abs(az1 - az).max(), 1*DEG)
+
+        # In place, and through naive_az_el.
+        az2, el2, roll2 = az.copy(), el.copy(), roll.copy()
+        pm.apply(az2, el2, roll2, inplace=True)
+        np.testing.assert_array_equal(az2, az1)
+        t = SIDEREAL_MIDNIGHT_IN_LONDON + np.arange(n)
+        csl0 = so3g.proj.CelestialSightLine.naive_az_el(
+            t, az1, el1, roll1, site=LONDON)
+        csl1 = so3g.proj.CelestialSightLine.naive_az_el(
+            t, az, el, roll, site=LONDON, pointing_model=pm)
+        np.testing.assert_allclose(np.array(csl1.Q), np.array(csl0.Q),
+                                   atol=1e-12)
+
+    def test_naive_kernel(self):
+        """Test the C++ naive_az_el against the quaternion product."""
+        euler = so3g.proj.quat.euler
+        coords = so3g.proj.coords
+        site = LONDON
+        n = 1000
+        t = SIDEREAL_MIDNIGHT_IN_LONDON + np.linspace(-1e8, 1e8, n)
+        az = np.linspace(-30, 400, n) * DEG
+        el = np.linspace(20, 80, n) * DEG
+        roll = np.linspace(-10, 10, n) * DEG
+
+        lst = (np.polyval(coords.ERA_POLY, (t - coords.ERA_EPOCH) / 86400)
+               + site.lon * DEG)
+        q_ref = np.array(
+            euler(2, lst) * euler(1, np.pi/2 - site.lat * DEG) *
+            euler(2, np.pi) * euler(2, -az) * euler(1, np.pi/2 - el) *
+            euler(2, np.pi + roll))
+        csl = so3g.proj.CelestialSightLine.naive_az_el(
+            t, az, el, roll, site=site)
+        np.testing.assert_allclose(np.array(csl.Q), q_ref, atol=1e-10)
+
+        # Scalars are broadcast; output is filled in place.
+        output = so3g.proj.quat.G3VectorQuat(np.zeros((n, 4)))
+        csl = so3g.proj.CelestialSightLine.naive_az_el(
+            t, az, 45*DEG, site=site, output=output)
+        self.assertIs(csl.Q, output)
+        q_ref = np.array(
+            euler(2, lst) * euler(1, np.pi/2 - site.lat * DEG) *
+            euler(2, np.pi) * euler(2, -az) * euler(1, np.pi/4) *
+            euler(2, np.pi))
+        np.testing.assert_allclose(np.array(output), q_ref, atol=1e-10)
+        output = np.zeros((n, 4))
+        csl = so3g.proj.CelestialSightLine.naive_az_el(
+            t, az, el, roll, site=site, output=output)
+        np.testing.assert_array_equal(np.array(csl.Q), output)
+        with self.assertRaises(RuntimeError):
+            so3g.proj.CelestialSightLine.naive_az_el(
+                t, az, el, roll, site=site, output=np.zeros((n, 3)))
+
+        # All scalars give a single quat.
+        csl = so3g.proj.CelestialSightLine.naive_az_el(
+            t[3], az[3], 45*DEG, site=site)
+        self.assertIsInstance(csl.Q, so3g.proj.quat.quat)
+        np.testing.assert_allclose(
+            [csl.Q.a, csl.Q.b, csl.Q.c, csl.Q.d], q_ref[3], atol=1e-10)
+
+    def test_correction(self):
+        """Test the tabulated correction against a stand-in for the
+        precise pointing (refraction, a time offset and a small fixed
+        rotation on top of the naive pointing)."""
+        site = LONDON
+        euler = so3g.proj.quat.euler
+        CSL = so3g.proj.CelestialSightLine
+
+        def reference(t, az, el):
+            el = el + 60*ARCSEC / np.tan(el)
+            q = CSL.naive_az_el(t + 0.4, az, el, site=site).Q
+            return euler(0, 20*ARCSEC) * q
+
+        n = 20000
+        t = SIDEREAL_MIDNIGHT_IN_LONDON + np.arange(n) * 0.2
+        phase = np.arange(n) / 300.
+        az = 60*DEG + 30*DEG * np.sin(phase)
+        el = 40*DEG + 0.5*DEG * np.sin(phase / 3)
+        roll = np.linspace(-5, 5, n) * DEG
+        corr = so3g.proj.PointingCorrection.for_observation(
+            t, az, el, site=site, reference=reference)
+        self.assertEqual(corr.table.shape[3], 4)
+
+        q_ref = np.array(reference(t, az, el) * euler(2, np.pi + roll) *
+                         euler(2, -np.pi))
+        for correction, tol in [(None, 100*ARCSEC), (corr, 0.1*ARCSEC)]:
+            csl = CSL.naive_az_el(t, az, el, roll, site=site,
+                                  correction=correction)
+            dot = abs((np.array(csl.Q) * q_ref).sum(axis=1))
+            err = 2 * np.arccos(np.clip(dot, 0, 1))
+            self.assertLess(err.max(), tol)
+        self.assertGreater(err.max(), 0)
+
+    @unittest.skipIf(not HAS_QPOINT, "qpoint not found")
+    def test_correction_precise(self):
+        """Test the tabulated correction against qpoint."""
+        site = so3g.proj.EarthlySite.get_named('act')
+        n = 2000
+        t = 1577836800. + np.arange(n) * 2.
+        az = 60*DEG + 30*DEG * np.sin(np.arange(n) / 30.)
+        el = np.full(n, 50*DEG)
+        corr = so3g.proj.PointingCorrection.for_observation(
+            t, az, el, site=site, weather='typical')
+        csl0 = so3g.proj.CelestialSightLine.az_el(
+            t, az, el, site=site, weather='typical')
+        csl1 = so3g.proj.CelestialSightLine.naive_az_el(
+            t, az, el, site=site, correction=corr)
+        dot = abs((np.array(csl0.Q) * np.array(csl1.Q)).sum(axis=1))
+        self.assertLess(2 * np.arccos(np.clip(dot, 0, 1)).max(),
+                        0.1*ARCSEC)
+
     def test_focalplane(self):
         # Focal plane
         names = ['a', 'b', 'c']
@@ -0,0 +1,817 @@
+"""
+Test the proj map-making engines, through the Projectionist.
+"""
+
+import os
+import unittest
+import tempfile
+
+import so3g
+import numpy as np
+
+from astropy import wcs
+
+DEG = so3g.proj.DEG
+
+
+def get_wcs(cdelt=[-0.05, 0.05], crpix=[21, 21], proj='CAR'):
+    """Returns an astropy WCS centered on the equator."""
+    w = wcs.WCS(naxis=2)
+    w.wcs.ctype = ['RA---' + proj, 'DEC--' + proj]
+    w.wcs.cdelt = cdelt
+    w.wcs.crval = [0., 0.]
+    w.wcs.crpix = crpix
+    return w
+
+
+def get_basics(n_det=9, n_t=2000):
+    """Returns (projectionist, assembly, signal) for a small CAR map
+    scanned by a few detectors."""
+    # A 2 x 2 degree CAR map centered on the equator.
+    w = wcs.WCS(naxis=2)
+    w.wcs.ctype = ['RA---CAR', 'DEC--CAR']
+    w.wcs.cdelt = [-0.05, 0.05]
+    w.wcs.crval = [0., 0.]
+    w.wcs.crpix = [21, 21]
+    shape = (40, 40)
+    p = so3g.proj.Projectionist.for_geom(shape, w)
+
+    # Raster scan over the map.
+    t = np.arange(n_t)
+    ra = 0.8 * DEG * np.sin(t / n_t * 40 * np.pi)
+    dec = 1.6 * DEG * (t / n_t - 0.5)
+    csl = so3g.proj.CelestialSightLine()
+    csl.Q = so3g.proj.quat.rotation_lonlat(ra, dec)
+
+    # A small focal plane with a range of polarization angles.
+    names = ['d%i' % i for i in range(n_det)]
+    xi = 0.2 * DEG * np.cos(np.arange(n_det))
+    eta = 0.2 * DEG * np.sin(np.arange(n_det))
+    gamma = np.arange(n_det) * 20 * DEG
+    fp = so3g.proj.FocalPlane.from_xieta(names, xi, eta, gamma)
+    asm = so3g.proj.Assembly.attach(csl, fp)
+
+    signal = np.random.normal(size=(n_det, n_t)).astype('float32')
+    return p, asm, signal
+
+
+def _ranges_list(r):
+    """Nested lists of the intervals in a RangesMatrix (or a dict of
+    them)."""
+    if isinstance(r, dict):
+        return {k: _ranges_list(v) for k, v in r.items()}
+    if isinstance(r, so3g.proj.RangesMatrix):
+        return [_ranges_list(x) for x in r.ranges]
+    return r.ranges().tolist()
+
+
+class TestProjEngines(unittest.TestCase):
+
+    def test_hits(self):
+        p, asm, signal = get_basics()
+        weights = p.to_weights(asm, comps='T')
+        hits = p.to_hits(asm)
+        self.assertEqual(hits.dtype, np.int32)
+        self.assertEqual(hits.shape, weights.shape[2:])
+        np.testing.assert_array_equal(hits, weights[0, 0])
+
+        # OMP, and uint16 output.
+        omp = p.get_prec_omp(asm)
+        hits16 = p.to_hits(asm, omp=omp, dtype='uint16')
+        self.assertEqual(hits16.dtype, np.uint16)
+        np.testing.assert_array_equal(hits16, hits)
+
+        # Per-group hits; group -1 is dropped.
+        groups = np.arange(len(asm.dets)) % 3 - 1
+        ghits = p.to_hits(asm, det_groups=groups)
+        self.assertEqual(ghits.shape, (2,) + hits.shape)
+        pix = p.get_pixels(asm)
+        for g in range(2):
+            ref = np.zeros(hits.size, int)
+            for i in (groups == g).nonzero()[0]:
+                np.add.at(ref, pix[i][pix[i] >= 0], 1)
+            np.testing.assert_array_equal(ghits[g].ravel(), ref)
+
+        # The map dtype is checked, not just its item size.
+        for dtype in ['float32', 'int16']:
+            with self.assertRaises(ValueError):
+                p.to_hits(asm, dest_map=np.zeros(hits.shape, dtype))
+            with self.assertRaises(ValueError):
+                p.to_hits(asm, dest_map=np.zeros(hits.shape, dtype), omp=omp)
+
+        # No detectors at all.
+        asm0 = so3g.proj.Assembly()
+        asm0.Q, asm0.dets = asm.Q, np.zeros((0, 4))
+        ghits = p.to_hits(asm0, det_groups=np.zeros(0, 'int32'))
+        self.assertEqual(ghits.shape, (0,) + hits.shape)
+
+    def test_omp_domains(self):
+        p, asm, signal = get_basics()
+        ref_map = p.to_map(signal, asm, comps='TQU')
+        ref_wts = p.to_weights(asm, comps='TQU')
+        for n_domain in [None, 1, 7, 64]:
+            omp = p.get_prec_omp(asm, n_domain=n_domain)
+            if n_domain is not None:
+                self.assertEqual(omp.shape[0], n_domain)
+            np.testing.assert_allclose(
+                p.to_map(signal, asm, comps='TQU', omp=omp), ref_map)
+            np.testing.assert_allclose(
+                p.to_weights(asm, comps='TQU', omp=omp), ref_wts)
+            np.testing.assert_array_equal(
+                p.to_hits(asm, omp=omp), ref_wts[0, 0])
+        # The domains must match the detectors.
+        pe = p.get_ProjEng('TQU')
+        q1 = p._get_cached_q(asm.Q)
+        with self.assertRaises(RuntimeError):
+            pe.to_map_omp(None, q1, asm.dets[:3], signal[:3], None, omp)
+
+    def test_omp_tiles(self):
+        p, asm, signal = get_basics()
+        p.naxis[0] = 25  # Leave some samples off the map.
+        src_map = np.random.normal(size=(3, p.naxis[1], p.naxis[0]))
+        ref_map = p.to_map(signal, asm, comps='TQU')
+        ref_tod = p.from_map(src_map, asm)
+        omp = p.get_prec_omp(asm, tile_shape=(8, 8))
+        self.assertEqual(omp.shape[0],
+                         len(p.get_tile_ranges(asm, (8, 8))))
+        for n_threads in [1, 3]:
+            with so3g.threads.limit(n_threads):
+                np.testing.assert_allclose(
+                    p.to_map(signal, asm, comps='TQU', omp=omp), ref_map)
+                tod = p.from_map(src_map, asm, omp=omp)
+                np.testing.assert_allclose(tod, ref_tod, rtol=1e-6)
+                # In place, with scale.
+                p.from_map(src_map, asm, signal=tod, scale=-1., omp=omp)
+                np.testing.assert_allclose(tod, 0., atol=1e-5)
+
+        plan = p.plan(asm, comps='TQU', threads=3, tile_shape=(8, 8))
+        np.testing.assert_allclose(plan.to_map(signal), ref_map)
+        np.testing.assert_allclose(plan.from_map(src_map), ref_tod,
+                                   rtol=1e-6)
+        self.assertEqual(plan.omp.shape, omp.shape)
+
+    def test_time_chunks(self):
+        # Few detectors and long samples: work is split in time.
+        p, asm, signal = get_basics(n_det=2, n_t=20000)
+        src_map = np.random.normal(size=(3, p.naxis[1], p.naxis[0]))
+        csl = so3g.proj.CelestialSightLine()
+        csl.Q = asm.Q
+        with so3g.threads.limit(1):
+            ref_coords = csl.coords()
+            ref_pix = p.get_pixels(asm)
+            ref_tod = p.from_map(src_map, asm)
+        with so3g.threads.limit(4):
+            np.testing.assert_array_equal(csl.coords(), ref_coords)
+            for a, b in zip(p.get_pixels(asm), ref_pix):
+                np.testing.assert_array_equal(a, b)
+            np.testing.assert_array_equal(p.from_map(src_map, asm), ref_tod)
+
+    def test_time_block(self):
+        p, asm, signal = get_basics(n_det=5, n_t=3000)
+        src_map = np.random.normal(size=(3, p.naxis[1], p.naxis[0]))
+        mask = np.zeros(p.naxis[::-1], bool)
+        mask[10:20] = True
+
+        def run():
+            omp = p.get_prec_omp(asm)
+            return [p.to_map(signal, asm, comps='TQU'),
+                    p.to_map(signal, asm, comps='TQU', omp=omp),
+                    p.to_weights(asm, comps='TQU'),
+                    p.from_map(src_map, asm),
+                    p.get_pixels(asm),
+                    p.get_coords(asm),
+                    omp,
+                    p.get_tile_ranges(asm, (8, 8)),
+                    p.get_mask_ranges(mask, asm)]
+
+        with so3g.threads.limit(2):
+            ref = run()
+            self.assertEqual(p.get_ProjEng('T').time_block, 0)
+            p.time_block = 7
+            self.assertEqual(p.get_ProjEng('T').time_block, 7)
+            out = run()
+        for a, b in zip(out[:6], ref[:6]):
+            np.testing.assert_allclose(np.array(a), np.array(b),
+                                       rtol=1e-5, atol=1e-5)
+        for a, b in zip(out[6:], ref[6:]):
+            self.assertEqual(_ranges_list(a), _ranges_list(b))
+
+        with self.assertRaises(ValueError):
+            p.get_ProjEng('T').time_block = -1
+
+    def test_pol_cal(self):
+        n_det = 4
+        p, asm, signal = get_basics(n_det=n_det)
+        # Reference: the angle offsets built into the focal plane (see
+        # get_basics).
+        names = ['d%i' % i for i in range(n_det)]
+        xi = 0.2 * DEG * np.cos(np.arange(n_det))
+        eta = 0.2 * DEG * np.sin(np.arange(n_det))
+        gamma = np.arange(n_det) * 20 * DEG
+        delta = np.array([5., -10., 30., 0.]) * DEG
+        fp = so3g.proj.FocalPlane.from_xieta(names, xi, eta, gamma + delta)
+        csl = so3g.proj.CelestialSightLine()
+        csl.Q = asm.Q
+        asm_ref = so3g.proj.Assembly.attach(csl, fp)
+
+        ref = p.to_map(signal, asm_ref, comps='TQU')
+        np.testing.assert_allclose(
+            p.to_map(signal, asm, comps='TQU', pol_angle=delta), ref,
+            rtol=1e-6, atol=1e-6)
+        omp = p.get_prec_omp(asm)
+        np.testing.assert_allclose(
+            p.to_map(signal, asm, comps='TQU', omp=omp, pol_angle=delta),
+            ref, rtol=1e-6, atol=1e-6)
+        plan = p.plan(asm, comps='QU', threads=1)
+        np.testing.assert_allclose(plan.to_map(signal, pol_angle=delta),
+                                   ref[1:], rtol=1e-6, atol=1e-6)
+        src_map = np.random.normal(size=ref.shape)
+        np.testing.assert_allclose(
+            p.from_map(src_map, asm, pol_angle=delta),
+            p.from_map(src_map, asm_ref), rtol=1e-5, atol=1e-5)
+
+        # Efficiency scales the polarization response only.
+        m = p.to_map(signal, asm, comps='TQU')
+        m_eff = p.to_map(signal, asm, comps='TQU', pol_eff=0.9)
+        np.testing.assert_allclose(m_eff[0], m[0])
+        np.testing.assert_allclose(m_eff[1:], 0.9 * m[1:], rtol=1e-5, atol=1e-5)
+        w = p.to_weights(asm, comps='TQU')
+        w_eff = p.to_weights(asm, comps='TQU', pol_eff=0.9)
+        np.testing.assert_allclose(w_eff[0, 0], w[0, 0])
+        np.testing.assert_allclose(w_eff[0, 1:], 0.9 * w[0, 1:], rtol=1e-5,
+                                   atol=1e-5)
+        np.testing.assert_allclose(w_eff[1:, 1:], 0.81 * w[1:, 1:],
+                                   rtol=1e-5, atol=1e-5)
+        np.testing.assert_allclose(
+            p.from_map(src_map, asm, pol_eff=0.),
+            p.from_map(src_map[:1], asm, comps='T'), rtol=1e-5, atol=1e-5)
+
+        projeng = p.get_ProjEng('TQU')
+        q1 = p._get_cached_q(asm.Q)
+        with self.assertRaises(RuntimeError):
+            projeng.to_map(None, q1, asm.dets, signal, np.ones((n_det, 3)))
+        for dtype in ['float32', 'int64']:
+            with self.assertRaises(ValueError):
+                projeng.to_map(None, q1, asm.dets, signal,
+                               np.ones((n_det, 2), dtype))
+        # Pair differencing is not calibrated.
+        with self.assertRaises(RuntimeError):
+            projeng.to_map_pairs(None, q1, asm.dets, signal,
+                                 np.ones((n_det, 2)),
+                                 np.array([[0, 1]], 'int32'), False)
+
+    def test_fractional_crpix(self):
+        # The reference pixel index is not rounded: with crpix 4.5
+        # (along x) and 5.5 (along y), the point (0, 0) is at the
+        # low corner of pixel (6, 5).
+        pe = so3g.ProjEng_Flat_T(so3g.Pixelizor2_Flat(10, 10, 1., 1.,
+                                                      5.5, 4.5))
+        pbore = np.array([[0., 0., 1., 0.],
+                          [0.99, -0.01, 1., 0.],
+                          [-0.01, 0.99, 1., 0.],
+                          [-4.99, -5.99, 1., 0.],
+                          [-5.01, 0., 1., 0.]])
+        pofs = np.array([[0., 0., 1., 0.]])
+        np.testing.assert_array_equal(pe.pixels(pbore, pofs, None)[0],
+                                      [65, 55, 64, 0, -1])
+
+    def test_resample(self):
+        p, asm, signal = get_basics()
+        ny, nx = p.naxis[1], p.naxis[0]
+        m = np.random.normal(size=(3, ny, nx))
+        w = np.random.uniform(size=(ny, nx))
+
+        d = p.downgrade_map(m, 4)
+        self.assertEqual(d.shape, (3, ny // 4, nx // 4))
+        np.testing.assert_allclose(
+            d, m.reshape(3, ny // 4, 4, nx // 4, 4).sum(axis=(2, 4)))
+        d = p.downgrade_map(m, 4, weights=w)
+        mw = (m * w).reshape(3, ny // 4, 4, nx // 4, 4).sum(axis=(2, 4))
+        np.testing.assert_allclose(
+            d, mw / w.reshape(ny // 4, 4, nx // 4, 4).sum(axis=(1, 3)))
+        # Weights maps, with partial blocks at the edges.
+        wmap = p.to_weights(asm, comps='TQU')
+        d = p.downgrade_map(wmap, 3)
+        self.assertEqual(d.shape, (3, 3, 14, 14))
+        np.testing.assert_allclose(d.sum(axis=(2, 3)), wmap.sum(axis=(2, 3)))
+        # Integer hits maps, and the downgraded geometry.
+        hits = p.to_hits(asm)
+        d = p.downgrade_map(hits, 4)
+        self.assertEqual(d.dtype, np.int32)
+        p_lo = p.downgraded(4)
+        np.testing.assert_array_equal(d, p_lo.to_hits(asm))
+        self.assertEqual(tuple(p_lo.naxis), (d.shape[1], d.shape[0]))
+        np.testing.assert_allclose(p_lo.cdelt, p.cdelt * 4)
+        np.testing.assert_allclose(p_lo.crpix, (p.crpix - 1.5) / 4)
+        np.testing.assert_allclose(p.downgrade_map(m, 4, weights=hits),
+                                   p.downgrade_map(m, 4, weights=hits * 1.))
+        with self.assertRaises(ValueError):
+            p.downgrade_map(hits, 4, weights=w)
+        with self.assertRaises(ValueError):
+            p.downgrade_map(m.astype('int64'), 4)
+        p_hi = p.upgraded(2)
+        np.testing.assert_allclose(p_hi.downgraded(2).crpix, p.crpix)
+        np.testing.assert_array_equal(
+            p_hi.downgrade_map(p_hi.to_hits(asm), 2), hits)
+
+        u = p.upgrade_map(m, 2)
+        np.testing.assert_array_equal(u, m.repeat(2, axis=1).repeat(2, axis=2))
+        out = np.zeros((3, 2 * ny, 2 * nx))
+        u = p.upgrade_map(m, 2, order=1, output=out)
+        self.assertIs(u, out)
+        # Interior points are 3/4 of the way to their neighbour.
+        np.testing.assert_allclose(u[:, 1:-1:2, 0], 0.75 * m[:, :-1, 0] +
+                                   0.25 * m[:, 1:, 0])
+
+        # Resample onto a grid with twice the pixel size and another
+        # extent: pixel centers land on the corners of the source
+        # pixels.
+        p2 = so3g.proj.Projectionist.for_geom((20, 30), get_wcs(
+            cdelt=[-0.1, 0.1], crpix=[16, 11]))
+        r = p2.resample_map(p, m, order=1)
+        self.assertEqual(r.shape, (3, 20, 30))
+        # Map center (pixel crpix) -> same position.
+        np.testing.assert_allclose(r[:, 11, 16], m[:, 21, 21])
+        np.testing.assert_allclose(r[:, 12, 16], m[:, 23, 21])
+        self.assertTrue(np.all(r[:, :, :5] == 0))
+        np.testing.assert_array_equal(p.resample_map(p, m, order=0), m)
+        p_tan = so3g.proj.Projectionist.for_geom((20, 30), get_wcs(
+            proj='TAN'))
+        with self.assertRaises(ValueError):
+            p_tan.resample_map(p, m)
+
+    def test_healpix(self):
+        p, asm, signal = get_basics()
+        m = np.zeros((3, p.naxis[1], p.naxis[0]))
+        m[0] = np.arange(m[0].size).reshape(m[0].shape)
+        m[1], m[2] = 1., 2.
+        nside = 256
+        hp = p.to_healpix(m, nside, chunk_size=10000)
+        self.assertEqual(hp.shape, (3, 12 * nside**2))
+        # Check against the pixel index of each center.
+        lon, lat = so3g.proj.util.healpix_pix2ang(
+            nside, np.arange(12 * nside**2))
+        csl = so3g.proj.CelestialSightLine()
+        csl.Q = so3g.proj.quat.rotation_lonlat(lon, lat)
+        pix = p.get_pixels(so3g.proj.Assembly.attach(
+            csl, np.array([[1., 0., 0., 0.]])))[0]
+        on_map = pix >= 0
+        self.assertGreater(on_map.sum(), 50)
+        np.testing.assert_array_equal(hp[0][on_map], pix[on_map])
+        # On the equator of a CAR map, Q and U are unchanged.
+        np.testing.assert_allclose(hp[1][on_map], 1., rtol=1e-6)
+        np.testing.assert_allclose(hp[2][on_map], 2., rtol=1e-6)
+        self.assertTrue(np.all(hp[:, ~on_map] == 0))
+
+    def test_from_map_scale(self):
+        p, asm, signal = get_basics()
+        src_map = np.random.normal(size=(3,) + p.get_pixelizor().zeros(-1).shape)
+        model = np.array(p.from_map(src_map, asm, comps='TQU'))
+        # Subtract in place.
+        tod = signal.copy()
+        p.from_map(src_map, asm, signal=tod, scale=-1.)
+        np.testing.assert_allclose(tod, signal - model, rtol=1e-5, atol=1e-5)
+
+    def test_tiled(self):
+        p, asm, signal = get_basics()
+        shape = (int(p.naxis[1]), int(p.naxis[0]))
+        ref_map = p.to_map(signal, asm, comps='TQU')
+        ref_wts = p.to_weights(asm, comps='TQU')
+        ref_hits = p.to_hits(asm)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # Small cache, to exercise eviction.
+            tmap = so3g.proj.TiledMap(tmpdir + '/map', (3,) + shape,
+                                      (16, 12), max_cached=2)
+            p.to_map(signal, asm, dest_map=tmap)
+            tmap.close()
+            np.testing.assert_allclose(tmap.to_dense(), ref_map)
+
+            twts = so3g.proj.TiledMap(tmpdir + '/wts', (3, 3) + shape,
+                                      (16, 12), max_cached=2)
+            p.to_weights(asm, dest_map=twts)
+            np.testing.assert_allclose(twts.to_dense(), ref_wts)
+
+            thits = so3g.proj.TiledMap(tmpdir + '/hits', shape, (16, 12),
+                                       dtype='int32')
+            p.to_hits(asm, dest_map=thits)
+            np.testing.assert_array_equal(thits.to_dense(), ref_hits)
+
+            # Reopen and accumulate a second time.
+            tmap = so3g.proj.TiledMap(tmpdir + '/map', (3,) + shape,
+                                      (16, 12))
+            p.to_map(signal, asm, dest_map=tmap)
+            np.testing.assert_allclose(tmap.to_dense(), 2 * ref_map)
+            tmap.close()
+            # Reopening with another dtype or layout is an error.
+            for args in [((3,) + shape, (16, 12), 'float32'),
+                         ((2,) + shape, (16, 12)),
+                         ((3,) + shape, (8, 12))]:
+                with self.assertRaises(ValueError):
+                    so3g.proj.TiledMap(tmpdir + '/map', *args)
+
+            # Tile indices need not fit in 6 digits.
+            big = so3g.proj.TiledMap(tmpdir + '/big', (1000, 2000), (1, 1))
+            big.get_tile(1234567)[:] = 1.
+            big.close()
+            self.assertEqual(big.tiles(), [1234567])
+            self.assertEqual(so3g.proj.TiledMap(
+                tmpdir + '/big', (1000, 2000), (1, 1)).tiles(), [1234567])
+
+    def test_mask_ranges(self):
+        p, asm, signal = get_basics()
+        shape = (int(p.naxis[1]), int(p.naxis[0]))
+        mask = np.zeros(shape, bool)
+        mask[10:20, 5:30] = True
+        mask[30:, 30:] = True
+        pix = p.get_pixels(asm)
+        for m in [mask, mask.astype('uint8'), mask.astype('float32')]:
+            rm = p.get_mask_ranges(m, asm)
+            self.assertEqual(rm.shape, signal.shape)
+            for r, px in zip(rm, pix):
+                ref = (px >= 0) & mask.ravel()[px]
+                np.testing.assert_array_equal(r.mask(), ref)
+        with self.assertRaises(ValueError):
+            p.get_ProjEng('T').mask_ranges(
+                mask.astype('int16'), p._get_cached_q(asm.Q), asm.dets)
+
+    def test_accumulator(self):
+        p, asm, signal = get_basics()
+        sig2 = np.random.normal(size=signal.shape).astype('float32')
+        ref_map = p.to_map(signal, asm, comps='TQU')
+        p.to_map(sig2, asm, dest_map=ref_map)
+        ref_wts = 2 * p.to_weights(asm, comps='TQU')
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # In memory; a repeated obs_id is skipped.
+            acc = so3g.proj.MapAccumulator(p)
+            self.assertTrue(acc.add(asm, signal, obs_id='obs0'))
+            acc.save(tmpdir + '/ckpt')
+            self.assertTrue(acc.add(asm, sig2, obs_id='obs1'))
+            self.assertFalse(acc.add(asm, sig2, obs_id='obs1'))
+            np.testing.assert_allclose(acc.signal, ref_map)
+            np.testing.assert_allclose(acc.weights, ref_wts)
+
+            # Resume from the checkpoint, with tiled storage.
+            acc2 = so3g.proj.MapAccumulator(p, workdir=tmpdir + '/work',
+                                            tile_shape=(16, 12))
+            self.assertTrue(acc2.restore(tmpdir + '/ckpt'))
+            self.assertEqual(acc2.obs_ids, ['obs0'])
+            for obs_id, sig in [('obs0', signal), ('obs1', sig2)]:
+                acc2.add(asm, sig, obs_id=obs_id)
+            np.testing.assert_allclose(acc2.signal.to_dense(), ref_map)
+            acc2.save(tmpdir + '/ckpt')
+            self.assertEqual(len(os.listdir(tmpdir + '/ckpt')), 2)
+
+            # A save interrupted after its checkpoint directory was
+            # renamed into place does not block later saves.
+            os.makedirs(tmpdir + '/ckpt/ckpt_000002/signal')
+            acc2.save(tmpdir + '/ckpt')
+            self.assertEqual(sorted(os.listdir(tmpdir + '/ckpt')),
+                             ['ckpt_000003', 'state.json'])
+
+            # Merge checkpoints and accumulators from elsewhere.
+            acc3 = so3g.proj.MapAccumulator(p, workdir=tmpdir + '/work3')
+            self.assertFalse(acc3.restore(tmpdir + '/nothing'))
+            acc3.merge(tmpdir + '/ckpt')
+            acc4 = so3g.proj.MapAccumulator(p)
+            acc4.add(asm, signal, obs_id='obs2')
+            acc3.merge(acc4)
+            # Merging a live tiled accumulator leaves its tiles open.
+            acc5 = so3g.proj.MapAccumulator(p, workdir=tmpdir + '/work5',
+                                            tile_shape=(16, 12))
+            acc5.add(asm, signal)
+            n_open = len(acc5.signal._cache)
+            self.assertGreater(n_open, 0)
+            so3g.proj.MapAccumulator(p).merge(acc5)
+            self.assertEqual(len(acc5.signal._cache), n_open)
+            self.assertEqual(acc3.obs_ids, ['obs0', 'obs1', 'obs2'])
+            np.testing.assert_allclose(acc3.signal, ref_map + acc4.signal)
+            with self.assertRaises(ValueError):
+                acc3.merge(acc4)
+
+    def test_profile(self):
+        p, asm, signal = get_basics()
+        p.to_map(signal, asm, comps='T')
+        self.assertIsNone(p.get_last_stats())
+        p.profile = True
+        # Crop the map, so some samples fall off it.
+        p.naxis[0] = 25
+        n_off = (np.array(p.get_pixels(asm)) < 0).sum()
+        self.assertGreater(n_off, 0)
+        omp = p.get_prec_omp(asm, n_domain=4)
+        for kw in [{}, {'omp': omp}]:
+            p.to_map(signal, asm, comps='TQU', **kw)
+            stats = p.get_last_stats()
+            self.assertEqual(stats['method'],
+                             'to_map_omp' if kw else 'to_map')
+            # The omp domains already exclude off-map samples.
+            self.assertEqual(stats['n_samples'] + (n_off if kw else 0),
+                             signal.size)
+            self.assertEqual(sum(stats['thread_samples']),
+                             stats['n_samples'])
+            self.assertEqual(stats['n_offmap'], 0 if kw else n_off)
+            self.assertEqual(len(stats['thread_time']), stats['n_threads'])
+            self.assertGreater(stats['t_loop'], 0)
+            self.assertLessEqual(stats['efficiency'], 1.)
+        p.from_map(p.to_map(signal, asm, comps='T'), asm)
+        self.assertEqual(p.get_last_stats()['method'], 'from_map')
+        # Engines made for other purposes don't displace the stats.
+        p.to_map(signal, asm, comps='T')
+        p.get_pixels(asm)
+        self.assertEqual(p.get_last_stats()['method'], 'to_map')
+
+    def test_plan(self):
+        p, asm, signal = get_basics()
+        ref_map = p.to_map(signal, asm, comps='TQU')
+        ref_wts = p.to_weights(asm, comps='TQU')
+        ref_sig = p.from_map(ref_map, asm)
+        p.profile = True
+        for threads in [1, 2]:
+            plan = p.plan(asm, comps='TQU', threads=threads)
+            self.assertIsInstance(plan, so3g.proj.ProjectionPlan)
+            for i in range(2):
+                map_out = plan.to_map(signal)
+                self.assertEqual(p.get_last_stats()['method'],
+                                 'to_map' if threads == 1 else 'to_map_omp')
+                np.testing.assert_allclose(map_out, ref_map, atol=1e-8)
+                np.testing.assert_allclose(plan.to_weights(), ref_wts,
+                                           atol=1e-8)
+                np.testing.assert_allclose(plan.from_map(ref_map), ref_sig,
+                                           rtol=1e-6)
+            self.assertEqual(plan._omp is None, threads == 1)
+        # Accumulate into an existing map.
+        plan.to_map(signal, dest_map=map_out)
+        np.testing.assert_allclose(map_out, 2 * ref_map, atol=1e-8)
+
+    def test_stacking(self):
+        p, asm, signal = get_basics()
+
+        def get_cutout(ra, dec):
+            w = wcs.WCS(naxis=2)
+            w.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+            w.wcs.cdelt = [-0.02, 0.02]
+            w.wcs.crval = [ra, dec]
+            w.wcs.crpix = [10, 10]
+            return so3g.proj.Projectionist.for_geom((21, 21), w)
+
+        # Overlapping sources, and one far from the scan.
+        ra = np.array([0., 0.3, -0.5, 0.31, 10.])
+        dec = np.array([0., -0.2, 0.4, -0.18, 5.])
+        sources = (ra * DEG, dec * DEG)
+        p = get_cutout(0., 0.)
+        for n_threads in [1, 3]:
+            with so3g.threads.limit(n_threads):
+                cuts = p.to_stacked_map(signal, asm, sources, comps='TQU',
+                                        per_source=True)
+                stack = p.to_stacked_map(signal, asm, sources, comps='TQU')
+                wcuts = p.to_stacked_weights(asm, sources, comps='TQU',
+                                             per_source=True)
+                wstack = p.to_stacked_weights(asm, sources, comps='TQU')
+            self.assertEqual(cuts.shape, (5, 3, 21, 21))
+            for i in range(len(ra)):
+                pi = get_cutout(ra[i], dec[i])
+                np.testing.assert_allclose(
+                    cuts[i], pi.to_map(signal, asm, comps='TQU'), atol=1e-8)
+                np.testing.assert_allclose(
+                    wcuts[i], pi.to_weights(asm, comps='TQU'), atol=1e-8)
+            self.assertTrue(np.all(cuts[4] == 0))
+            np.testing.assert_allclose(stack, cuts.sum(axis=0), atol=1e-8)
+            np.testing.assert_allclose(wstack, wcuts.sum(axis=0), atol=1e-8)
+
+        # Turning each source by 180 degrees flips the cutouts.
+        flipped = p.to_stacked_map(signal, asm, sources + (np.pi,),
+                                   comps='TQU', per_source=True)
+        np.testing.assert_allclose(flipped, cuts[..., ::-1, ::-1], atol=1e-8)
+
+        # The rotations may be passed directly, but other arrays are
+        # not mistaken for them.
+        rots = p.get_source_rotations(*sources)
+        np.testing.assert_allclose(
+            p.to_stacked_map(signal, asm, rots, comps='TQU'), stack)
+        for bad in [np.array(sources), rots.astype('float32'),
+                    rots.view('int64')]:
+            with self.assertRaises(ValueError):
+                p.to_stacked_map(signal, asm, bad, comps='T')
+        engine = getattr(so3g, f'StackProjEng_{p.proj_name}_T')
+        with self.assertRaises(ValueError):
+            engine(p.get_pixelizor(), rots.view('int64'), False)
+
+        # Stacking needs a zenithal projection.
+        p_car, _, _ = get_basics()
+        with self.assertRaises(ValueError):
+            p_car.to_stacked_map(signal, asm, sources, comps='T')
+
+    def test_fast_math(self):
+        p, asm, signal = get_basics()
+        # Cover the whole sphere, including the lon=180 branch cut.
+        n_t = 20000
+        csl = so3g.proj.CelestialSightLine()
+        csl.Q = so3g.proj.quat.rotation_lonlat(
+            np.random.uniform(-np.pi, np.pi, n_t),
+            np.arcsin(np.random.uniform(-.999, .999, n_t)))
+        asm = so3g.proj.Assembly.attach(csl, asm.dets)
+        q1 = p._get_cached_q(asm.Q)
+        for proj_name in ['CAR', 'CEA']:
+            exact = p.get_ProjEng('TQU', proj_name).coords(q1, asm.dets, None)
+            fast = p.get_ProjEng('TQU', proj_name, fast_math=True).coords(
+                q1, asm.dets, None)
+            for c0, c1 in zip(exact, fast):
+                dlon = (c1[:, 0] - c0[:, 0] + np.pi) % (2 * np.pi) - np.pi
+                self.assertLess(abs(dlon).max(), 0.01 * DEG / 3600)
+                np.testing.assert_allclose(c1[:, 1:], c0[:, 1:],
+                                           rtol=0, atol=0.01 * DEG / 3600)
+        # Through the attribute.
+        p.fast_math = True
+        fast_map = p.to_map(signal, get_basics()[1], comps='TQU')
+        self.assertTrue(np.all(np.isfinite(fast_map)))
+
+    def test_async(self):
+        p, asm, signal = get_basics()
+        ref = p.to_map(signal, asm, comps='TQU')
+        futs = [p.to_map_async(signal, asm, comps='TQU'),
+                p.to_weights_async(asm, comps='TQU'),
+                p.from_map_async(ref, asm)]
+        np.testing.assert_array_equal(futs[0].result(), ref)
+        np.testing.assert_array_equal(futs[1].result(),
+                                      p.to_weights(asm, comps='TQU'))
+        np.testing.assert_array_equal(futs[2].result(),
+                                      p.from_map(ref, asm))
+
+        # Concurrent calls on one engine, into maps with different
+        # strides.
+        pe = p.get_ProjEng('TQU')
+        q1 = p._get_cached_q(asm.Q)
+        maps = [np.zeros(ref.shape) if i % 2 else
+                np.zeros(ref.shape[:1] + (ref.shape[1] * 2,
+                                          ref.shape[2] * 3))[:, ::2, ::3]
+                for i in range(8)]
+        futs = [so3g.threads.submit(pe.to_map, m, q1, asm.dets, signal, None)
+                for m in maps]
+        for f in futs:
+            np.testing.assert_array_equal(f.result(), ref)
+
+    def test_float32_pointing(self):
+        p, asm, signal = get_basics()
+        q1 = np.asarray(p._get_cached_q(asm.Q))
+        dets = np.asarray(asm.dets)
+        for proj_name in ['CAR', 'CEA']:
+            pe = p.get_ProjEng('TQU', proj_name)
+            ref = np.array(pe.coords(q1, dets, None))
+            for bore, ofs in [(q1.astype('float32'), dets),
+                              (q1, dets.astype('float32')),
+                              (q1.astype('float32'), dets.astype('float32'))]:
+                c = np.array(pe.coords(bore, ofs, None))
+                np.testing.assert_allclose(c, ref, rtol=0, atol=1e-6)
+        # Only the rare sample right on a pixel edge changes pixel.
+        pe = p.get_ProjEng('TQU')
+        pix64 = np.array(pe.pixels(q1, dets, None))
+        pix32 = np.array(pe.pixels(q1.astype('float32'),
+                                   dets.astype('float32'), None))
+        self.assertGreater(np.mean(pix64 == pix32), .999)
+        # Non-float arrays of the same itemsize are rejected too.
+        for bore, ofs in [(q1.astype('float16'), dets),
+                          (q1.astype('int64'), dets),
+                          (q1, dets.astype('int32'))]:
+            with self.assertRaises(ValueError):
+                pe.coords(bore, ofs, None)
+
+    def test_pairs(self):
+        p, asm, signal = get_basics(n_det=10)
+        pairs = np.array([[0, 1], [2, 3], [4, 5], [8, 9]])
+        a, b = signal[pairs[:, 0]], signal[pairs[:, 1]]
+        tsum, tdiff = (a + b) / 2, (a - b) / 2
+
+        for pointing in ['mean', 'first']:
+            pasm = p.get_pair_assembly(asm, pairs, pointing)
+            self.assertEqual(pasm.dets.shape, (len(pairs), 4))
+            ref = np.concatenate([p.to_map(tsum, pasm, comps='T'),
+                                  p.to_map(tdiff, pasm, comps='QU')])
+            m = p.to_map_pairs(signal, asm, pairs, comps='TQU',
+                               pointing=pointing)
+            np.testing.assert_allclose(m, ref, rtol=1e-5, atol=1e-5)
+            omp = p.get_prec_omp(pasm)
+            m = p.to_map_pairs(signal, asm, pairs, comps='TQU',
+                               pointing=pointing, omp=omp)
+            np.testing.assert_allclose(m, ref, rtol=1e-5, atol=1e-5)
+            np.testing.assert_allclose(
+                p.to_map_pairs(signal, asm, pairs, comps='QU',
+                               pointing=pointing), ref[1:],
+                rtol=1e-5, atol=1e-5)
+
+        # The mean pointing lies between the two detectors.
+        xi, eta, _ = so3g.proj.quat.decompose_xieta(asm.dets)
+        pxi, peta, _ = so3g.proj.quat.decompose_xieta(
+            p.get_pair_assembly(asm, pairs).dets)
+        np.testing.assert_allclose(pxi, xi[pairs].mean(axis=1), atol=1e-12)
+        np.testing.assert_allclose(peta, eta[pairs].mean(axis=1), atol=1e-12)
+
+        # Against a known sky, with co-located pairs at several angles
+        # and B detectors orthogonal to their A partners; the signal of
+        # the unpaired detectors must not leak in.
+        n_pair = 4
+        gamma = np.repeat(np.arange(n_pair) * 40 * DEG, 2)
+        gamma[1::2] += 90 * DEG
+        gamma = np.concatenate([gamma, [0., 0.]])
+        dets = np.array(so3g.proj.quat.rotation_xieta(
+            np.full(len(gamma), 0.1 * DEG), np.full(len(gamma), 0.05 * DEG),
+            gamma))
+        asm = so3g.proj.Assembly.attach(asm, dets)
+        pairs = np.arange(2 * n_pair).reshape(-1, 2)
+        sky = np.zeros(p.to_map(signal, asm, comps='TQU').shape)
+        sky[0], sky[1], sky[2] = 5., 1., -0.5
+        signal = np.array(p.from_map(sky, asm, comps='TQU'))
+        signal[2 * n_pair:] += 100.
+        for pointing in ['mean', 'first', 'individual']:
+            if pointing == 'individual':
+                wasm = so3g.proj.Assembly.attach(asm, dets[:2 * n_pair])
+                omp = p.get_prec_omp(asm)
+            else:
+                wasm = p.get_pair_assembly(asm, pairs, pointing)
+                omp = p.get_prec_omp(wasm)
+            for omp in [None, omp]:
+                m = p.to_map_pairs(signal, asm, pairs, comps='TQU',
+                                   pointing=pointing, omp=omp)
+                w = p.to_weights(wasm, comps='TQU')
+                for i, j in [(1, 0), (2, 0), (2, 1)]:
+                    w[i, j] = w[j, i]
+                if pointing != 'individual':
+                    # The pair sum and difference decouple T from Q, U.
+                    w[0, 1:] = w[1:, 0] = 0
+                hit = w[0, 0] > 0
+                self.assertGreater(hit.sum(), 100)
+                sol = np.linalg.solve(w[:, :, hit].transpose(2, 0, 1),
+                                      m[:, hit].T[..., None])[..., 0]
+                np.testing.assert_allclose(sol, sky[:, hit].T, atol=1e-4)
+
+        with self.assertRaises(ValueError):
+            p.to_map_pairs(signal, asm, [[0, 10]], comps='T',
+                           pointing='individual')
+
+        # As many pairs as detectors: the mode is not guessed from the
+        # shapes.  With each detector projected in full, on its own,
+        # this is just to_map.
+        asm4 = so3g.proj.Assembly.attach(asm, dets[:4])
+        pairs4 = np.array([[0, 1], [2, 3], [1, 2], [3, 0]], 'int32')
+        np.testing.assert_allclose(
+            p.to_map_pairs(signal[:4], asm4, pairs4, comps='TQU',
+                           pointing='individual'),
+            p.to_map(signal[:4], asm4, comps='TQU'), rtol=1e-5, atol=1e-4)
+        pe = p.get_ProjEng('T')
+        q1 = p._get_cached_q(asm4.Q)
+        with self.assertRaises(RuntimeError):
+            pe.to_map_pairs(None, q1, asm4.dets, signal[:4], None,
+                            pairs4[:2], True)
+        with self.assertRaises(ValueError):
+            pe.to_map_pairs(None, q1, asm4.dets, signal[:4], None,
+                            pairs4.astype('float32'), False)
+
+    def test_multi(self):
+        p, asm, signal = get_basics()
+        # A tangent plane map, centered near the scan.
+        w = wcs.WCS(naxis=2)
+        w.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+        w.wcs.cdelt = [-0.04, 0.04]
+        w.wcs.crval = [0.3, 0.2]
+        w.wcs.crpix = [31, 31]
+        p_tan = so3g.proj.Projectionist.for_geom((60, 60), w)
+        # Same scan, with a slowly drifting boresight.
+        csl = so3g.proj.CelestialSightLine()
+        n_t = signal.shape[1]
+        csl.Q = so3g.proj.quat.euler(
+            2, np.linspace(0, 0.2, n_t) * DEG) * asm.Q
+        asm2 = so3g.proj.Assembly.attach(csl, asm.dets)
+
+        targets = [(p, asm), (p_tan, asm), (p_tan, asm2)]
+        maps = so3g.proj.multi_to_map(targets, signal, comps='TQU')
+        wmaps = so3g.proj.multi_to_weights(targets, comps='TQU')
+        # The targets are split between threads; results must not
+        # depend on the number of threads.
+        for n_threads in [1, 2]:
+            with so3g.threads.limit(n_threads):
+                for m0, m1 in zip(
+                        maps, so3g.proj.multi_to_map(targets, signal,
+                                                     comps='TQU')):
+                    np.testing.assert_array_equal(m1, m0)
+        for (_p, _asm), m, wm in zip(targets, maps, wmaps):
+            ref = _p.to_map(signal, _asm, comps='TQU')
+            self.assertGreater(np.abs(ref).sum(), 0)
+            np.testing.assert_allclose(m, ref, rtol=1e-5, atol=1e-4)
+            np.testing.assert_allclose(
+                wm, _p.to_weights(_asm, comps='TQU'), rtol=1e-5, atol=1e-4)
+
+        # Accumulate into the existing maps.
+        maps2 = so3g.proj.multi_to_map(targets, signal, dest_maps=maps)
+        self.assertIs(maps2[0], maps[0])
+        with self.assertRaises(ValueError):
+            so3g.proj.multi_to_map([(p, asm), (p_tan, get_basics(n_det=3)[1])],
+                                   signal, comps='T')
+        # Same number of detectors, but different offsets.
+        dets = np.array(asm.dets)
+        dets[0] = dets[1]
+        asm3 = so3g.proj.Assembly.attach(csl, so3g.proj.quat.G3VectorQuat(dets))
+        with self.assertRaises(ValueError):
+            so3g.proj.multi_to_weights([(p, asm), (p_tan, asm3)], comps='T')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+"""
+Test the control of the so3g OpenMP thread count and affinity.
+"""
+
+import unittest
+import asyncio
+import os
+import sys
+import threading
+
+import so3g
+import numpy as np
+
+
+class TestThreads(unittest.TestCase):
+
+    def test_num_threads(self):
+        n0 = so3g.get_num_threads()
+        self.assertGreater(n0, 0)
+        old = so3g.set_num_threads(3)
+        self.assertEqual(so3g.get_num_threads(), 3)
+        self.assertEqual(so3g.set_num_threads(old), 3)
+        self.assertEqual(so3g.get_num_threads(), n0)
+        with self.assertRaises(ValueError):
+            so3g.set_num_threads(-1)
+
+    def test_limit(self):
+        # The OMP precomputation makes one domain per thread.
+        pe = so3g.ProjEng_CAR_T(so3g.Pixelizor2_Flat(10, 10, .01, .01, 5, 5))
+        pbore = np.zeros((100, 4))
+        pbore[:, 0] = 1.
+        pdet = pbore[:3]
+        n0 = so3g.get_num_threads()
+        with so3g.threads.limit(2):
+            self.assertEqual(so3g.get_num_threads(), 2)
+            self.assertEqual(len(pe.pixel_ranges(pbore, pdet)), 2)
+        self.assertEqual(so3g.get_num_threads(), n0)
+
+        # The setting is per calling thread.
+        seen = []
+        with so3g.threads.limit(2):
+            t = threading.Thread(
+                target=lambda: seen.append(so3g.get_num_threads()))
+            t.start()
+            t.join()
+        self.assertEqual(seen, [n0])
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'Linux only')
+    def test_affinity(self):
+        mask0 = os.sched_getaffinity(0)
+        cpu = min(mask0)
+        with so3g.threads.limit(2, cpus=[cpu]):
+            # The calling thread is thread 0 of the team.
+            self.assertEqual(os.sched_getaffinity(0), {cpu})
+        self.assertEqual(os.sched_getaffinity(0), mask0)
+
+    @unittest.skipUnless(sys.platform.startswith('linux') and
+                         len(os.sched_getaffinity(0)) > 1,
+                         'Linux with several CPUs only')
+    def test_affinity_workers(self):
+        # The other threads are pinned in the regions that do the work.
+        def masks():
+            return [os.sched_getaffinity(int(tid))
+                    for tid in os.listdir('/proc/self/task')]
+        mask0 = os.sched_getaffinity(0)
+        cpu = max(mask0)
+        pe = so3g.ProjEng_CAR_T(so3g.Pixelizor2_Flat(10, 10, .01, .01, 5, 5))
+        pbore = np.zeros((1000, 4))
+        pbore[:, 0] = 1.
+        pdet = pbore[:4]
+        with so3g.threads.limit(4, cpus=[cpu]):
+            for i in range(3):
+                pe.pixel_ranges(pbore, pdet)
+            self.assertGreaterEqual(masks().count({cpu}), 4)
+        with so3g.threads.limit(4):
+            pe.pixel_ranges(pbore, pdet)
+        self.assertEqual(masks().count({cpu}), 0)
+
+    def test_submit(self):
+        pe = so3g.ProjEng_CAR_T(so3g.Pixelizor2_Flat(10, 10, .01, .01, 5, 5))
+        pbore = np.zeros((1000, 4))
+        pbore[:, 0] = 1.
+        pdet = so3g.proj.quat.rotation_xieta(np.arange(3) * .01, 0.)
+        pdet = np.asarray(pdet)
+        signal = np.ones((3, 1000), 'float32')
+        ref = pe.to_map(None, pbore, pdet, signal, None)
+
+        fut = so3g.threads.submit(pe.to_map, None, pbore, pdet, signal, None)
+        np.testing.assert_array_equal(fut.result(), ref)
+
+        # The caller's thread limit is carried to the worker.
+        with so3g.threads.limit(2):
+            fut = so3g.threads.submit(so3g.get_num_threads)
+        self.assertEqual(fut.result(), 2)
+
+        # Exceptions are delivered through the future.
+        fut = so3g.threads.submit(pe.to_map, None, pbore[:, :3], pdet,
+                                  signal, None)
+        with self.assertRaises(RuntimeError):
+            fut.result()
+
+        # asyncio.
+        async def project():
+            return await asyncio.wrap_future(so3g.threads.submit(
+                pe.to_map, None, pbore, pdet, signal, None))
+        np.testing.assert_array_equal(asyncio.run(project()), ref)
+        so3g.threads.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()